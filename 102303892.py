@@ -3,35 +3,112 @@
 Mashup Program - Downloads YouTube videos of a singer, converts to audio,
 cuts first Y seconds, and merges into a single output file.
 
-Usage: python <program.py> <SingerName> <NumberOfVideos> <AudioDuration> <OutputFileName>
+Usage: python <program.py> [--jobs N] [--normalize LUFS] [--crossfade SECONDS] [--segment start|energy] <SingerName> <NumberOfVideos> <AudioDuration> <OutputFileName>
 Example: python mashup.py "Sharry Maan" 20 20 output.mp3
+
+--jobs N decodes and trims up to N tracks at once (default: one per CPU core).
+--normalize LUFS normalizes every clip to that integrated loudness (e.g. -14).
+--crossfade SECONDS overlaps consecutive clips with a crossfade of that length.
+--segment energy keeps the most energetic Y seconds of each track instead of the first Y.
+
+Batch mode: python <program.py> --batch <manifest.jsonl|manifest.csv> [--concurrency K] [--report report.json] [options]
+Each manifest row has singer, videos, duration and output (a JSON object per
+line, or CSV columns with that header). Rows run in one process, up to K at
+once (default 2), sharing the search and clip caches, the download slots
+(MASHUP_GLOBAL_DOWNLOADS) and the decoder slots (MASHUP_GLOBAL_DECODES).
+A status line per row is printed at the end and written to --report as JSON.
 """
 
 import sys
 import os
-from pytubefix import YouTube, Search
-from pydub import AudioSegment
-import shutil
-
-# Configure ffmpeg and ffprobe paths for pydub
-ffmpeg_path = os.path.join(os.environ.get('LOCALAPPDATA', ''), 
-                           'Microsoft', 'WinGet', 'Packages',
-                           'Gyan.FFmpeg_Microsoft.Winget.Source_8wekyb3d8bbwe',
-                           'ffmpeg-8.0.1-full_build', 'bin', 'ffmpeg.exe')
-ffprobe_path = os.path.join(os.environ.get('LOCALAPPDATA', ''), 
-                            'Microsoft', 'WinGet', 'Packages',
-                            'Gyan.FFmpeg_Microsoft.Winget.Source_8wekyb3d8bbwe',
-                            'ffmpeg-8.0.1-full_build', 'bin', 'ffprobe.exe')
-if os.path.exists(ffmpeg_path):
-    AudioSegment.converter = ffmpeg_path
-    AudioSegment.ffprobe = ffprobe_path
+import json
+import time
+import clip_cache
+import workspace
+import search_cache
+from pipeline import MashupPipeline, DECODE_WORKERS
+from segment_select import SEGMENT_MODE, SEGMENT_MODES
+from track_filter import TrackFilter
+from audio_engine import (stream_concat, transcode, run_parallel, get_ffmpeg, EngineError,
+                          LOUDNESS_TARGET, CROSSFADE_SECONDS)
+
+# ffmpeg/ffprobe are located on first use (PATH, MASHUP_FFMPEG/MASHUP_FFPROBE,
+# or the Windows winget install), and pydub is only loaded by the fallback path
+
+# Batch mode: manifest rows processed at once (override with --concurrency)
+BATCH_CONCURRENCY = int(os.environ.get("MASHUP_BATCH_CONCURRENCY", "2"))
+# Accepted manifest column names for each field
+MANIFEST_FIELDS = {
+    'singer': ('singer', 'singer_name', 'artist'),
+    'videos': ('videos', 'num_videos', 'n'),
+    'duration': ('duration', 'seconds', 'y'),
+    'output': ('output', 'output_file'),
+}
+
+
+def _option_value(name, value, convert, check, message):
+    """Convert an option value, exiting with `message` if it is invalid"""
+    try:
+        value = convert(value)
+        if not check(value):
+            raise ValueError
+    except ValueError:
+        print(f"Error: {name} {message}")
+        sys.exit(1)
+    return value
+
+
+def parse_options(args):
+    """Remove the --jobs N (-j N), --normalize LUFS, --crossfade SECONDS,
+    --segment MODE, --batch FILE, --concurrency K and --report FILE options
+    (also accepted as --option=value) from args.
+
+    Returns (args, options) where options has 'jobs', 'loudness', 'crossfade',
+    'segment', 'batch', 'concurrency' and 'report'.
+    """
+    options = {'jobs': DECODE_WORKERS, 'loudness': LOUDNESS_TARGET, 'crossfade': CROSSFADE_SECONDS,
+               'segment': SEGMENT_MODE, 'batch': None, 'concurrency': BATCH_CONCURRENCY, 'report': None}
+    # option -> (key, converter, validity check, error message)
+    known = {
+        '--jobs': ('jobs', int, lambda v: v >= 1, "must be a positive integer"),
+        '--normalize': ('loudness', float, lambda v: -70 <= v <= -5,
+                        "must be a loudness between -70 and -5 LUFS"),
+        '--crossfade': ('crossfade', float, lambda v: v >= 0,
+                        "must be a non-negative number of seconds"),
+        '--segment': ('segment', str, lambda v: v in SEGMENT_MODES,
+                      f"must be one of: {', '.join(SEGMENT_MODES)}"),
+        '--batch': ('batch', str, os.path.isfile, "must be an existing manifest file"),
+        '--concurrency': ('concurrency', int, lambda v: v >= 1, "must be a positive integer"),
+        '--report': ('report', str, bool, "must be a file name"),
+    }
+    remaining = []
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        name, has_value, value = arg.partition('=')
+        if name == '-j':
+            name = '--jobs'
+        if name in known:
+            if not has_value:
+                if i + 1 < len(args):
+                    i += 1
+                    value = args[i]
+                else:
+                    value = ''
+            key, convert, check, message = known[name]
+            options[key] = _option_value(name, value, convert, check, message)
+        else:
+            remaining.append(arg)
+        i += 1
+    return remaining, options
 
 
 def validate_arguments(args):
     """Validate command line arguments"""
     if len(args) != 5:
         print("Error: Incorrect number of parameters")
-        print("Usage: python <program.py> <SingerName> <NumberOfVideos> <AudioDuration> <OutputFileName>")
+        print("Usage: python <program.py> [--jobs N] [--normalize LUFS] [--crossfade SECONDS] [--segment start|energy] <SingerName> <NumberOfVideos> <AudioDuration> <OutputFileName>")
+        print("       python <program.py> --batch <manifest.jsonl|manifest.csv> [--concurrency K] [--report report.json] [options]")
         print("Example: python mashup.py 'Sharry Maan' 20 20 output.mp3")
         sys.exit(1)
     
@@ -62,157 +139,301 @@ def validate_arguments(args):
     return singer_name, num_videos, duration, output_file
 
 
-def download_videos(singer_name, num_videos):
-    """Download videos from YouTube"""
+def search_videos(singer_name, num_videos, duration=None, segment=SEGMENT_MODE):
+    """Search YouTube and return (videos, track filter): the first `num_videos`
+    results that look like distinct songs, and the filter holding the rest"""
     print(f"\nSearching for '{singer_name}' videos on YouTube...")
     
-    # Create temporary directory for downloads
-    temp_dir = "temp_downloads"
-    if os.path.exists(temp_dir):
-        shutil.rmtree(temp_dir)
-    os.makedirs(temp_dir)
-    
     try:
-        # Search for videos
-        search = Search(singer_name)
-        results = search.results
-        
-        if not results:
-            print(f"Error: No search results found for '{singer_name}'")
-            print("Suggestions:")
-            print("- Try a more common or different spelling")
-            print("- Check your internet connection")
-            print("- Try a different singer name")
-            sys.exit(1)
-        
-        if len(results) < num_videos:
-            print(f"Warning: Only {len(results)} videos found for '{singer_name}'")
-            print(f"Will download all {len(results)} available videos")
-        
-        downloaded_files = []
-        
-        for i, video in enumerate(results[:num_videos]):
-            try:
-                print(f"Downloading video {i+1}/{min(num_videos, len(results))}: {video.title[:50]}...")
-                
-                # Download audio stream
-                audio_stream = video.streams.filter(only_audio=True).first()
-                if audio_stream:
-                    output_path = audio_stream.download(
-                        output_path=temp_dir,
-                        filename=f"video_{i}.mp4"
-                    )
-                    downloaded_files.append(output_path)
-                    print(f"✓ Successfully downloaded video {i+1}")
-                else:
-                    print(f"Warning: No audio stream found for video {i+1}")
-                    
-            except Exception as e:
-                print(f"Error downloading video {i+1}: {str(e)}")
-                continue
-        
-        if len(downloaded_files) == 0:
-            print("\nError: No videos were successfully downloaded")
-            print("This can happen if:")
-            print("1. The singer name returned no valid results")
-            print("2. All videos failed to download (network issues)")
-            print("3. YouTube API restrictions")
-            print("4. Special characters in the name caused issues")
-            print("\nTry:")
-            print("- Using a more common spelling")
-            print("- Removing special characters from the name")
-            print("- Checking your internet connection")
-            sys.exit(1)
-        
-        print(f"\nSuccessfully downloaded {len(downloaded_files)} videos")
-        return downloaded_files
-        
+        results = search_cache.search(singer_name)
     except Exception as e:
-        print(f"Error during video download: {str(e)}")
+        print(f"Error during video search: {str(e)}")
+        sys.exit(1)
+    
+    if not results:
+        print(f"Error: No search results found for '{singer_name}'")
+        print("Suggestions:")
+        print("- Try a more common or different spelling")
+        print("- Check your internet connection")
+        print("- Try a different singer name")
+        sys.exit(1)
+    
+    candidates = TrackFilter(results, singer_name, duration=duration, segment=segment)
+    videos = candidates.select(num_videos)
+    if not videos:
+        print(f"Error: None of the search results for '{singer_name}' look like songs")
         sys.exit(1)
+    
+    if len(videos) < num_videos:
+        print(f"Warning: Only {len(videos)} usable videos found for '{singer_name}' "
+              f"(of {len(results)} results)")
+        print(f"Will download all {len(videos)} of them")
+    
+    return videos, candidates
+
 
+def download_and_merge(videos, duration, output_file, temp_dir, jobs=DECODE_WORKERS,
+                       loudness=LOUDNESS_TARGET, crossfade=CROSSFADE_SECONDS,
+                       segment=SEGMENT_MODE, track_filter=None):
+    """Download, trim and merge as a pipeline: each track is decoded while later ones download.
 
-def convert_to_audio(video_files):
-    """Convert video files to audio format"""
+    Downloads and intermediate files go to temp_dir, which must exist.
+    Returns (downloaded_files, merged); merged is False when the pipelined
+    ffmpeg engine failed and the pydub fallback should be used.
+    """
+    part = "most energetic" if segment == 'energy' else "first"
+    print(f"\nDownloading, trimming {part} {duration} seconds and merging with ffmpeg...")
+    
+    mashup_pipeline = MashupPipeline(videos, temp_dir, duration, decode_workers=jobs,
+                                     loudness=loudness, crossfade=crossfade, segment=segment,
+                                     track_filter=track_filter)
+    try:
+        stats = mashup_pipeline.run(output_file, bitrate='192k')
+    except EngineError as e:
+        stats = None
+        print(f"Pipelined ffmpeg engine failed: {str(e)}")
+    
+    downloaded_files = mashup_pipeline.downloaded_files()
+    print(f"Clip cache counters: {clip_cache.stats()}")
+    if track_filter and track_filter.skipped:
+        print(f"Left out {len(track_filter.skipped)} search results (non-music or duplicates)")
+    
+    if len(downloaded_files) == 0:
+        print("\nError: No videos were successfully downloaded")
+        print("This can happen if:")
+        print("1. The singer name returned no valid results")
+        print("2. All videos failed to download (network issues)")
+        print("3. YouTube API restrictions")
+        print("4. Special characters in the name caused issues")
+        print("\nTry:")
+        print("- Using a more common spelling")
+        print("- Removing special characters from the name")
+        print("- Checking your internet connection")
+        sys.exit(1)
+    
+    print(f"\nSuccessfully downloaded {len(downloaded_files)} videos")
+    if stats is None:
+        print("Falling back to pydub processing")
+        return downloaded_files, False
+    
+    print(f"\nSuccess! Mashup created: {output_file}")
+    print(f"Total duration: {stats['duration']:.2f} seconds")
+    print(f"Peak memory - process RSS: {stats['process_peak_rss_kb']} KB "
+          f"(from {stats['process_start_rss_kb']} KB), encoder RSS: {stats['encoder_peak_rss_kb']} KB")
+    return downloaded_files, True
+
+
+def convert_to_audio(video_files, jobs=1):
+    """Convert video files to audio format (up to `jobs` files at once)"""
     print("\nProcessing audio from videos...")
     audio_files = []
     
-    for i, video_file in enumerate(video_files):
-        try:
-            print(f"Processing file {i+1}/{len(video_files)}...")
-            audio = AudioSegment.from_file(video_file)
-            audio_file = video_file.replace('.mp4', '_audio.mp4')
-            audio.export(audio_file, format='mp4', codec='aac')
-            audio_files.append(audio_file)
-        except Exception as e:
-            print(f"Error processing audio {i+1}: {str(e)}")
+    converter = get_ffmpeg()
+    arg_list = [
+        (video_file, os.path.splitext(video_file)[0] + '_audio.mp4', None, 'aac', 'mp4', converter)
+        for video_file in video_files
+    ]
+    for i, audio_file, error in run_parallel(transcode, arg_list, jobs):
+        if error is not None:
+            print(f"Error processing audio {i+1}: {str(error)}")
             continue
+        print(f"Processed file {i+1}/{len(video_files)}")
+        audio_files.append(audio_file)
     
     print(f"Successfully processed {len(audio_files)} audio files")
     return audio_files
 
 
-def cut_audio(audio_files, duration):
-    """Cut first Y seconds from each audio file"""
+def cut_audio(audio_files, duration, jobs=1):
+    """Cut first Y seconds from each audio file (up to `jobs` files at once)"""
     print(f"\nCutting first {duration} seconds from each audio...")
     cut_audio_files = []
     
-    for i, audio_file in enumerate(audio_files):
-        try:
-            audio = AudioSegment.from_file(audio_file)
-            
-            # Cut first 'duration' seconds (duration is in seconds, pydub uses milliseconds)
-            cut_audio = audio[:duration * 1000]
-            
-            cut_file = audio_file.replace('_audio.mp4', '_cut.mp4')
-            cut_audio.export(cut_file, format='mp4', codec='aac')
-            cut_audio_files.append(cut_file)
-            
-        except Exception as e:
-            print(f"Error cutting audio {i+1}: {str(e)}")
+    # Only the first 'duration' seconds of each file are decoded
+    converter = get_ffmpeg()
+    arg_list = [
+        (audio_file, audio_file.replace('_audio.mp4', '_cut.mp4'), duration, 'aac', 'mp4', converter)
+        for audio_file in audio_files
+    ]
+    for i, cut_file, error in run_parallel(transcode, arg_list, jobs):
+        if error is not None:
+            print(f"Error cutting audio {i+1}: {str(error)}")
             continue
+        cut_audio_files.append(cut_file)
     
     print(f"Successfully cut {len(cut_audio_files)} audio files")
     return cut_audio_files
 
 
-def merge_audio(audio_files, output_file):
+def merge_audio(audio_files, output_file, jobs=1, loudness=LOUDNESS_TARGET,
+                crossfade=CROSSFADE_SECONDS):
     """Merge all audio files into a single output file"""
     print("\nMerging audio files...")
     
     try:
-        # Start with empty audio
-        combined = AudioSegment.empty()
-        
-        for i, audio_file in enumerate(audio_files):
-            audio = AudioSegment.from_file(audio_file)
-            combined += audio
-            print(f"Merged file {i+1}/{len(audio_files)}")
+        # Stream each file into a single encoder instead of accumulating in memory
+        stats = stream_concat(audio_files, output_file, codec='aac', bitrate='192k', jobs=jobs,
+                              loudness=loudness, crossfade=crossfade)
         
-        # Export final merged file as MP4
-        combined.export(
-            output_file,
-            format='mp4',
-            codec='aac',
-            bitrate='192k'
-        )
         print(f"\nSuccess! Mashup created: {output_file}")
-        print(f"Total duration: {len(combined)/1000:.2f} seconds")
+        print(f"Total duration: {stats['duration']:.2f} seconds")
+        print(f"Peak memory - process RSS: {stats['process_peak_rss_kb']} KB "
+              f"(from {stats['process_start_rss_kb']} KB), encoder RSS: {stats['encoder_peak_rss_kb']} KB, "
+              f"segment buffer: {stats['peak_segment_bytes']} bytes")
         
     except Exception as e:
         print(f"Error merging audio files: {str(e)}")
         sys.exit(1)
 
 
-def cleanup(temp_dir="temp_downloads"):
-    """Clean up temporary files"""
-    print("\nCleaning up temporary files...")
+def load_manifest(path):
+    """Read batch rows from a JSONL manifest (one object per line) or a CSV
+    manifest with a header row. Returns a list of dicts."""
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.lower().endswith('.csv'):
+            import csv
+            return [dict(row) for row in csv.DictReader(f)]
+        rows = []
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                row = {'error': f"line {line_number} is not valid JSON: {str(e)}"}
+            if not isinstance(row, dict):
+                row = {'error': f"line {line_number} is not a JSON object"}
+            rows.append(row)
+        return rows
+
+
+def validate_row(row):
+    """Return (singer_name, num_videos, duration, output_file) for a manifest
+    row, with the same rules as the command-line arguments.
+
+    Raises ValueError describing the first problem.
+    """
+    if 'error' in row:
+        raise ValueError(row['error'])
+    values = {}
+    for field, names in MANIFEST_FIELDS.items():
+        value = next((row[name] for name in names if row.get(name) not in (None, '')), None)
+        if value is None:
+            raise ValueError(f"missing {field}")
+        values[field] = str(value).strip()
     try:
-        if os.path.exists(temp_dir):
-            shutil.rmtree(temp_dir)
-        print("Cleanup complete")
+        num_videos = int(values['videos'])
+    except ValueError:
+        raise ValueError("number of videos must be a valid integer")
+    if num_videos <= 10:
+        raise ValueError("number of videos must be greater than 10")
+    try:
+        duration = int(values['duration'])
+    except ValueError:
+        raise ValueError("audio duration must be a valid integer")
+    if duration <= 20:
+        raise ValueError("audio duration must be greater than 20 seconds")
+    return values['singer'], num_videos, duration, values['output']
+
+
+def run_batch_row(index, singer_name, num_videos, duration, output_file, options):
+    """Produce one manifest row's mashup; returns its status dict (never raises)"""
+    def log(message):
+        print(f"[{index}] {message}")
+
+    status = {'row': index, 'singer': singer_name, 'videos': num_videos, 'duration': duration,
+              'output': output_file, 'status': 'failed', 'error': None}
+    started = time.perf_counter()
+    try:
+        workspace.check_quota(workspace.estimate_job_bytes(num_videos, duration))
+        output_dir = os.path.dirname(os.path.abspath(output_file))
+        os.makedirs(output_dir, exist_ok=True)
+
+        results = search_cache.search(singer_name)
+        if not results:
+            raise ValueError(f"no search results found for '{singer_name}'")
+        candidates = TrackFilter(results, singer_name, duration=duration,
+                                 segment=options['segment'], log=log)
+        videos = candidates.select(num_videos)
+        if not videos:
+            raise ValueError(f"none of the search results for '{singer_name}' look like songs")
+        log(f"Found {len(results)} videos for '{singer_name}', using {len(videos)}")
+
+        with workspace.job_workspace(f"batch{index}", keep_failed=False) as temp_dir:
+            mashup_pipeline = MashupPipeline(videos, temp_dir, duration,
+                                             decode_workers=options['jobs'],
+                                             loudness=options['loudness'],
+                                             crossfade=options['crossfade'],
+                                             segment=options['segment'],
+                                             track_filter=candidates, log=log)
+            try:
+                stats = mashup_pipeline.run(output_file, bitrate='192k')
+            except EngineError as e:
+                downloaded_files = mashup_pipeline.downloaded_files()
+                if not downloaded_files:
+                    raise
+                log(f"Pipelined ffmpeg engine failed ({str(e)}), falling back to pydub")
+                stats = stream_concat(downloaded_files, output_file, duration=duration,
+                                      codec='aac', bitrate='192k', jobs=1,
+                                      loudness=options['loudness'],
+                                      crossfade=options['crossfade'], log=log)
+            status.update(downloaded=len(mashup_pipeline.downloaded_files()),
+                          segments=stats['segments'], audio_seconds=round(stats['duration'], 2),
+                          skipped=len(candidates.skipped))
+        status['status'] = 'ok'
     except Exception as e:
-        print(f"Warning: Could not clean up temporary files: {str(e)}")
+        status['error'] = str(e)
+        log(f"Error: {str(e)}")
+    status['seconds'] = round(time.perf_counter() - started, 2)
+    return status
+
+
+def run_batch(manifest, options):
+    """Run every row of a manifest in this process and report each row's outcome.
+
+    Returns the process exit code: 0 if every row succeeded, 1 otherwise.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    rows = load_manifest(manifest)
+    print(f"\nBatch: {len(rows)} rows from {manifest}, {options['concurrency']} at a time")
+
+    statuses = [None] * len(rows)
+    valid = []
+    outputs = set()
+    for index, row in enumerate(rows, 1):
+        try:
+            singer_name, num_videos, duration, output_file = validate_row(row)
+            if os.path.abspath(output_file) in outputs:
+                raise ValueError(f"output {output_file} is used by an earlier row")
+            outputs.add(os.path.abspath(output_file))
+            valid.append((index, singer_name, num_videos, duration, output_file))
+        except ValueError as e:
+            statuses[index - 1] = {'row': index, 'status': 'invalid', 'error': str(e)}
+
+    workspace.reap(log=print)
+    with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+        futures = [pool.submit(run_batch_row, *args, options) for args in valid]
+        for future in futures:
+            status = future.result()
+            statuses[status['row'] - 1] = status
+
+    print("\n" + "=" * 60)
+    print("Batch report")
+    print("=" * 60)
+    for status in statuses:
+        detail = status['error'] or f"{status['audio_seconds']}s from {status['segments']} tracks " \
+                                    f"in {status['seconds']}s -> {status['output']}"
+        print(f"{status['row']:>4}  {status['status']:<8} {status.get('singer', '')[:30]:<30} {detail}")
+    succeeded = sum(1 for status in statuses if status['status'] == 'ok')
+    print(f"\n{succeeded}/{len(statuses)} rows succeeded")
+    print(f"Clip cache counters: {clip_cache.stats()}")
+
+    if options['report']:
+        with open(options['report'], 'w') as f:
+            json.dump({'manifest': manifest, 'rows': statuses}, f, indent=2)
+        print(f"Report written to {options['report']}")
+    return 0 if statuses and succeeded == len(statuses) else 1
 
 
 def main():
@@ -222,35 +443,56 @@ def main():
     print("=" * 60)
     
     # Validate arguments
-    singer_name, num_videos, duration, output_file = validate_arguments(sys.argv)
+    args, options = parse_options(sys.argv)
+    jobs = options['jobs']
+    if options['batch']:
+        if len(args) != 1:
+            print("Error: --batch takes no other positional parameters")
+            sys.exit(1)
+        sys.exit(run_batch(options['batch'], options))
+    singer_name, num_videos, duration, output_file = validate_arguments(args)
     
+    # Make sure the scratch space fits in the workspace quota, clearing
+    # directories left behind by runs that were killed
+    workspace.reap(log=print)
     try:
-        # Download videos
-        video_files = download_videos(singer_name, num_videos)
-        
-        # Convert to audio
-        audio_files = convert_to_audio(video_files)
-        
-        # Cut audio
-        cut_files = cut_audio(audio_files, duration)
-        
-        # Merge audio
-        merge_audio(cut_files, output_file)
-        
-        # Cleanup
-        cleanup()
+        workspace.check_quota(workspace.estimate_job_bytes(num_videos, duration))
+    except workspace.QuotaExceeded as e:
+        print(f"Error: {str(e)}")
+        sys.exit(1)
+    
+    try:
+        # Each run gets its own temporary directory, removed when it finishes
+        # (also on errors), so several runs can share a working directory
+        with workspace.job_workspace('cli', keep_failed=False) as temp_dir:
+            # Search, then download, trim and merge in overlapping stages,
+            # falling back to pydub if the ffmpeg pipeline fails
+            videos, candidates = search_videos(singer_name, num_videos, duration, options['segment'])
+            video_files, merged = download_and_merge(videos, duration, output_file, temp_dir, jobs=jobs,
+                                                     loudness=options['loudness'],
+                                                     crossfade=options['crossfade'],
+                                                     segment=options['segment'],
+                                                     track_filter=candidates)
+            if not merged:
+                # Convert to audio
+                audio_files = convert_to_audio(video_files, jobs)
+                
+                # Cut audio
+                cut_files = cut_audio(audio_files, duration, jobs)
+                
+                # Merge audio
+                merge_audio(cut_files, output_file, jobs, options['loudness'], options['crossfade'])
         
+        print("\nTemporary files cleaned up")
         print("\n" + "=" * 60)
         print("Mashup generation completed successfully!")
         print("=" * 60)
         
     except KeyboardInterrupt:
         print("\n\nProcess interrupted by user")
-        cleanup()
         sys.exit(1)
     except Exception as e:
         print(f"\nUnexpected error: {str(e)}")
-        cleanup()
         sys.exit(1)
 
 
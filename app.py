@@ -3,46 +3,79 @@ Mashup Web Application
 Allows users to create YouTube mashups via web interface and receive results via email
 """
 
-from flask import Flask, render_template, request, jsonify
-from pytubefix import YouTube, Search
-from pydub import AudioSegment
+from flask import Flask, render_template, request, jsonify, Response, stream_with_context, send_file
 import os
 import shutil
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.base import MIMEBase
-from email.mime.text import MIMEText
-from email import encoders
-import zipfile
-import threading
 import re
+import json
+import threading
+import time
 from dotenv import load_dotenv
+import database
+import search_cache
+import job_queue
+import job_state
+import download_links
+import mailer
+import telemetry
+import result_packaging
+import preview
+import rate_limit
+import workspace
+from pipeline import MashupPipeline
+from track_filter import TrackFilter
+from audio_engine import stream_concat, EngineError
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Configure ffmpeg and ffprobe paths for pydub
-ffmpeg_path = os.path.join(os.environ.get('LOCALAPPDATA', ''), 
-                           'Microsoft', 'WinGet', 'Packages',
-                           'Gyan.FFmpeg_Microsoft.Winget.Source_8wekyb3d8bbwe',
-                           'ffmpeg-8.0.1-full_build', 'bin', 'ffmpeg.exe')
-ffprobe_path = os.path.join(os.environ.get('LOCALAPPDATA', ''), 
-                            'Microsoft', 'WinGet', 'Packages',
-                            'Gyan.FFmpeg_Microsoft.Winget.Source_8wekyb3d8bbwe',
-                            'ffmpeg-8.0.1-full_build', 'bin', 'ffprobe.exe')
-if os.path.exists(ffmpeg_path):
-    AudioSegment.converter = ffmpeg_path
-    AudioSegment.ffprobe = ffprobe_path
-    print(f"Using ffmpeg from: {ffmpeg_path}")
-    print(f"Using ffprobe from: {ffprobe_path}")
-else:
-    print("Warning: ffmpeg not found at expected location, using system PATH")
+# Importing this module only configures it; nothing here starts threads or
+# processes, so it is safe to preload (gunicorn --preload) before forking.
+# ffmpeg is located on first use (audio_engine.find_tool), and pydub and the
+# email modules are imported where they are needed.
 app = Flask(__name__)
 
 # Configuration
 UPLOAD_FOLDER = 'temp_mashups'
-if not os.path.exists(UPLOAD_FOLDER):
-    os.makedirs(UPLOAD_FOLDER)
+os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+
+# Finished mashups are kept here, served through signed download links
+# (valid for MASHUP_LINK_TTL seconds) and shared by identical requests.
+# Only the audio file is stored; zip packages are built while they download
+RESULTS_FOLDER = os.path.join(UPLOAD_FOLDER, 'results')
+RESULT_RETENTION = max(download_links.LINK_TTL, 2 * job_queue.DEDUPE_WINDOW)  # seconds
+download_links.load_secret(os.path.join(UPLOAD_FOLDER, '.link_secret'))
+
+# Job scratch directories (task_<id>_*): unique per job, limited by
+# MASHUP_WORKSPACE_QUOTA_MB at admission, failed ones reaped in the background
+workspace.configure(os.environ.get("MASHUP_WORKSPACE_DIR", UPLOAD_FOLDER))
+
+# Public base URL used in emailed links (defaults to the URL the job was submitted on)
+PUBLIC_URL = os.environ.get("MASHUP_PUBLIC_URL")
+
+# Job queue: requests only enqueue, a bounded pool of worker processes runs
+# create_mashup (pool size: MASHUP_QUEUE_WORKERS, queue limit: MASHUP_MAX_QUEUED).
+# The same SQLite database also holds job progress, the mail outbox, the
+# rate-limit buckets (MASHUP_RATE_IP_* / MASHUP_RATE_EMAIL_*), the shared
+# search cache (MASHUP_SEARCH_TTL) and the metrics, so every web and worker
+# process sees the same state; logs are JSON lines
+QUEUE_DB = os.environ.get("MASHUP_QUEUE_DB", os.path.join(UPLOAD_FOLDER, 'jobs.db'))
+database.configure(QUEUE_DB)
+
+# Tracks decoded at once by each job (MASHUP_DECODE_WORKERS); by default the
+# CPU cores are shared out between the queue workers
+DECODE_JOBS = int(os.environ.get(
+    "MASHUP_DECODE_WORKERS",
+    str(max(1, (os.cpu_count() or 1) // max(1, job_queue.QUEUE_WORKERS)))
+))
+
+# Job status event stream (/jobs/<id>/events). Each open stream holds a
+# request thread, so only MASHUP_SSE_STREAMS run at once per process; the
+# page polls /jobs/<id> instead
+SSE_POLL_INTERVAL = 1.0  # seconds between progress checks
+SSE_MAX_SECONDS = 900  # streams are closed after this; EventSource reconnects
+SSE_STREAMS = int(os.environ.get("MASHUP_SSE_STREAMS", "4"))
+_sse_slots = threading.BoundedSemaphore(SSE_STREAMS)
 
 # Email configuration
 # IMPORTANT: Update these with your actual Gmail credentials before running
@@ -50,11 +83,37 @@ if not os.path.exists(UPLOAD_FOLDER):
 # 1. Enable 2-Factor Authentication on your Google account
 # 2. Generate an App Password: https://myaccount.google.com/apppasswords
 # 3. Use the App Password (not your regular Gmail password)
-SMTP_SERVER = "smtp.gmail.com"
-SMTP_PORT = 587
+SMTP_SERVER = os.environ.get("MASHUP_SMTP_SERVER", "smtp.gmail.com")
+SMTP_PORT = int(os.environ.get("MASHUP_SMTP_PORT", "587"))
+SMTP_STARTTLS = os.environ.get("MASHUP_SMTP_STARTTLS", "1") == "1"  # set to 0 for a local test server
 SENDER_EMAIL = os.environ.get("SENDER_EMAIL", "your_email@gmail.com")  # Update this or set environment variable
 SENDER_PASSWORD = os.environ.get("SENDER_PASSWORD", "your_app_password")  # Update this or set environment variable
 
+# Outgoing mail is queued in the job database and sent over a few reused
+# SMTP connections (MASHUP_MAIL_WORKERS) with retries, outside the mashup jobs
+mailer.configure(SMTP_SERVER, SMTP_PORT, SENDER_EMAIL, SENDER_PASSWORD, starttls=SMTP_STARTTLS)
+
+
+def start_background():
+    """Start this process's job queue supervisor, mail senders and workspace
+    reaper (idempotent).
+
+    Kept out of the import so a preloading master does not start threads
+    that would not survive the fork: gunicorn.conf.py calls this in each
+    worker after it is forked, and the first request calls it otherwise.
+    """
+    job_queue.start_pool({
+        'mashup': 'app:create_mashup',
+        'deliver': 'app:deliver_mashup',
+    }, on_failed=abandon_job)
+    mailer.start()
+    workspace.start_reaper(sweep=prune_records)
+
+
+@app.before_request
+def ensure_background():
+    start_background()
+
 
 def validate_email(email):
     """Validate email format"""
@@ -62,135 +121,266 @@ def validate_email(email):
     return re.match(pattern, email) is not None
 
 
-def create_mashup(singer_name, num_videos, duration, user_email, task_id):
-    """Create mashup in background thread"""
-    temp_dir = os.path.join(UPLOAD_FOLDER, f"task_{task_id}")
+def report_progress(task_id, **fields):
+    """Record job progress for the status API (never fails the job)"""
+    try:
+        job_state.update(task_id, **fields)
+    except Exception as e:
+        telemetry.log_job(task_id, f"Warning - Could not record progress: {str(e)}")
+
+
+def record_download(task_id, path, bytes_fetched):
+    """Download progress callback: count finished videos and fetched bytes"""
+    try:
+        if path:
+            job_state.increment(task_id, 'videos_downloaded')
+        if bytes_fetched:
+            job_state.increment(task_id, 'bytes_fetched', bytes_fetched)
+    except Exception as e:
+        telemetry.log_job(task_id, f"Warning - Could not record progress: {str(e)}")
+
+
+def merge_with_pydub(downloaded_files, duration, output_file, task_id):
+    """Decode and cut audio with pydub (fallback for the single-pass ffmpeg engine).
+
+    Segments are streamed into one encoder one at a time instead of being
+    accumulated in memory, so peak memory stays bounded by a single segment.
+    """
+    telemetry.log_job(task_id, "Processing audio files...")
+    return stream_concat(
+        downloaded_files,
+        output_file,
+        duration=duration,
+        codec='aac',
+        bitrate='192k',
+        jobs=DECODE_JOBS,
+        log=telemetry.job_logger(task_id)
+    )
+
+
+def create_mashup(singer_name, num_videos, duration, user_email, task_id, base_url=None):
+    """Create mashup (runs in a job queue worker process)"""
+    prune_results()
     
     try:
-        # Create task directory
-        os.makedirs(temp_dir, exist_ok=True)
-        
-        print(f"Task {task_id}: Starting mashup creation for {singer_name}")
-        
-        # Search and download videos
-        print(f"Task {task_id}: Searching for videos...")
-        search = Search(singer_name)
-        results = search.results
-        
-        if not results:
-            raise Exception(f"No search results found for '{singer_name}'. Try a different or more common name.")
-        
-        print(f"Task {task_id}: Found {len(results)} videos, will download first {num_videos}")
-        
-        downloaded_files = []
-        for i, video in enumerate(results[:num_videos]):
-            try:
-                print(f"Task {task_id}: Downloading video {i+1}/{num_videos}: {video.title[:50]}")
-                audio_stream = video.streams.filter(only_audio=True).first()
-                if audio_stream:
-                    output_path = audio_stream.download(
-                        output_path=temp_dir,
-                        filename=f"video_{i}.mp4"
-                    )
-                    downloaded_files.append(output_path)
-                    print(f"Task {task_id}: Successfully downloaded video {i+1}")
-                else:
-                    print(f"Task {task_id}: No audio stream available for video {i+1}")
-            except Exception as e:
-                print(f"Task {task_id}: Error downloading video {i+1}: {str(e)}")
-                continue
-        
-        if not downloaded_files:
-            raise Exception(f"No videos were successfully downloaded. This can happen if:\n"
-                          f"1. The singer name '{singer_name}' returned no results\n"
-                          f"2. All videos failed to download (network issues)\n"
-                          f"3. YouTube API restrictions\n"
-                          f"Try using a more common or different spelling of the singer name.")
-        
-        print(f"Task {task_id}: Successfully downloaded {len(downloaded_files)} out of {num_videos} videos")
-        
-        # Convert to audio and cut
-        print(f"Task {task_id}: Processing audio files...")
-        combined = AudioSegment.empty()
+        # Scratch files live in a unique workspace, removed on success and
+        # kept for debugging (until the workspace reaper runs) on failure
+        with workspace.job_workspace(task_id, estimate=workspace.estimate_job_bytes(num_videos, duration)) \
+                as temp_dir:
+            telemetry.log_job(task_id, f"Starting mashup creation for {singer_name}")
+            report_progress(task_id, stage='searching')
+        
+            # Search and download videos
+            telemetry.log_job(task_id, "Searching for videos...")
+            with telemetry.span('search', job_id=task_id) as span:
+                results = search_cache.search(singer_name)
+                span.update(results=len(results))
+        
+            if not results:
+                raise Exception(f"No search results found for '{singer_name}'. Try a different or more common name.")
+        
+            # Leave out non-music results and re-uploads, keeping the rest as replacements
+            candidates = TrackFilter(results, singer_name, duration=duration,
+                                     log=telemetry.job_logger(task_id))
+            videos = candidates.select(num_videos)
+            if not videos:
+                raise Exception(f"None of the search results for '{singer_name}' look like songs. "
+                                f"Try a different or more common name.")
+            telemetry.log_job(task_id, f"Found {len(results)} videos, will download {len(videos)}")
+            report_progress(task_id, stage='downloading', videos_total=len(videos))
+        
+            # Download, trim and merge as a pipeline: each track is decoded while
+            # later ones are still downloading, and encoded in search order
+            output_file = os.path.join(temp_dir, f"mashup_{task_id}.mp4")
+            telemetry.log_job(task_id, f"Exporting combined audio to {output_file}")
+            mashup_pipeline = MashupPipeline(
+                videos,
+                temp_dir,
+                duration,
+                decode_workers=DECODE_JOBS,
+                on_progress=lambda i, path, fetched: record_download(task_id, path, fetched),
+                on_downloads_done=lambda files: report_progress(task_id, stage='processing'),
+                on_segment=lambda i: job_state.increment(task_id, 'videos_processed'),
+                job_id=task_id,
+                track_filter=candidates,
+                log=telemetry.job_logger(task_id)
+            )
         
-        for i, video_file in enumerate(downloaded_files):
             try:
-                print(f"Task {task_id}: Processing audio from video {i+1}/{len(downloaded_files)}")
-                audio = AudioSegment.from_file(video_file)
-                print(f"Task {task_id}: Video {i+1} loaded, duration: {len(audio)/1000:.2f}s")
-                cut_audio = audio[:duration * 1000]  # Cut to specified duration
-                print(f"Task {task_id}: Video {i+1} cut to {duration}s")
-                combined += cut_audio
-                print(f"Task {task_id}: Video {i+1} added to combined audio")
-            except Exception as e:
-                print(f"Task {task_id}: Error processing audio {i+1}: {str(e)}")
-                import traceback
-                traceback.print_exc()
-                continue
-        
-        # Export merged audio as MP4
-        output_file = os.path.join(temp_dir, f"mashup_{task_id}.mp4")
-        print(f"Task {task_id}: Exporting combined audio to {output_file}")
-        print(f"Task {task_id}: Combined audio duration: {len(combined)/1000:.2f}s")
-        
-        try:
-            combined.export(
-                output_file, 
-                format='mp4',
-                codec='aac',
-                bitrate='192k'
-            )
-            print(f"Task {task_id}: Export completed successfully")
+                try:
+                    stats = mashup_pipeline.run(output_file, bitrate='192k')
+                except EngineError as e:
+                    downloaded_files = mashup_pipeline.downloaded_files()
+                    if not downloaded_files:
+                        raise Exception(f"No videos were successfully downloaded. This can happen if:\n"
+                                      f"1. The singer name '{singer_name}' returned no results\n"
+                                      f"2. All videos failed to download (network issues)\n"
+                                      f"3. YouTube API restrictions\n"
+                                      f"Try using a more common or different spelling of the singer name.")
+                    telemetry.log_job(task_id, f"Pipelined ffmpeg engine failed ({str(e)}), falling back to pydub")
+                    with telemetry.span('export', job_id=task_id, engine='pydub'):
+                        stats = merge_with_pydub(downloaded_files, duration, output_file, task_id)
+                    report_progress(task_id, videos_processed=stats['segments'])
+                telemetry.log_job(task_id, f"Successfully downloaded {len(mashup_pipeline.downloaded_files())} "
+                                           f"out of {num_videos} videos")
+                if stats['duration'] is not None:
+                    telemetry.log_job(task_id, f"Combined audio duration: {stats['duration']:.2f}s")
+                memory = (f"process RSS: {stats['process_peak_rss_kb']} KB (from {stats['process_start_rss_kb']} KB), "
+                          f"encoder RSS: {stats['encoder_peak_rss_kb']} KB")
+                if 'peak_segment_bytes' in stats:  # only the pydub path holds whole segments
+                    memory += f", segment buffer: {stats['peak_segment_bytes']} bytes"
+                telemetry.log_job(task_id, f"Peak memory - {memory}")
+                telemetry.log_job(task_id, "Export completed successfully")
             
-            # Check file size
-            file_size = os.path.getsize(output_file)
-            print(f"Task {task_id}: Output file size: {file_size} bytes")
+                # Check file size
+                file_size = os.path.getsize(output_file)
+                telemetry.log_job(task_id, f"Output file size: {file_size} bytes")
             
-            if file_size == 0:
-                raise Exception("Output file is empty (0 bytes)")
+                if file_size == 0:
+                    raise Exception("Output file is empty (0 bytes)")
                 
-        except Exception as e:
-            print(f"Task {task_id}: ERROR during export: {str(e)}")
-            import traceback
-            traceback.print_exc()
-            raise
-        
-        # Create zip file
-        zip_path = os.path.join(temp_dir, f"mashup_{task_id}.zip")
-        with zipfile.ZipFile(zip_path, 'w') as zipf:
-            zipf.write(output_file, os.path.basename(output_file))
-        
-        # Send email
-        print(f"Task {task_id}: Sending email to {user_email}")
-        send_email(user_email, zip_path, singer_name)
-        
-        print(f"Task {task_id}: Completed successfully")
-        
-        # Cleanup after successful completion
-        try:
-            shutil.rmtree(temp_dir)
-            print(f"Task {task_id}: Cleaned up temp files")
-        except Exception as e:
-            print(f"Task {task_id}: Warning - Could not clean up temp files: {str(e)}")
+            except Exception as e:
+                import traceback
+                telemetry.log_job(task_id, f"ERROR during export: {str(e)}", traceback=traceback.format_exc())
+                raise
+        
+            # Keep the result so identical requests arriving later can share it;
+            # it is moved, not copied, and packaged per download (see result_packaging)
+            report_progress(task_id, stage='packaging')
+            with telemetry.span('package', job_id=task_id):
+                os.makedirs(RESULTS_FOLDER, exist_ok=True)
+                result_path = os.path.join(RESULTS_FOLDER, os.path.basename(output_file))
+                shutil.move(output_file, result_path)
+        
+            # Send email to everyone who requested this mashup
+            report_progress(task_id, stage='emailing')
+            with telemetry.span('email', job_id=task_id):
+                email_subscribers(task_id, result_path, singer_name, base_url, fallback=user_email)
+        
+            telemetry.log_job(task_id, "Completed successfully")
+            telemetry.inc('mashup_jobs_total', status='done')
+            report_progress(task_id, stage='done', message='Your mashup has been emailed to you')
+        telemetry.log_job(task_id, "Cleaned up temp files")
         
     except Exception as e:
-        print(f"Task {task_id}: Error - {str(e)}")
-        # Send error email
+        telemetry.log_job(task_id, f"Error - {str(e)}")
+        telemetry.inc('mashup_jobs_total', status='failed')
+        report_progress(task_id, stage='failed', message=str(e))
+        email_failure(task_id, singer_name, str(e), fallback=user_email)
+        telemetry.log_job(task_id, "Keeping the job workspace for debugging until the reaper removes it")
+        raise
+
+
+def email_failure(task_id, singer_name, error_message, fallback=None):
+    """Send the error email to everyone who requested a failed mashup"""
+    try:
+        for recipient in job_queue.claim_subscribers(task_id) or ([fallback] if fallback else []):
+            send_error_email(recipient, singer_name, error_message, task_id=task_id)
+    except Exception as mail_error:
+        telemetry.log_job(task_id, f"Warning - Could not queue error emails: {str(mail_error)}")
+
+
+def abandon_job(job):
+    """Fail a mashup job whose worker kept dying (called by the queue supervisor)"""
+    if job['kind'] != 'mashup':
+        return
+    singer_name, user_email = job['args'][0], job['args'][3]
+    message = "The mashup could not be created because its worker stopped repeatedly"
+    telemetry.inc('mashup_jobs_total', status='failed')
+    report_progress(job['id'], stage='failed', message=message)
+    email_failure(job['id'], singer_name, message, fallback=user_email)
+
+
+def prune_results():
+    """Delete retained results older than RESULT_RETENTION"""
+    if not os.path.isdir(RESULTS_FOLDER):
+        return
+    cutoff = time.time() - RESULT_RETENTION
+    for name in os.listdir(RESULTS_FOLDER):
+        path = os.path.join(RESULTS_FOLDER, name)
         try:
-            send_error_email(user_email, singer_name, str(e))
-        except:
+            if os.path.getmtime(path) < cutoff:
+                os.remove(path)
+        except OSError:
             pass
-        # Keep temp files on error for debugging
-        print(f"Task {task_id}: Keeping temp files in {temp_dir} for debugging due to error")
 
 
-def send_email(recipient_email, zip_path, singer_name):
-    """Send email with zip file attachment"""
+def prune_records():
+    """Delete finished jobs (with their progress and subscribers) and sent or
+    failed mail older than RESULT_RETENTION from the shared database"""
+    cutoff = time.time() - RESULT_RETENTION
+    jobs = job_queue.prune(cutoff)
+    progress = job_state.prune(cutoff)
+    mail = mailer.prune(cutoff)
+    if jobs or progress or mail:
+        telemetry.log(f"Retention sweep: removed {jobs} jobs, {progress} progress records "
+                      f"and {mail} outbox messages")
+
+
+def download_url(result_path, base_url=None, fmt=result_packaging.DEFAULT_FORMAT):
+    """Return a signed, expiring download link for a retained result, packaged as `fmt`"""
+    base_url = (PUBLIC_URL or base_url or 'http://localhost:5000').rstrip('/')
+    token = download_links.make_token(os.path.basename(result_path))
+    return f"{base_url}/download/{token}?format={fmt}"
+
+
+def email_subscribers(task_id, result_path, singer_name, base_url=None, fallback=None):
+    """Email a download link to every subscriber of a job not notified yet.
+
+    Keeps claiming until no new subscribers appear, so requesters who attach
+    while mail is being sent are included; those attaching after the last
+    claim are left to the job's follow-up delivery (see job_queue._finish).
+    Raises the last error if no email could be sent at all.
+    """
+    links = {fmt: download_url(result_path, base_url, fmt) for fmt in result_packaging.PACKAGE_FORMATS}
+    sent = 0
+    failed = set()
+    last_error = None
+    recipients = job_queue.claim_subscribers(task_id) or ([fallback] if fallback else [])
+    while recipients:
+        for recipient in recipients:
+            telemetry.log_job(task_id, f"Sending email to {recipient}")
+            try:
+                send_email(recipient, links, singer_name, task_id=task_id)
+                sent += 1
+            except Exception as e:
+                last_error = e
+                failed.add(recipient)
+        recipients = [r for r in job_queue.claim_subscribers(task_id) if r not in failed]
+    
+    # Leave failed recipients unnotified so a later delivery can retry them
+    for recipient in failed:
+        job_queue.release_subscriber(task_id, recipient)
+    if not sent and last_error is not None:
+        raise last_error
+
+
+def deliver_mashup(task_id):
+    """Notify the subscribers of a finished mashup job that it did not notify
+    itself, because they attached while it was finishing or after it finished
+    (its follow-up job)"""
+    job = job_queue.get_job(task_id)
+    singer_name = job['args'][0]
+    if job['status'] == 'failed':
+        email_failure(task_id, singer_name, job['error'] or "The mashup could not be created")
+        return
+    base_url = job['args'][5] if len(job['args']) > 5 else None
+    result_path = os.path.join(RESULTS_FOLDER, f"mashup_{task_id}.mp4")
+    if not os.path.exists(result_path):
+        raise Exception(f"Result for job {task_id} is no longer available")
+    email_subscribers(task_id, result_path, singer_name, base_url)
+
+
+def send_email(recipient_email, download_links_by_format, singer_name, task_id=None):
+    """Queue an email with download links (one per package format) for the mashup"""
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
     try:
         # Check if email is configured
         if SENDER_EMAIL == "your_email@gmail.com" or SENDER_PASSWORD == "your_app_password":
-            print("ERROR: Email not configured! Please update SENDER_EMAIL and SENDER_PASSWORD in app.py")
-            raise Exception("Email configuration required. Please check the console for instructions.")
+            telemetry.log("Email not configured! Please update SENDER_EMAIL and SENDER_PASSWORD in app.py",
+                          job_id=task_id, level='error')
+            raise Exception("Email configuration required. Please check the logs for instructions.")
         
         # Create message
         msg = MIMEMultipart()
@@ -198,13 +388,24 @@ def send_email(recipient_email, zip_path, singer_name):
         msg['To'] = recipient_email
         msg['Subject'] = f"Your {singer_name} Mashup is Ready!"
         
-        # Email body
+        # Email body: the default package first, then the other formats
+        main_link = download_links_by_format[result_packaging.DEFAULT_FORMAT]
+        other_links = "\n".join(
+            f"- {result_packaging.FORMAT_LABELS[fmt]}: {link}"
+            for fmt, link in download_links_by_format.items() if fmt != result_packaging.DEFAULT_FORMAT
+        )
         body = f"""
 Hello!
 
 Your mashup for {singer_name} has been created successfully.
 
-Please find the attached zip file containing your mashup.
+Download your mashup here:
+{main_link}
+
+Other formats:
+{other_links}
+
+The link expires in {int(download_links.LINK_TTL // 3600)} hours.
 
 Enjoy your music!
 
@@ -213,34 +414,20 @@ Mashup Generator Team
         """
         msg.attach(MIMEText(body, 'plain'))
         
-        # Attach zip file
-        with open(zip_path, 'rb') as attachment:
-            part = MIMEBase('application', 'octet-stream')
-            part.set_payload(attachment.read())
+        # Queue email; the mailer delivers and retries it
+        mailer.enqueue(msg)
         
-        encoders.encode_base64(part)
-        part.add_header(
-            'Content-Disposition',
-            f'attachment; filename= {os.path.basename(zip_path)}'
-        )
-        msg.attach(part)
-        
-        # Send email
-        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        server.starttls()
-        server.login(SENDER_EMAIL, SENDER_PASSWORD)
-        server.send_message(msg)
-        server.quit()
-        
-        print(f"Email sent successfully to {recipient_email}")
+        telemetry.log(f"Email queued for {recipient_email}", job_id=task_id)
         
     except Exception as e:
-        print(f"Error sending email: {str(e)}")
+        telemetry.log(f"Error queueing email: {str(e)}", job_id=task_id, level='error')
         raise
 
 
-def send_error_email(recipient_email, singer_name, error_message):
-    """Send error notification email"""
+def send_error_email(recipient_email, singer_name, error_message, task_id=None):
+    """Queue an error notification email"""
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
     try:
         if SENDER_EMAIL == "your_email@gmail.com" or SENDER_PASSWORD == "your_app_password":
             return
@@ -264,14 +451,10 @@ Mashup Generator Team
         """
         msg.attach(MIMEText(body, 'plain'))
         
-        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        server.starttls()
-        server.login(SENDER_EMAIL, SENDER_PASSWORD)
-        server.send_message(msg)
-        server.quit()
+        mailer.enqueue(msg)
         
     except Exception as e:
-        print(f"Error sending error notification: {str(e)}")
+        telemetry.log(f"Error queueing error notification: {str(e)}", job_id=task_id, level='error')
 
 
 @app.route('/')
@@ -280,6 +463,17 @@ def index():
     return render_template('index.html')
 
 
+def reserved_workspace_bytes():
+    """Return the scratch space admitted mashups will take beyond what their
+    workspaces use so far (all of their estimate while still queued)"""
+    used = workspace.job_usage()
+    reserved = 0
+    for job in job_queue.unfinished_jobs('mashup'):
+        _, num_videos, duration = job['args'][:3]
+        reserved += max(0, workspace.estimate_job_bytes(num_videos, duration) - used.get(job['id'], 0))
+    return reserved
+
+
 @app.route('/create-mashup', methods=['POST'])
 def create_mashup_endpoint():
     """Handle mashup creation request"""
@@ -307,28 +501,247 @@ def create_mashup_endpoint():
         num_videos = int(num_videos)
         duration = int(duration)
         
-        # Generate task ID
-        import time
-        task_id = str(int(time.time()))
-        
-        # Start background thread
-        thread = threading.Thread(
-            target=create_mashup,
-            args=(singer_name, num_videos, duration, email, task_id)
-        )
-        thread.daemon = True
-        thread.start()
+        # Refuse new work while job workspaces would not fit in the disk quota,
+        # counting what queued and running mashups will still need
+        try:
+            workspace.check_quota(workspace.estimate_job_bytes(num_videos, duration),
+                                  reserved=reserved_workspace_bytes())
+        except workspace.QuotaExceeded as e:
+            telemetry.log(f"Rejected job: {str(e)}", level='warning')
+            response = jsonify({'error': 'The server is low on disk space. Please try again in a few minutes.'})
+            response.status_code = 503
+            response.headers['Retry-After'] = '300'
+            return response
+        
+        # Refuse clients submitting faster than their token buckets refill. The
+        # tokens are given back if the queue is full; a request attached to an
+        # existing job only gets its email token back, since it still costs an
+        # email to an address the client picked
+        client = rate_limit.client_ip(request.remote_addr, request.headers.get('X-Forwarded-For'))
+        charges = [('ip', client), ('email', email.lower())]
+        try:
+            rate_limit.acquire(charges)
+        except rate_limit.RateLimited as e:
+            telemetry.inc('mashup_rate_limited_total', scope=e.scope)
+            telemetry.log(f"Rejected job: {str(e)}", level='warning', client=client)
+            response = jsonify({'error': f'Too many mashup requests from this {e.scope}. '
+                                         f'Please try again in {int(e.retry_after // 60) + 1} minutes.'})
+            response.status_code = 429
+            response.headers['Retry-After'] = str(int(e.retry_after) + 1)
+            return response
+        
+        # Generate a unique task ID
+        task_id = job_queue.new_job_id()
+        
+        # Queue the job, or attach to an identical one that is in flight or
+        # recently finished; reject with 429 when the queue is saturated.
+        # Jobs are scheduled fairly per client, smaller ones (N x Y) first
+        dedupe_key = f"{search_cache.normalize(singer_name)}|{num_videos}|{duration}"
+        try:
+            job = job_queue.submit(
+                task_id,
+                [singer_name, num_videos, duration, email, task_id, request.host_url],
+                dedupe_key=dedupe_key,
+                subscriber=email,
+                client=client,
+                cost=num_videos * duration,
+                followup='deliver'
+            )
+        except job_queue.QueueFull as e:
+            rate_limit.refund(charges)
+            response = jsonify({
+                'error': f'The server is busy ({e.queue_length} mashups waiting). Please try again in a few minutes.',
+                'queue_position': e.queue_length + 1
+            })
+            response.status_code = 429
+            response.headers['Retry-After'] = '60'
+            return response
+        
+        if job['attached']:
+            rate_limit.refund([('email', email.lower())])
+        if not job['attached']:
+            report_progress(task_id, stage='queued')
+            message = f'Your mashup is being created (position {job["queue_position"]} in the queue)!'
+        elif job['status'] == 'done':
+            # Already finished: the queue emails the existing result (one
+            # 'deliver' job waiting per finished job covers every new subscriber)
+            message = 'This mashup was just created for someone else, so it is ready now!'
+        else:
+            message = 'This mashup is already being created, so you will get a copy!'
         
         return jsonify({
             'success': True,
-            'message': f'Your mashup is being created! You will receive an email at {email} once it\'s ready. This may take several minutes.',
-            'task_id': task_id
+            'message': f'{message} You will receive an email at {email} once it\'s ready. This may take several minutes.',
+            'task_id': job['job_id'],
+            'queue_position': job['queue_position']
         })
         
     except Exception as e:
         return jsonify({'error': f'Server error: {str(e)}'}), 500
 
 
+@app.route('/preview')
+def preview_endpoint():
+    """Stream a short mono preview of a mashup (MASHUP_PREVIEW_SECONDS per track) as MP3"""
+    started = time.perf_counter()
+    singer_name = request.args.get('singer_name', '').strip()
+    num_videos = request.args.get('num_videos', '').strip() or '11'
+    if not singer_name:
+        return jsonify({'error': 'Singer name is required'}), 400
+    if not num_videos.isdigit() or int(num_videos) < 1:
+        return jsonify({'error': 'Number of videos must be a positive integer'}), 400
+    num_videos = min(int(num_videos), preview.PREVIEW_MAX_TRACKS)
+
+    client = rate_limit.client_ip(request.remote_addr, request.headers.get('X-Forwarded-For'))
+    try:
+        rate_limit.acquire([('preview', client)])
+    except rate_limit.RateLimited as e:
+        telemetry.inc('mashup_rate_limited_total', scope=e.scope)
+        response = jsonify({'error': f'Too many previews. Please try again in {int(e.retry_after // 60) + 1} minutes.'})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(int(e.retry_after) + 1)
+        return response
+
+    if not preview.try_acquire():
+        response = jsonify({'error': 'The server is busy making other previews. Please try again shortly.'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '10'
+        return response
+
+    # The stream owns the slot from here and frees it when the preview stops
+    preview_id = job_queue.new_job_id()
+    stream = preview.PreviewStream(singer_name, num_videos, job_id=preview_id, started=started,
+                                   log=telemetry.job_logger(preview_id))
+    try:
+        stream.start()
+    except preview.PreviewError as e:
+        telemetry.log_job(preview_id, f"Preview failed: {str(e)}")
+        return jsonify({'error': str(e)}), e.status
+    # The response closes the stream when it is done or abandoned
+    return Response(stream, mimetype=preview.MIMETYPE,
+                    headers={'Cache-Control': 'no-store', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/download/<token>')
+def download_endpoint(token):
+    """Stream a finished mashup from disk, as is (supports Range and ETag
+    requests) or packaged on the fly as ?format=zip or ?format=bundle"""
+    try:
+        filename = download_links.verify_token(token)
+    except download_links.InvalidToken as e:
+        return jsonify({'error': str(e)}), 403
+    
+    fmt = request.args.get('format', 'raw')
+    if fmt not in result_packaging.PACKAGE_FORMATS:
+        return jsonify({'error': f"Format must be one of: {', '.join(result_packaging.PACKAGE_FORMATS)}"}), 400
+    
+    path = os.path.abspath(os.path.join(RESULTS_FOLDER, filename))
+    if not os.path.isfile(path):
+        return jsonify({'error': 'This mashup is no longer available'}), 404
+    if fmt == 'raw':
+        return send_file(
+            path,
+            as_attachment=True,
+            download_name=result_packaging.download_name(path, fmt),
+            conditional=True,
+            etag=True,
+            max_age=3600
+        )
+    return Response(
+        result_packaging.stream_package(path, fmt),
+        mimetype='application/zip',
+        headers={
+            'Content-Disposition': f'attachment; filename="{result_packaging.download_name(path, fmt)}"',
+            'Cache-Control': 'private, max-age=3600',
+        }
+    )
+
+
+def job_status(task_id):
+    """Combine a job's queue state and progress into one dict (None if unknown)"""
+    job = job_queue.get_job(task_id)
+    progress = job_state.get(task_id)
+    if job is None:
+        return None
+    
+    status = job['status']
+    if progress and progress['stage'] == 'failed':
+        status = 'failed'
+    
+    result = {
+        'task_id': task_id,
+        'status': status,
+        'queue_position': job.get('queue_position'),
+        'error': job['error'],
+    }
+    if progress:
+        result.update({
+            'stage': progress['stage'],
+            'message': progress['message'],
+            'videos_total': progress['videos_total'],
+            'videos_downloaded': progress['videos_downloaded'],
+            'videos_processed': progress['videos_processed'],
+            'bytes_fetched': progress['bytes_fetched'],
+            'eta_seconds': progress['eta_seconds'],
+        })
+    return result
+
+
+@app.route('/jobs/<task_id>')
+def job_status_endpoint(task_id):
+    """Report the stage and progress of a mashup job"""
+    status = job_status(task_id)
+    if status is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    return jsonify(status)
+
+
+@app.route('/jobs/<task_id>/events')
+def job_events_endpoint(task_id):
+    """Stream job progress as server-sent events until the job finishes"""
+    if job_status(task_id) is None:
+        return jsonify({'error': 'Unknown job'}), 404
+    if not _sse_slots.acquire(blocking=False):
+        response = jsonify({'error': f'Too many open event streams; poll /jobs/{task_id} instead'})
+        response.status_code = 503
+        response.headers['Retry-After'] = '30'
+        return response
+    
+    def events():
+        last = None
+        deadline = time.time() + SSE_MAX_SECONDS
+        while time.time() < deadline:
+            status = job_status(task_id)
+            if status != last:
+                yield f"data: {json.dumps(status)}\n\n"
+                last = status
+            if status['status'] in ('done', 'failed'):
+                return
+            time.sleep(SSE_POLL_INTERVAL)
+    
+    response = Response(
+        stream_with_context(events()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    response.call_on_close(_sse_slots.release)  # also when the client goes away
+    return response
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Expose stage timings, bytes downloaded, queue depth and failures to Prometheus"""
+    jobs = job_queue.queue_stats()
+    gauges = {
+        'mashup_queue_depth': jobs.get('queued', 0),
+        'mashup_active_jobs': jobs.get('running', 0),
+        'mashup_mail_outbox': {
+            (('status', status),): count for status, count in mailer.outbox_stats().items()
+        },
+    }
+    return Response(telemetry.render(gauges), mimetype='text/plain; version=0.0.4')
+
+
 if __name__ == '__main__':
     # Print startup instructions
     print("\n" + "="*60)
@@ -349,4 +762,5 @@ if __name__ == '__main__':
     print("  set SENDER_PASSWORD=your_app_password")
     print("="*60 + "\n")
     
+    start_background()
     app.run(debug=True, host='0.0.0.0', port=5000)
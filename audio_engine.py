@@ -0,0 +1,516 @@
+"""
+Native ffmpeg audio engine.
+Callers keep their pydub code path as a fallback when this engine fails.
+
+The streaming assembler (stream_concat) is the bounded-memory pydub path:
+it decodes one trimmed segment at a time and pipes its PCM straight into a
+single encoder instead of accumulating an AudioSegment.
+
+decode_segment and encode_pcm are the per-track building blocks used by the
+download/decode/encode pipeline (see pipeline).
+
+Both streaming paths can normalize each clip to an EBU R128 loudness target
+(ffmpeg's loudnorm filter, applied while the clip is decoded) and crossfade
+the joins (PCMCrossfader, which mixes only the overlapping samples with
+NumPy while the PCM streams to the encoder).
+
+ffmpeg and ffprobe are located once per process, on first use (see
+find_tool), and pydub is only imported by the fallback paths that need it.
+"""
+
+import io
+import math
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+from collections import deque
+
+# Sample format every input is resampled to before concatenation
+SAMPLE_RATE = 44100
+FRAME_BYTES = 4  # one s16le stereo sample frame
+
+# Mixing defaults (override with environment variables)
+LOUDNESS_TARGET = float(os.environ["MASHUP_LOUDNESS_TARGET"]) \
+    if os.environ.get("MASHUP_LOUDNESS_TARGET") else None  # integrated LUFS, e.g. -14; unset = off
+CROSSFADE_SECONDS = float(os.environ.get("MASHUP_CROSSFADE", "0"))
+TRUE_PEAK = -1.5  # dBTP ceiling used with the loudness target
+LOUDNESS_RANGE = 11  # LU
+COPY_CHUNK = 256 * 1024
+
+# Where the winget package puts ffmpeg on Windows, tried after PATH
+WINGET_FFMPEG_DIR = os.path.join(os.environ.get('LOCALAPPDATA', ''),
+                                 'Microsoft', 'WinGet', 'Packages',
+                                 'Gyan.FFmpeg_Microsoft.Winget.Source_8wekyb3d8bbwe',
+                                 'ffmpeg-8.0.1-full_build', 'bin')
+TOOL_CHECK_TIMEOUT = 10  # seconds allowed for `<tool> -version`
+
+_tools = {}  # name -> discovered path
+_tools_lock = threading.Lock()
+
+
+class EngineError(Exception):
+    """Raised when the native ffmpeg engine cannot produce the output"""
+
+
+def _tool_works(path):
+    """Return True if path is an executable that runs `-version` successfully"""
+    if not (os.path.isfile(path) and os.access(path, os.X_OK)):
+        return False
+    try:
+        return subprocess.run([path, '-version'], stdout=subprocess.DEVNULL,
+                              stderr=subprocess.DEVNULL, timeout=TOOL_CHECK_TIMEOUT).returncode == 0
+    except (OSError, subprocess.SubprocessError):
+        return False
+
+
+def find_tool(name):
+    """Return the path of `name` (ffmpeg or ffprobe), discovered once per process.
+
+    Tries MASHUP_FFMPEG / MASHUP_FFPROBE, then PATH, then the Windows winget
+    install, and keeps the first candidate that actually runs. If none does,
+    the bare name is returned so running it reports the missing binary.
+    """
+    with _tools_lock:
+        if name not in _tools:
+            candidates = [
+                os.environ.get(f"MASHUP_{name.upper()}"),
+                shutil.which(name),
+                os.path.join(WINGET_FFMPEG_DIR, f"{name}.exe") if os.name == 'nt' else None,
+            ]
+            _tools[name] = next((path for path in candidates if path and _tool_works(path)), name)
+        return _tools[name]
+
+
+def get_ffmpeg():
+    """Return the ffmpeg binary to run"""
+    return find_tool('ffmpeg')
+
+
+def load_pydub(converter=None):
+    """Import pydub (only the fallback paths need it) and point it at our ffmpeg/ffprobe.
+
+    Returns the AudioSegment class.
+    """
+    from pydub import AudioSegment, utils
+    AudioSegment.converter = converter or get_ffmpeg()
+    ffprobe = find_tool('ffprobe')
+    AudioSegment.ffprobe = ffprobe
+    if ffprobe != 'ffprobe':
+        utils.get_prober_name = lambda: ffprobe
+    return AudioSegment
+
+
+def loudnorm_filter(target):
+    """Return the ffmpeg filter that normalizes audio to `target` LUFS (EBU R128)"""
+    return f"loudnorm=I={target}:TP={TRUE_PEAK}:LRA={LOUDNESS_RANGE}"
+
+
+def _parse_duration(stderr):
+    """Extract the final encoded duration (seconds) from ffmpeg -stats output"""
+    matches = re.findall(r'time=(\d+):(\d+):(\d+(?:\.\d+)?)', stderr)
+    if not matches:
+        return None
+    hours, minutes, seconds = matches[-1]
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def _run_ffmpeg(cmd, feed=None, stdout=None):
+    """Run ffmpeg, optionally feeding its stdin from `feed(stdin)`.
+
+    `stdout` is where ffmpeg's standard output goes (a file descriptor or
+    object; discarded by default).
+    Returns (returncode, stderr text, peak RSS of the ffmpeg process in KB or None).
+    """
+    # stderr goes to a temp file so a chatty ffmpeg can never block on a full pipe
+    with tempfile.TemporaryFile() as errlog:
+        try:
+            proc = subprocess.Popen(
+                cmd,
+                stdin=subprocess.PIPE if feed else subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL if stdout is None else stdout,
+                stderr=errlog
+            )
+        except OSError as e:
+            raise EngineError(f"Could not run ffmpeg: {str(e)}")
+
+        try:
+            if feed:
+                try:
+                    feed(proc.stdin)
+                except BrokenPipeError:
+                    pass  # encoder exited early; its return code explains why
+        finally:
+            if feed:
+                try:
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+            if hasattr(os, 'wait4'):
+                _, status, usage = os.wait4(proc.pid, 0)
+                proc.returncode = os.waitstatus_to_exitcode(status)
+                peak_rss_kb = usage.ru_maxrss
+            else:
+                proc.wait()
+                peak_rss_kb = None
+
+        errlog.seek(0)
+        stderr = errlog.read().decode('utf-8', errors='replace')
+
+    return proc.returncode, stderr, peak_rss_kb
+
+
+def _proc_status_kb(field):
+    """Return a memory field (e.g. VmRSS) of /proc/self/status in KB, or None off Linux"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class ProcessRSS:
+    """Measure this process's resident memory over one run (a `with` block).
+
+    Queue workers live through many jobs, so the lifetime peak of getrusage()
+    says little about a single job. On entry the RSS is recorded
+    ('start_kb') and the kernel's high-water mark (VmHWM) is reset through
+    /proc/self/clear_refs; on exit 'peak_kb' is that mark. When another
+    measurement is already running in the process (CLI batches run jobs side
+    by side) or the reset is refused, a thread samples VmRSS every
+    `interval` seconds instead. Without /proc (not Linux) both stay None.
+    """
+
+    _lock = threading.Lock()
+    _running = 0  # measurements in progress in this process
+
+    def __init__(self, interval=0.1):
+        self.interval = interval
+        self.start_kb = None
+        self.peak_kb = None
+        self._exact = False
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def __enter__(self):
+        self.start_kb = self.peak_kb = _proc_status_kb('VmRSS')
+        if self.start_kb is None:
+            return self
+        with ProcessRSS._lock:
+            ProcessRSS._running += 1
+            self._exact = ProcessRSS._running == 1 and self._reset_peak()
+        if not self._exact:
+            self._sampler = threading.Thread(target=self._sample, name="rss-sampler", daemon=True)
+            self._sampler.start()
+        return self
+
+    @staticmethod
+    def _reset_peak():
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')  # resets VmHWM to the current RSS
+            return True
+        except OSError:
+            return False
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self._record(_proc_status_kb('VmRSS'))
+
+    def _record(self, kb):
+        if kb is not None and kb > self.peak_kb:
+            self.peak_kb = kb
+
+    def __exit__(self, *exc_info):
+        if self.start_kb is None:
+            return False
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+        # No other measurement resets the mark while this one is running
+        self._record(_proc_status_kb('VmHWM' if self._exact else 'VmRSS'))
+        with ProcessRSS._lock:
+            ProcessRSS._running -= 1
+        return False
+
+
+def probe_duration(path):
+    """Return the playable audio duration (seconds) of a possibly truncated file.
+
+    Remuxes the audio stream to the null muxer without decoding it, so this is
+    cheap even for long files. Returns None if ffmpeg cannot read the file.
+    """
+    cmd = [get_ffmpeg(), '-hide_banner', '-nostdin', '-loglevel', 'error', '-stats',
+           '-i', path, '-map', '0:a:0', '-c', 'copy', '-f', 'null', '-']
+    returncode, stderr, _ = _run_ffmpeg(cmd)
+    if returncode != 0:
+        return None
+    return _parse_duration(stderr)
+
+
+def extract_clip(input_file, output_file, duration, start=0):
+    """Copy `duration` seconds of the audio stream into a Matroska file without re-encoding"""
+    cmd = [get_ffmpeg(), '-hide_banner', '-nostdin', '-y', '-loglevel', 'error',
+           '-ss', str(start), '-t', str(duration), '-i', input_file,
+           '-map', '0:a:0', '-c', 'copy', '-f', 'matroska', output_file]
+    returncode, stderr, _ = _run_ffmpeg(cmd)
+    if returncode != 0:
+        raise EngineError(f"ffmpeg exited with code {returncode}: {stderr.strip()[-500:]}")
+    return output_file
+
+
+def decode_segment(input_file, output_file, duration=None, start=0, loudness=None):
+    """Decode (up to `duration` seconds of) input_file into raw PCM in the common format.
+
+    The output is headerless s16le at SAMPLE_RATE, stereo, ready to be fed to
+    an encoder built by build_pcm_encoder_command. With `loudness` the clip
+    is normalized to that many LUFS in the same ffmpeg run. Returns the
+    decoded duration in seconds (None if ffmpeg did not report it).
+    Raises EngineError if ffmpeg fails.
+    """
+    cmd = [get_ffmpeg(), '-hide_banner', '-nostdin', '-y', '-loglevel', 'error', '-stats']
+    if start:
+        cmd += ['-ss', str(start)]
+    if duration:
+        cmd += ['-t', str(duration)]
+    cmd += ['-i', input_file, '-map', '0:a:0', '-vn']
+    if loudness is not None:
+        cmd += ['-af', loudnorm_filter(loudness)]
+    cmd += ['-ar', str(SAMPLE_RATE), '-ac', '2', '-c:a', 'pcm_s16le', '-f', 's16le', output_file]
+    returncode, stderr, _ = _run_ffmpeg(cmd)
+    if returncode != 0:
+        raise EngineError(f"ffmpeg exited with code {returncode}: {stderr.strip()[-500:]}")
+    return _parse_duration(stderr)
+
+
+def build_pcm_encoder_command(output_file, codec='aac', bitrate='192k', output_format='mp4',
+                              channels=None):
+    """Build an ffmpeg command that encodes s16le stereo PCM read from stdin.
+
+    With `channels` (e.g. 1) the output is downmixed. An output_file of
+    'pipe:1' writes to stdout, flushing every packet so it can be streamed;
+    an MP3 stream then starts with the first audio frame, not a tag header.
+    """
+    cmd = [
+        get_ffmpeg(), '-hide_banner', '-nostdin', '-y', '-loglevel', 'error',
+        '-f', 's16le', '-ar', str(SAMPLE_RATE), '-ac', '2', '-i', 'pipe:0',
+        '-c:a', codec,
+        '-b:a', bitrate,
+    ]
+    if channels:
+        cmd += ['-ac', str(channels)]
+    if output_file == 'pipe:1':
+        cmd += ['-flush_packets', '1']
+        if output_format == 'mp3':
+            cmd += ['-id3v2_version', '0', '-write_xing', '0']
+    return cmd + ['-f', output_format, output_file]
+
+
+def encode_pcm(feed, output_file, codec='aac', bitrate='192k', output_format='mp4',
+               channels=None, stdout=None):
+    """Run one encoder over the PCM that `feed(stdin)` writes.
+
+    With output_file='pipe:1' the encoded audio is written to `stdout` (a
+    file descriptor or object) as it is produced.
+    Returns the encoder's peak RSS in KB (None where unavailable).
+    Raises EngineError if ffmpeg is missing or fails.
+    """
+    cmd = build_pcm_encoder_command(output_file, codec=codec, bitrate=bitrate,
+                                    output_format=output_format, channels=channels)
+    returncode, stderr, peak_rss_kb = _run_ffmpeg(cmd, feed, stdout=stdout)
+    if returncode != 0:
+        raise EngineError(f"ffmpeg exited with code {returncode}: {stderr.strip()[-500:]}")
+    return peak_rss_kb
+
+
+class PCMCrossfader:
+    """Write consecutive PCM segments to a stream, overlapping each join.
+
+    Only the last `seconds` of the previous segment are held back and mixed
+    (equal-power curves) with the start of the next one, so every byte is
+    copied once and memory stays bounded by the crossfade length. With
+    seconds=0 segments are simply concatenated.
+    """
+
+    def __init__(self, out, seconds=0):
+        self.out = out
+        self.fade_bytes = int(seconds * SAMPLE_RATE) * FRAME_BYTES
+        self.tail = b''
+        self.bytes_written = 0
+
+    def _write(self, data):
+        if data:
+            self.out.write(data)
+            self.bytes_written += len(data)
+
+    def add(self, source, size):
+        """Append a segment of `size` bytes read from the file object `source`"""
+        # A fade may take at most half of a (short) segment
+        fade = min(self.fade_bytes, size // 2 // FRAME_BYTES * FRAME_BYTES)
+        head = source.read(fade)
+        overlap = min(len(self.tail), len(head))
+        self._write(self.tail[:len(self.tail) - overlap])
+        if overlap:
+            self._write(_crossfade(self.tail[len(self.tail) - overlap:], head[:overlap]))
+        self._write(head[overlap:])
+
+        remaining = size - 2 * fade
+        while remaining > 0:
+            chunk = source.read(min(COPY_CHUNK, remaining))
+            if not chunk:
+                break
+            self._write(chunk)
+            remaining -= len(chunk)
+        self.tail = source.read(fade)
+
+    def close(self):
+        """Write the held-back end of the last segment"""
+        self._write(self.tail)
+        self.tail = b''
+
+
+def _crossfade(outgoing, incoming):
+    """Mix two equally long s16le stereo buffers with equal-power fades"""
+    import numpy as np
+    a = np.frombuffer(outgoing, dtype='<i2').reshape(-1, 2).astype(np.float32)
+    b = np.frombuffer(incoming, dtype='<i2').reshape(-1, 2).astype(np.float32)
+    t = ((np.arange(len(a), dtype=np.float32) + 0.5) / len(a))[:, None] * (math.pi / 2)
+    mixed = a * np.cos(t) + b * np.sin(t)
+    return np.clip(np.rint(mixed), -32768, 32767).astype('<i2').tobytes()
+
+
+def normalize_pcm(data, loudness, converter=None):
+    """Normalize s16le stereo PCM to `loudness` LUFS with ffmpeg's loudnorm filter"""
+    cmd = [converter or get_ffmpeg(), '-hide_banner', '-nostdin', '-loglevel', 'error',
+           '-f', 's16le', '-ar', str(SAMPLE_RATE), '-ac', '2', '-i', 'pipe:0',
+           '-af', loudnorm_filter(loudness),
+           '-ar', str(SAMPLE_RATE), '-ac', '2', '-c:a', 'pcm_s16le', '-f', 's16le', 'pipe:1']
+    try:
+        proc = subprocess.run(cmd, input=data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise EngineError(f"Could not run ffmpeg: {str(e)}")
+    if proc.returncode != 0:
+        raise EngineError(f"ffmpeg exited with code {proc.returncode}: "
+                          f"{proc.stderr.decode('utf-8', errors='replace').strip()[-500:]}")
+    return proc.stdout
+
+
+def run_parallel(func, arg_list, jobs=1):
+    """Call func(*args) for every args tuple, up to `jobs` calls at a time.
+
+    Yields (index, result, error) in input order as results become
+    available; error is the exception a call raised (result is then None).
+    Calls run in spawned worker processes, so `func` must be a module-level
+    function. jobs=1 runs them in this process. Daemonic processes (job queue
+    workers) may not start children, so there the calls run in threads; the
+    pydub work still runs in parallel because pydub decodes with ffmpeg
+    subprocesses.
+    """
+    if jobs <= 1 or len(arg_list) <= 1:
+        for i, args in enumerate(arg_list):
+            try:
+                yield i, func(*args), None
+            except Exception as e:
+                yield i, None, e
+        return
+
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+    if multiprocessing.current_process().daemon:
+        executor = ThreadPoolExecutor(max_workers=jobs)
+    else:
+        executor = ProcessPoolExecutor(max_workers=jobs,
+                                       mp_context=multiprocessing.get_context('spawn'))
+    with executor:
+        # Submit a bounded window ahead so results never pile up in memory
+        pending = deque()
+        submitted = 0
+        for i in range(len(arg_list)):
+            while submitted < len(arg_list) and len(pending) < 2 * jobs:
+                pending.append(executor.submit(func, *arg_list[submitted]))
+                submitted += 1
+            try:
+                yield i, pending.popleft().result(), None
+            except Exception as e:
+                yield i, None, e
+
+
+def decode_pcm(path, duration=None, start=0, converter=None, loudness=None):
+    """Decode (a trimmed part of) a file with pydub into PCM in the common format.
+
+    Returns the raw s16le stereo bytes, normalized to `loudness` LUFS if
+    given. `converter` is the ffmpeg binary to use, so worker processes do not
+    have to discover it again.
+    """
+    AudioSegment = load_pydub(converter)
+    segment = AudioSegment.from_file(path, start_second=start or None, duration=duration)
+    data = segment.set_frame_rate(SAMPLE_RATE).set_channels(2).set_sample_width(2).raw_data
+    if loudness is not None:
+        data = normalize_pcm(data, loudness, converter)
+    return data
+
+
+def transcode(input_file, output_file, duration=None, codec='aac', output_format='mp4',
+              converter=None):
+    """Decode (the first `duration` seconds of) a file with pydub and export it"""
+    AudioSegment = load_pydub(converter)
+    audio = AudioSegment.from_file(input_file, duration=duration)
+    if duration:
+        audio = audio[:duration * 1000]
+    audio.export(output_file, format=output_format, codec=codec)
+    return output_file
+
+
+def stream_concat(input_files, output_file, duration=None, start=0,
+                  codec='aac', bitrate='192k', output_format='mp4', jobs=1,
+                  loudness=LOUDNESS_TARGET, crossfade=CROSSFADE_SECONDS, log=print):
+    """Decode inputs with pydub and stream their PCM into one encoder, in order.
+
+    Up to `jobs` files are decoded at once (see run_parallel), and only a
+    bounded window of decoded segments is held in memory, so peak memory does
+    not grow with the length of the mashup. Each segment can be normalized to
+    `loudness` LUFS, and joins crossfaded over `crossfade` seconds, in the
+    same pass. Files that fail to decode are skipped. Returns a stats dict with the output 'duration', the number of
+    'segments' merged, the largest PCM buffer held ('peak_segment_bytes'),
+    the 'encoder_peak_rss_kb' of ffmpeg, and the RSS of this process, which
+    holds the decoded segments, when the merge started and at its peak
+    ('process_start_rss_kb', 'process_peak_rss_kb'; see ProcessRSS).
+    """
+    cmd = build_pcm_encoder_command(output_file, codec=codec, bitrate=bitrate,
+                                    output_format=output_format)
+    stats = {'duration': 0.0, 'segments': 0, 'peak_segment_bytes': 0,
+             'encoder_peak_rss_kb': None, 'process_start_rss_kb': None, 'process_peak_rss_kb': None}
+    converter = get_ffmpeg()
+
+    def feed(stdin):
+        writer = PCMCrossfader(stdin, crossfade)
+        arg_list = [(path, duration, start, converter, loudness) for path in input_files]
+        for i, data, error in run_parallel(decode_pcm, arg_list, jobs):
+            if error is not None:
+                log(f"Error processing audio {i+1}: {str(error)}")
+                continue
+
+            writer.add(io.BytesIO(data), len(data))
+            stats['segments'] += 1
+            stats['peak_segment_bytes'] = max(stats['peak_segment_bytes'], len(data))
+            log(f"Merged file {i+1}/{len(input_files)}")
+            del data
+        writer.close()
+        stats['duration'] = writer.bytes_written / (SAMPLE_RATE * FRAME_BYTES)
+
+    with ProcessRSS() as rss:
+        returncode, stderr, peak_rss_kb = _run_ffmpeg(cmd, feed)
+    if stats['segments'] == 0:
+        raise EngineError("No audio segments could be decoded")
+    if returncode != 0:
+        raise EngineError(f"ffmpeg exited with code {returncode}: {stderr.strip()[-500:]}")
+
+    stats['encoder_peak_rss_kb'] = peak_rss_kb
+    stats['process_start_rss_kb'] = rss.start_kb
+    stats['process_peak_rss_kb'] = rss.peak_kb
+    return stats
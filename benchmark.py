@@ -0,0 +1,434 @@
+#!/usr/bin/env python3
+"""
+Benchmark harness for the mashup pipeline.
+
+Generates synthetic audio fixtures with ffmpeg (sine and noise tracks of
+varying length and codec), replaces pytubefix.Search with a local fake that
+serves them with configurable latency, and times each processing stage over
+a grid of track counts and clip durations. Every run happens in a fresh
+process so peak RSS is measured per run. The startup_cli and startup_app
+stages instead time a fresh interpreter importing the command-line tool or
+the web app (the cost every CLI run and gunicorn worker boot pays). Results are written as JSON; pass
+--compare to print the change against an earlier run.
+
+Usage: python benchmark.py [--stages download,pipeline] [--tracks 11,20] [--durations 25,40]
+                           [--repeat 3] [--latency 0.2] [--search-latency 0.5]
+                           [--jobs N] [--output benchmark.json] [--compare old.json]
+"""
+
+import argparse
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+STAGES = ['search', 'download', 'convert', 'cut', 'merge', 'pipeline', 'create_mashup',
+          'startup_cli', 'startup_app']
+STARTUP_STAGES = {
+    # stage -> code run by a fresh interpreter
+    'startup_cli': "import importlib.util as u; s = u.spec_from_file_location('cli', '102303892.py'); "
+                   "s.loader.exec_module(u.module_from_spec(s))",
+    'startup_app': "import app",
+}
+DEFAULT_STAGES = ['search', 'download', 'pipeline', 'create_mashup']
+
+# Fixture variety: (signal, codec, container extension)
+FIXTURE_KINDS = [
+    ('sine', 'aac', 'm4a'),
+    ('noise', 'libopus', 'webm'),
+    ('sine', 'libmp3lame', 'mp3'),
+    ('noise', 'aac', 'm4a'),
+]
+FIXTURE_BITRATE = '128k'
+
+
+# ---------------------------------------------------------------------------
+# Fixtures and the fake YouTube search
+# ---------------------------------------------------------------------------
+
+def fixture_length(i, max_duration):
+    """Length in seconds of fixture i: always longer than the longest clip (and
+    than the shortest track the track filter accepts), and varied"""
+    from track_filter import MIN_TRACK_SECONDS
+    return int(max(max_duration + 20, MIN_TRACK_SECONDS + 1)) + (i * 13) % 60
+
+
+def generate_fixtures(fixture_dir, count, max_duration, ffmpeg='ffmpeg'):
+    """Create (or reuse) `count` synthetic tracks; returns [{'path', 'length'}]"""
+    os.makedirs(fixture_dir, exist_ok=True)
+    fixtures = []
+    for i in range(count):
+        signal, codec, ext = FIXTURE_KINDS[i % len(FIXTURE_KINDS)]
+        length = fixture_length(i, max_duration)
+        path = os.path.join(fixture_dir, f"track_{i}_{signal}_{length}s.{ext}")
+        if not os.path.exists(path):
+            if signal == 'sine':
+                source = f"sine=frequency={220 + 55 * i}:sample_rate=44100:duration={length}"
+            else:
+                source = f"anoisesrc=color=pink:sample_rate=44100:amplitude=0.3:duration={length}"
+            partial = path + '.part'
+            subprocess.run(
+                [ffmpeg, '-hide_banner', '-nostdin', '-y', '-loglevel', 'error',
+                 '-f', 'lavfi', '-i', source, '-ac', '2',
+                 '-c:a', codec, '-b:a', FIXTURE_BITRATE, '-f', _muxer(ext), partial],
+                check=True
+            )
+            os.replace(partial, path)
+        fixtures.append({'path': path, 'length': length})
+    return fixtures
+
+
+def _muxer(ext):
+    return {'m4a': 'mp4', 'webm': 'webm', 'mp3': 'mp3'}[ext]
+
+
+class FakeStream:
+    """Audio stream that 'downloads' a fixture after a delay"""
+
+    def __init__(self, fixture, latency):
+        self.fixture = fixture
+        self.latency = latency
+        self.url = None  # no URL: the downloader uses download(), not range fetches
+        self.filesize = os.path.getsize(fixture)
+        self.mime_type = 'audio/mp4'
+        self.bitrate = 128000
+
+    def download(self, output_path, filename):
+        time.sleep(self.latency)
+        path = os.path.join(output_path, filename)
+        shutil.copyfile(self.fixture, path)
+        return path
+
+
+class FakeStreamQuery:
+    def __init__(self, stream):
+        self._stream = stream
+
+    def filter(self, **kwargs):
+        return self
+
+    def first(self):
+        return self._stream
+
+
+class FakeVideo:
+    """Stand-in for a pytubefix YouTube object"""
+
+    def __init__(self, i, fixture, latency):
+        self.video_id = f"bench{i:04d}"
+        self.title = f"Benchmark Track {i + 1}"
+        self.length = fixture['length']
+        self.streams = FakeStreamQuery(FakeStream(fixture['path'], latency))
+
+
+def install_fake_search(fixtures, latency, search_latency):
+    """Replace pytubefix.Search (and YouTube) with fakes serving the fixtures"""
+
+    class FakeSearch:
+        def __init__(self, query):
+            time.sleep(search_latency)
+            self.query = query
+            self.results = [FakeVideo(i, fixture, latency) for i, fixture in enumerate(fixtures)]
+
+    def fake_youtube(url):
+        # Results another process cached by video id (see search_cache)
+        i = int(url.rsplit('bench', 1)[1])
+        return FakeVideo(i, fixtures[i], latency)
+
+    try:
+        import pytubefix
+    except ImportError:
+        pytubefix = types.ModuleType('pytubefix')
+        sys.modules['pytubefix'] = pytubefix
+    pytubefix.Search = FakeSearch
+    pytubefix.YouTube = fake_youtube
+    return FakeSearch
+
+
+# ---------------------------------------------------------------------------
+# Stages (each runs in its own process; only the returned work is timed)
+# ---------------------------------------------------------------------------
+
+def _load_cli():
+    spec = importlib.util.spec_from_file_location('mashup_cli', os.path.join(REPO_DIR, '102303892.py'))
+    cli = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(cli)
+    return cli
+
+
+def _download(videos, work_dir, duration):
+    from downloader import download_all
+    return [path for path in download_all(videos, work_dir, duration=duration, cache=False,
+                                          log=lambda msg: None) if path]
+
+
+def prepare_stage(stage, params, work_dir):
+    """Do a stage's untimed setup and return the callable to time"""
+    if stage in STARTUP_STAGES:
+        return _prepare_startup(stage, work_dir)
+
+    import search_cache
+    fixtures = params['fixtures'][:params['tracks']]
+    install_fake_search(fixtures, params['latency'], params['search_latency'])
+    duration = params['duration']
+    jobs = params['jobs']
+    output_file = os.path.join(work_dir, 'mashup.mp4')
+
+    if stage == 'search':
+        return lambda: search_cache.search('benchmark artist')
+
+    videos = search_cache.search('benchmark artist')
+    if stage == 'download':
+        return lambda: _download(videos, work_dir, duration)
+    if stage == 'pipeline':
+        from pipeline import MashupPipeline
+        return lambda: MashupPipeline(videos, work_dir, duration, decode_workers=jobs,
+                                      log=lambda msg: None).run(output_file)
+    if stage == 'create_mashup':
+        return _prepare_create_mashup(params, work_dir)
+
+    files = _download(videos, work_dir, duration)
+    cli = _load_cli()
+    if stage == 'convert':
+        return lambda: cli.convert_to_audio(files, jobs)
+    audio_files = cli.convert_to_audio(files, jobs)
+    if stage == 'cut':
+        return lambda: cli.cut_audio(audio_files, duration, jobs)
+    cut_files = cli.cut_audio(audio_files, duration, jobs)
+    if stage == 'merge':
+        return lambda: cli.merge_audio(cut_files, output_file, jobs)
+    raise ValueError(f"Unknown stage: {stage}")
+
+
+def _prepare_create_mashup(params, work_dir):
+    """Import the web app in an isolated work dir (no queue workers, mail only queued)"""
+    os.environ.update({
+        'MASHUP_QUEUE_WORKERS': '0',
+        'MASHUP_MAIL_WORKERS': '0',
+        'MASHUP_QUEUE_DB': os.path.join(work_dir, 'jobs.db'),
+        'SENDER_EMAIL': 'benchmark@example.com',
+        'SENDER_PASSWORD': 'benchmark',
+    })
+    os.chdir(work_dir)
+    import app
+    task_id = 'benchmark'
+    return lambda: app.create_mashup('benchmark artist', params['tracks'], params['duration'],
+                                     'listener@example.com', task_id)
+
+
+def _prepare_startup(stage, work_dir):
+    """Time a fresh interpreter importing the CLI or app from a scratch directory"""
+    env = dict(os.environ, PYTHONPATH=REPO_DIR, MASHUP_QUEUE_DB=os.path.join(work_dir, 'jobs.db'),
+               MASHUP_QUEUE_WORKERS='0', MASHUP_MAIL_WORKERS='0')
+    code = STARTUP_STAGES[stage]
+    if stage == 'startup_cli':
+        code = code.replace("'102303892.py'", repr(os.path.join(REPO_DIR, '102303892.py')))
+    return lambda: subprocess.run([sys.executable, '-c', code], cwd=work_dir, env=env, check=True,
+                                  stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _peak_rss_kb(who):
+    if resource is None:
+        return None
+    usage = resource.getrusage(who)
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    return usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+
+
+def _run_stage(stage, params, result_queue):
+    """Child process body: set up, time one run of the stage, report back"""
+    sys.path.insert(0, REPO_DIR)
+    os.environ['MASHUP_CACHE'] = '0'  # every run must do the real work
+    work_dir = tempfile.mkdtemp(prefix=f"mashup_bench_{stage}_")
+    try:
+        # Quiet the stage's own progress output
+        sys.stdout = open(os.devnull, 'w')
+        work = prepare_stage(stage, params, work_dir)
+        started = time.perf_counter()
+        work()
+        elapsed = time.perf_counter() - started
+        result_queue.put({
+            'seconds': elapsed,
+            'peak_rss_kb': _peak_rss_kb(resource.RUSAGE_SELF) if resource else None,
+            'peak_child_rss_kb': _peak_rss_kb(resource.RUSAGE_CHILDREN) if resource else None,
+        })
+    except BaseException as e:
+        result_queue.put({'error': f"{type(e).__name__}: {str(e)}"})
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_once(stage, params, timeout):
+    """Run one timed measurement in a fresh process and return its result dict"""
+    ctx = multiprocessing.get_context('spawn')
+    result_queue = ctx.Queue()
+    proc = ctx.Process(target=_run_stage, args=(stage, params, result_queue))
+    proc.start()
+    try:
+        result = result_queue.get(timeout=timeout)
+    except Exception:
+        proc.terminate()
+        result = {'error': f"Timed out after {timeout}s"}
+    proc.join()
+    return result
+
+
+# ---------------------------------------------------------------------------
+# Statistics and reporting
+# ---------------------------------------------------------------------------
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    rank = max(1, -(-pct * len(ordered) // 100))
+    return ordered[int(rank) - 1]
+
+
+def summarize(stage, tracks, duration, runs):
+    """Aggregate the runs of one benchmark case"""
+    times = [run['seconds'] for run in runs if 'seconds' in run]
+    summary = {
+        'stage': stage,
+        'tracks': tracks,
+        'duration': duration,
+        'runs': len(runs),
+        'errors': [run['error'] for run in runs if 'error' in run],
+        'seconds': [round(t, 4) for t in times],
+    }
+    if times:
+        p50 = percentile(times, 50)
+        summary.update({
+            'p50_seconds': round(p50, 4),
+            'p95_seconds': round(percentile(times, 95), 4),
+            'mean_seconds': round(sum(times) / len(times), 4),
+            'tracks_per_second': round(tracks / p50, 3) if p50 else None,
+            'audio_seconds_per_second': round(tracks * duration / p50, 2) if p50 else None,
+            'peak_rss_kb': max((run.get('peak_rss_kb') or 0) for run in runs),
+            'peak_child_rss_kb': max((run.get('peak_child_rss_kb') or 0) for run in runs),
+        })
+    return summary
+
+
+def compare(results, baseline_file):
+    """Print the p50 change of each case against a previous results file"""
+    with open(baseline_file) as f:
+        baseline = {
+            (case['stage'], case['tracks'], case['duration']): case
+            for case in json.load(f)['results']
+        }
+    print(f"\nComparison with {baseline_file} (p50, negative is faster):")
+    for case in results:
+        old = baseline.get((case['stage'], case['tracks'], case['duration']))
+        if not old or 'p50_seconds' not in old or 'p50_seconds' not in case:
+            continue
+        change = (case['p50_seconds'] - old['p50_seconds']) / old['p50_seconds'] * 100
+        label = '' if case['stage'] in STARTUP_STAGES else f" {case['tracks']:>3} tracks x {case['duration']}s"
+        print(f"  {case['stage']:<16}{label}: "
+              f"{old['p50_seconds']:.3f}s -> {case['p50_seconds']:.3f}s ({change:+.1f}%)")
+
+
+def _int_list(text):
+    return [int(value) for value in text.split(',') if value]
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description="Benchmark the mashup pipeline on synthetic audio")
+    parser.add_argument('--stages', default=','.join(DEFAULT_STAGES),
+                        help=f"comma-separated stages ({', '.join(STAGES)}, or 'all')")
+    parser.add_argument('--tracks', type=_int_list, default=[11, 20], help="track counts, e.g. 11,20")
+    parser.add_argument('--durations', type=_int_list, default=[25], help="clip durations in seconds")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per case")
+    parser.add_argument('--latency', type=float, default=0.2, help="fake download latency (s)")
+    parser.add_argument('--search-latency', type=float, default=0.5, help="fake search latency (s)")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1, help="parallel decoders")
+    parser.add_argument('--fixtures', default=os.path.join(tempfile.gettempdir(), 'mashup_bench_fixtures'),
+                        help="directory for generated fixtures (reused between runs)")
+    parser.add_argument('--timeout', type=float, default=600, help="seconds allowed per run")
+    parser.add_argument('--output', default='benchmark.json', help="results file")
+    parser.add_argument('--compare', help="previous results file to compare against")
+    args = parser.parse_args(argv)
+
+    args.stages = STAGES if args.stages == 'all' else args.stages.split(',')
+    unknown = set(args.stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    sys.path.insert(0, REPO_DIR)
+    from audio_engine import get_ffmpeg
+    ffmpeg = get_ffmpeg()
+
+    print(f"Generating fixtures in {args.fixtures}...")
+    fixtures = generate_fixtures(args.fixtures, max(args.tracks), max(args.durations), ffmpeg)
+    ffmpeg_version = subprocess.run([ffmpeg, '-version'], capture_output=True,
+                                    text=True).stdout.split('\n')[0]
+
+    results = []
+    for stage in args.stages:
+        # Startup does not depend on the track grid, so it is measured once
+        grid = [(0, 0)] if stage in STARTUP_STAGES else \
+            [(tracks, duration) for tracks in args.tracks for duration in args.durations]
+        for tracks, duration in grid:
+            params = {
+                'fixtures': fixtures,
+                'tracks': tracks,
+                'duration': duration,
+                'latency': args.latency,
+                'search_latency': args.search_latency,
+                'jobs': args.jobs,
+            }
+            runs = [run_once(stage, params, args.timeout) for _ in range(args.repeat)]
+            case = summarize(stage, tracks, duration, runs)
+            results.append(case)
+            if stage in STARTUP_STAGES:
+                label = f"{stage:<16}"
+                detail = f"interpreter peak RSS {case.get('peak_child_rss_kb')} KB"
+            else:
+                label = f"{stage:<16} {tracks:>3} tracks x {duration}s"
+                detail = (f"{case.get('audio_seconds_per_second')} audio-s/s  "
+                          f"peak RSS {case.get('peak_rss_kb')} KB (ffmpeg {case.get('peak_child_rss_kb')} KB)")
+            if 'p50_seconds' in case:
+                print(f"{label}: p50 {case['p50_seconds']:.3f}s  p95 {case['p95_seconds']:.3f}s  {detail}")
+            else:
+                print(f"{label}: failed - {case['errors'][0]}")
+
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'ffmpeg': ffmpeg_version,
+            'latency': args.latency,
+            'search_latency': args.search_latency,
+            'jobs': args.jobs,
+            'repeat': args.repeat,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
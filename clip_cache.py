@@ -0,0 +1,233 @@
+"""
+Persistent on-disk cache of downloaded audio, shared by the web app workers
+and the command-line tool.
+
+Two kinds of entries are kept, each addressed by a hash of its key:
+- raw audio, keyed by video id (only complete downloads are stored)
+- trimmed clips, keyed by (video id, duration, codec, start)
+
+Writes are atomic (temp file + rename) and serialised across processes with a
+file lock; the total size is capped with least-recently-used eviction, where
+each hit refreshes the entry's modification time. Other modules keeping
+derived data in the cache directory put their folders under the same cap
+with add_folder().
+
+Hits, misses, stores and evictions are counted in this process (stats())
+and, once telemetry is recording, in mashup_clip_cache_total.
+"""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+import telemetry
+
+try:
+    import fcntl
+except ImportError:  # Windows: fall back to in-process locking only
+    fcntl = None
+
+# Cache configuration (override with environment variables)
+CACHE_ENABLED = os.environ.get("MASHUP_CACHE", "1") == "1"
+CACHE_DIR = os.environ.get(
+    "MASHUP_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "mashup")
+)
+CACHE_MAX_BYTES = int(float(os.environ.get("MASHUP_CACHE_MAX_MB", "2048")) * 1024 * 1024)
+
+# Clips are stream-copied from the source, so they keep the source codec
+CLIP_CODEC = "copy"
+
+_thread_lock = threading.Lock()
+_counters_lock = threading.Lock()
+_counters = {f"{kind}_{result}": 0 for kind in ('raw', 'clip') for result in ('hit', 'miss', 'store', 'evict')}
+
+# kind -> folder under CACHE_DIR, evicted together
+_folders = {'raw': 'raw', 'clip': 'clips'}
+
+
+def add_folder(kind, name):
+    """Put the files another module keeps in CACHE_DIR/name under the size cap
+    (evicted as `kind`, next time an entry is stored) and return the folder.
+
+    They must be written atomically with a ".tmp-" prefix while incomplete,
+    and have their modification time refreshed when used.
+    """
+    _folders[kind] = name
+    return os.path.join(CACHE_DIR, name)
+
+
+def _count(kind, result):
+    with _counters_lock:
+        name = f"{kind}_{result}"
+        _counters[name] = _counters.get(name, 0) + 1
+    telemetry.inc('mashup_clip_cache_total', kind=kind, result=result)
+
+
+def _kind(key):
+    return 'raw' if key.startswith('raw/') else 'clip'
+
+
+def stats():
+    """Return a copy of this process's cache hit/miss counters"""
+    with _counters_lock:
+        return dict(_counters)
+
+
+def raw_key(video_id):
+    """Cache key for the full audio of a video"""
+    return "raw/" + hashlib.sha1(video_id.encode('utf-8')).hexdigest()
+
+
+def clip_key(video_id, duration, codec=CLIP_CODEC, start=0):
+    """Cache key for `duration` seconds of a video from `start` in `codec`"""
+    key = f"{video_id}|{duration}|{codec}" + (f"|{start}" if start else "")
+    digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return "clips/" + digest
+
+
+def _entry_path(key):
+    return os.path.join(CACHE_DIR, key)
+
+
+class _CacheLock:
+    """Exclusive lock shared by all threads and processes using the cache"""
+
+    def __enter__(self):
+        _thread_lock.acquire()
+        self._file = None
+        try:
+            if fcntl:
+                os.makedirs(CACHE_DIR, exist_ok=True)
+                self._file = open(os.path.join(CACHE_DIR, ".lock"), 'a')
+                fcntl.flock(self._file, fcntl.LOCK_EX)
+        except Exception:
+            _thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            if self._file:
+                fcntl.flock(self._file, fcntl.LOCK_UN)
+                self._file.close()
+        finally:
+            _thread_lock.release()
+
+
+def lookup(key, dest):
+    """Copy (hard-link when possible) a cached entry to dest.
+
+    Returns dest on a hit, or None on a miss.
+    """
+    kind = _kind(key)
+    path = _entry_path(key)
+    try:
+        os.utime(path)  # mark as recently used
+        if os.path.exists(dest):
+            os.remove(dest)
+        try:
+            os.link(path, dest)
+        except OSError:
+            shutil.copyfile(path, dest)
+    except FileNotFoundError:
+        # Missing, or evicted by another worker between the two calls
+        _count(kind, 'miss')
+        return None
+    _count(kind, 'hit')
+    return dest
+
+
+def store(key, src_path):
+    """Atomically add a file to the cache under key, then enforce the size cap"""
+    path = _entry_path(key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, 'wb') as out, open(src_path, 'rb') as src:
+            shutil.copyfileobj(src, out)
+        with _CacheLock():
+            os.replace(tmp_path, path)
+            _count(_kind(key), 'store')
+            evict()
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return path
+
+
+def evict(max_bytes=None):
+    """Remove least-recently-used entries until the cache fits in max_bytes.
+
+    store() calls this with the cache lock held. Returns the remaining size.
+    """
+    max_bytes = CACHE_MAX_BYTES if max_bytes is None else max_bytes
+    entries = []
+    total = 0
+    for kind, name in list(_folders.items()):
+        folder = os.path.join(CACHE_DIR, name)
+        if not os.path.isdir(folder):
+            continue
+        for name in os.listdir(folder):
+            if name.startswith('.tmp-'):
+                continue
+            path = os.path.join(folder, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path, kind))
+            total += st.st_size
+
+    entries.sort()
+    for _, size, path, kind in entries:
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+            _count(kind, 'evict')
+        except FileNotFoundError:
+            pass
+    return total
+
+
+def fetch_cached(video_id, duration, dest, start=0):
+    """Materialise the cached clip for a video at dest, cutting it from cached
+    raw audio if only that is available. Returns dest, or None on a miss.
+    """
+    if lookup(clip_key(video_id, duration, start=start), dest):
+        return dest
+
+    raw_path = dest + ".raw"
+    if not lookup(raw_key(video_id), raw_path):
+        return None
+    try:
+        return save_clip(video_id, duration, raw_path, dest, start=start)
+    finally:
+        if os.path.exists(raw_path):
+            os.remove(raw_path)
+
+
+def save_clip(video_id, duration, src_path, dest, start=0):
+    """Cut `duration` seconds of src_path (from `start`) into dest and cache it as a clip.
+
+    The cut is a stream copy (no decode). If it fails, src_path itself is used
+    as the clip. Returns dest.
+    """
+    from audio_engine import extract_clip, EngineError
+
+    # Never write through a hard link into an existing cache entry
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        extract_clip(src_path, dest, duration, start=start)
+    except EngineError:
+        if os.path.abspath(src_path) != os.path.abspath(dest):
+            shutil.copyfile(src_path, dest)
+    store(clip_key(video_id, duration, start=start), dest)
+    return dest
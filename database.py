@@ -0,0 +1,57 @@
+"""
+The SQLite database shared by the web processes, the queue workers and the
+mail senders (normally the job database, MASHUP_QUEUE_DB).
+
+Every module that keeps state there registers a function creating its tables
+with @schema; one configure() call points all of them at the database and
+creates the tables. Modules that are optional outside the web app (metrics,
+the shared search cache) stay off until then (see configured()).
+"""
+
+import os
+import sqlite3
+from contextlib import closing
+
+DEFAULT_PATH = os.environ.get("MASHUP_QUEUE_DB", "mashup_jobs.db")
+
+_path = None
+_schemas = []
+
+
+def schema(create):
+    """Register create(conn), which creates a module's tables if missing
+    (and migrates older ones); use as a decorator"""
+    _schemas.append(create)
+    if _path is not None:
+        with closing(connect()) as conn:
+            create(conn)
+    return create
+
+
+def configure(db_path):
+    """Use the database at db_path and create every registered table"""
+    global _path
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    _path = db_path
+    with closing(connect()) as conn:
+        for create in _schemas:
+            create(conn)
+
+
+def configured():
+    """True once configure() was called in this process"""
+    return _path is not None
+
+
+def path():
+    """Return the database file in use"""
+    return _path or DEFAULT_PATH
+
+
+def connect():
+    """Open an autocommit connection returning sqlite3.Row rows; use with
+    contextlib.closing()"""
+    conn = sqlite3.connect(path(), timeout=30, isolation_level=None)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    return conn
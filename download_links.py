@@ -0,0 +1,95 @@
+"""
+Signed, expiring download tokens for finished mashups.
+
+A token names a file in the results folder and carries its expiry time,
+signed with HMAC-SHA256. The signing secret comes from MASHUP_LINK_SECRET,
+or is generated once and stored next to the results so that every web and
+worker process on the host shares it.
+"""
+
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import time
+
+# Link configuration (override with environment variables)
+LINK_TTL = float(os.environ.get("MASHUP_LINK_TTL", str(24 * 3600)))  # seconds
+
+_secret = None
+
+
+class InvalidToken(Exception):
+    """Raised when a download token is malformed, forged or expired"""
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def load_secret(secret_file):
+    """Load the signing secret, creating secret_file on first use"""
+    global _secret
+    env_secret = os.environ.get("MASHUP_LINK_SECRET")
+    if env_secret:
+        _secret = env_secret.encode('utf-8')
+        return
+
+    os.makedirs(os.path.dirname(os.path.abspath(secret_file)), exist_ok=True)
+    try:
+        # O_EXCL makes creation atomic when several processes start together
+        fd = os.open(secret_file, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            f.write(secrets.token_hex(32))
+    except FileExistsError:
+        pass
+
+    for _ in range(50):
+        with open(secret_file) as f:
+            value = f.read().strip()
+        if value:
+            _secret = value.encode('utf-8')
+            return
+        time.sleep(0.1)  # another process is still writing it
+    raise RuntimeError(f"Download link secret in {secret_file} is empty")
+
+
+def _sign(payload):
+    if _secret is None:
+        raise RuntimeError("Download link secret not loaded; call load_secret() first")
+    return _b64encode(hmac.new(_secret, payload, hashlib.sha256).digest())
+
+
+def make_token(filename, ttl=None):
+    """Return a token granting download access to filename for ttl seconds"""
+    ttl = LINK_TTL if ttl is None else ttl
+    payload = f"{filename}:{int(time.time() + ttl)}".encode('utf-8')
+    return f"{_b64encode(payload)}.{_sign(payload)}"
+
+
+def verify_token(token):
+    """Return the filename a token grants access to.
+
+    Raises InvalidToken if the token is malformed, has a bad signature or
+    has expired.
+    """
+    try:
+        encoded, signature = token.split('.', 1)
+        payload = _b64decode(encoded)
+    except (ValueError, TypeError):
+        raise InvalidToken("Malformed download token")
+
+    if not hmac.compare_digest(signature, _sign(payload)):
+        raise InvalidToken("Invalid download token")
+
+    filename, _, expires = payload.decode('utf-8', errors='replace').rpartition(':')
+    if not expires.isdigit() or int(expires) < time.time():
+        raise InvalidToken("Download link has expired")
+    if not filename or os.path.basename(filename) != filename:
+        raise InvalidToken("Invalid download token")
+    return filename
@@ -0,0 +1,251 @@
+"""
+Parallel audio downloader shared by the web app and the command-line tool.
+Downloads several audio streams per job at once, under a process-wide cap
+shared by all jobs, and retries each video with exponential backoff.
+
+When the caller only needs the first `duration` seconds of each track, the
+range-fetch mode downloads just the bytes estimated to cover that much audio
+(from the stream's bitrate) and grows the range if the clip comes out short.
+
+In the "energy" segment mode (see segment_select) the whole stream is
+downloaded instead, and the clip is cut from its most energetic window.
+
+Downloads go through the shared clip cache (see clip_cache), so a video seen
+by an earlier job is served from disk without touching the network.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import clip_cache
+import segment_select
+from audio_engine import extract_clip, EngineError
+
+# Concurrency configuration (override with environment variables)
+DOWNLOAD_WORKERS = int(os.environ.get("MASHUP_DOWNLOAD_WORKERS", "4"))  # per job
+GLOBAL_DOWNLOAD_LIMIT = int(os.environ.get("MASHUP_GLOBAL_DOWNLOADS", "8"))  # per process
+DOWNLOAD_RETRIES = int(os.environ.get("MASHUP_DOWNLOAD_RETRIES", "2"))
+RETRY_BACKOFF = float(os.environ.get("MASHUP_RETRY_BACKOFF", "1.0"))  # seconds
+
+# Range-fetch configuration
+RANGE_FETCH = os.environ.get("MASHUP_RANGE_FETCH", "1") == "1"
+RANGE_MARGIN = float(os.environ.get("MASHUP_RANGE_MARGIN", "5"))  # extra seconds fetched
+RANGE_HEADER_BYTES = 64 * 1024  # allowance for container headers and index
+RANGE_MAX_GROWTH = 3  # times the range is doubled before fetching the rest
+DEFAULT_AUDIO_BITRATE = 160000  # bits/s, used when a stream reports none
+HTTP_TIMEOUT = 30
+CHUNK_SIZE = 64 * 1024
+
+# Shared by every job running in this process
+_global_slots = threading.BoundedSemaphore(GLOBAL_DOWNLOAD_LIMIT)
+
+
+def _fetch_range(url, path, start, end=None):
+    """Write bytes start..end (inclusive, None = to EOF) of url into path.
+
+    Appends when start > 0. Works whether or not the server honours the Range
+    header. Returns the number of bytes written.
+    """
+    import urllib.request  # only range fetches need it; keeps startup light
+    byte_range = f"bytes={start}-{end}" if end is not None else f"bytes={start}-"
+    req = urllib.request.Request(url, headers={'Range': byte_range, 'User-Agent': 'Mozilla/5.0'})
+    wanted = end - start + 1 if end is not None else None
+    written = 0
+
+    with urllib.request.urlopen(req, timeout=HTTP_TIMEOUT) as resp, \
+            open(path, 'ab' if start else 'wb') as f:
+        # A plain 200 means the server sent the whole file from byte 0
+        to_skip = start if resp.status != 206 else 0
+        while wanted is None or written < wanted:
+            chunk = resp.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if to_skip:
+                dropped = min(to_skip, len(chunk))
+                chunk = chunk[dropped:]
+                to_skip -= dropped
+            if wanted is not None:
+                chunk = chunk[:wanted - written]
+            f.write(chunk)
+            written += len(chunk)
+
+    return written
+
+
+def fetch_url(url, path):
+    """Download url into path; returns the number of bytes written"""
+    return _fetch_range(url, path, 0)
+
+
+def download_range(stream, output_dir, filename, duration, margin=RANGE_MARGIN, log=print):
+    """Download only enough of an audio stream to cover its first `duration` seconds.
+
+    The byte range is estimated from the stream bitrate plus `margin` seconds,
+    then doubled whenever the downloaded clip decodes shorter than `duration`.
+    Returns the downloaded file path.
+    """
+    from audio_engine import probe_duration
+
+    path = os.path.join(output_dir, filename)
+    bitrate = getattr(stream, 'bitrate', None) or DEFAULT_AUDIO_BITRATE
+    try:
+        filesize = stream.filesize or None
+    except Exception:
+        filesize = None
+
+    fetched = 0
+    end = int((duration + margin) * bitrate / 8) + RANGE_HEADER_BYTES - 1
+    for _ in range(RANGE_MAX_GROWTH + 1):
+        if filesize:
+            end = min(end, filesize - 1)
+        wanted = end - fetched + 1
+        written = _fetch_range(stream.url, path, fetched, end)
+        fetched += written
+
+        # Short read or end of the known size means we already have the whole file
+        if written < wanted or (filesize and fetched >= filesize):
+            return path
+
+        clip_duration = probe_duration(path)
+        if clip_duration is not None and clip_duration >= duration:
+            return path
+
+        log(f"Range for {filename} covers {clip_duration or 0:.1f}s of {duration}s, "
+            f"growing to {2 * fetched} bytes")
+        end = 2 * fetched - 1
+
+    # Still short after growing: fetch the rest of the file
+    _fetch_range(stream.url, path, fetched)
+    return path
+
+
+def download_audio(video, output_dir, filename, duration=None, retries=DOWNLOAD_RETRIES,
+                   backoff=RETRY_BACKOFF, log=print):
+    """Download the audio stream of one video, retrying with backoff.
+
+    If `duration` is given (and range fetching is enabled) only the bytes
+    needed for the first `duration` seconds are downloaded.
+    Returns the downloaded file path, or None if the video has no audio stream.
+    Raises the last error once all retries are exhausted.
+    """
+    attempt = 0
+    while True:
+        try:
+            with _global_slots:
+                audio_stream = video.streams.filter(only_audio=True).first()
+                if not audio_stream:
+                    return None
+                if duration and RANGE_FETCH and getattr(audio_stream, 'url', None):
+                    try:
+                        return download_range(audio_stream, output_dir, filename, duration, log=log)
+                    except Exception as e:
+                        log(f"Range fetch failed for {filename} ({str(e)}), downloading full stream")
+                return audio_stream.download(output_path=output_dir, filename=filename)
+        except Exception as e:
+            if attempt >= retries:
+                raise
+            delay = backoff * (2 ** attempt)
+            attempt += 1
+            log(f"Retrying {filename} in {delay:.1f}s (attempt {attempt}/{retries}): {str(e)}")
+            time.sleep(delay)
+
+
+def download_one(video, i, total, output_dir, duration=None, retries=DOWNLOAD_RETRIES,
+                 backoff=RETRY_BACKOFF, cache=clip_cache.CACHE_ENABLED,
+                 segment=segment_select.SEGMENT_MODE, log=print):
+    """Download (or fetch from the clip cache) the audio of the i-th of `total` videos.
+
+    With segment="energy" the returned file is a `duration`-second clip of
+    the track's most energetic window instead of (about) its first seconds.
+    Returns (path, bytes_fetched); path is None if the download failed or the
+    video had no audio, bytes_fetched is 0 for cache hits.
+    """
+    video_id = getattr(video, 'video_id', None)
+    use_cache = bool(cache and video_id and duration)
+    select = bool(duration and segment == 'energy')
+    clip_path = os.path.join(output_dir, f"video_{i}.mka")
+    try:
+        start = segment_select.cached_start(video_id, duration) if use_cache and select else 0
+        if use_cache and start is not None and \
+                clip_cache.fetch_cached(video_id, duration, clip_path, start=start):
+            log(f"✓ Using cached audio for video {i+1}")
+            return clip_path, 0
+
+        log(f"Downloading video {i+1}/{total}: {video.title[:50]}...")
+        # Picking a window needs the whole track, so range fetching is skipped
+        path = download_audio(video, output_dir, f"video_{i}.mp4",
+                              duration=None if select else duration,
+                              retries=retries, backoff=backoff, log=log)
+        if path:
+            log(f"✓ Successfully downloaded video {i+1}")
+        else:
+            log(f"Warning: No audio stream found for video {i+1}")
+        fetched = os.path.getsize(path) if path else 0
+    except Exception as e:
+        log(f"Error downloading video {i+1}: {str(e)}")
+        return None, 0
+
+    start = 0
+    if path and select:
+        start = segment_select.select_window(path, duration, video_id=video_id,
+                                             cache=use_cache, log=log)
+        if start:
+            log(f"Using {duration}s from {start:.1f}s of video {i+1}")
+
+    if path and use_cache:
+        try:
+            # Range-fetched files are partial, so only full downloads are raw entries
+            if select or not RANGE_FETCH:
+                clip_cache.store(clip_cache.raw_key(video_id), path)
+            path = clip_cache.save_clip(video_id, duration, path, clip_path, start=start)
+        except Exception as e:
+            log(f"Warning: Could not cache video {i+1}: {str(e)}")
+    elif path and start:
+        # Cut the window out so every merge path can keep trimming from 0
+        try:
+            extract_clip(path, clip_path, duration, start=start)
+            os.remove(path)
+            path = clip_path
+        except EngineError as e:
+            log(f"Warning: Could not cut the selected window of video {i+1}, "
+                f"keeping its first {duration}s: {str(e)}")
+    return path, fetched
+
+
+def download_all(videos, output_dir, duration=None, workers=DOWNLOAD_WORKERS,
+                 retries=DOWNLOAD_RETRIES, backoff=RETRY_BACKOFF,
+                 cache=clip_cache.CACHE_ENABLED, segment=segment_select.SEGMENT_MODE,
+                 on_progress=None, log=print):
+    """Download audio for every video in parallel.
+
+    With `duration` set, only about the first `duration` seconds of each
+    track are fetched (see download_range), and with `cache` enabled the
+    trimmed clips are served from and saved to the clip cache. `segment`
+    selects which part of each track is kept (see download_one).
+
+    `on_progress(i, path, bytes_fetched)` is called as each video finishes
+    (path is None if it failed, bytes_fetched is 0 for cache hits).
+
+    Returns a list aligned with `videos` (search order): the downloaded path
+    for each video, or None where the download failed or had no audio.
+    """
+    total = len(videos)
+    results = [None] * total
+
+    def fetch(i):
+        results[i], fetched = download_one(videos[i], i, total, output_dir, duration=duration,
+                                           retries=retries, backoff=backoff, cache=cache,
+                                           segment=segment, log=log)
+        if on_progress:
+            try:
+                on_progress(i, results[i], fetched)
+            except Exception as e:
+                log(f"Warning: Progress callback failed for video {i+1}: {str(e)}")
+
+    if total:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, total))) as pool:
+            list(pool.map(fetch, range(total)))
+
+    return results
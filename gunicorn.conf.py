@@ -0,0 +1,12 @@
+"""
+Gunicorn settings, read automatically when gunicorn starts in this directory.
+
+The app is preloaded once in the master (see Procfile) and forked into the
+workers; each worker then starts its own background threads.
+"""
+
+
+def post_fork(server, worker):
+    """Start the job queue supervisor and mail senders in the new worker"""
+    import app
+    app.start_background()
@@ -0,0 +1,535 @@
+"""
+Durable SQLite-backed job queue with a bounded pool of worker processes.
+
+Web workers only enqueue jobs. One process per host (elected with a file lock,
+so any of the gunicorn workers can take over if the current one is recycled)
+supervises a fixed pool of worker processes that claim queued jobs, run the
+handler registered for the job's kind and keep a heartbeat. Jobs whose
+heartbeat goes stale because their worker died are put back on the queue.
+
+Jobs submitted with a dedupe key are coalesced: while an identical job is
+queued, running or recently finished, new requesters are added to its
+subscribers instead of creating another job. A job can name a follow-up
+kind that notifies subscribers who attached too late for the job itself:
+it is queued (once per job while waiting) in the same transaction that
+attaches a subscriber to the finished job, or that finishes a job whose
+subscribers were not all claimed, so none is left without a notification.
+
+Queued jobs are not run strictly in arrival order but by fair queueing
+across clients: each job gets a virtual start tag (the later of the
+queue's virtual time and its client's previous finish tag) and a finish tag
+(start plus the job's cost), and workers claim the smallest finish tag.
+Clients take turns, and small jobs overtake large ones. A job waiting
+longer than MASHUP_MAX_WAIT seconds is claimed first, so none starves.
+"""
+
+import importlib
+import json
+import multiprocessing
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing
+
+import database
+import telemetry
+
+try:
+    import fcntl
+except ImportError:  # Windows: no cross-process election, every process leads
+    fcntl = None
+
+# Queue configuration (override with environment variables)
+QUEUE_WORKERS = int(os.environ.get("MASHUP_QUEUE_WORKERS", "2"))
+MAX_QUEUED = int(os.environ.get("MASHUP_MAX_QUEUED", "20"))
+MAX_ATTEMPTS = int(os.environ.get("MASHUP_JOB_ATTEMPTS", "3"))
+DEDUPE_WINDOW = float(os.environ.get("MASHUP_DEDUPE_WINDOW", "600"))  # seconds after finishing
+MAX_WAIT = float(os.environ.get("MASHUP_MAX_WAIT", "900"))  # seconds before fair ordering is overridden
+POLL_INTERVAL = 1.0  # seconds between queue polls in an idle worker
+HEARTBEAT_INTERVAL = 10.0
+STALE_AFTER = 60.0  # a running job without a heartbeat for this long is requeued
+SUPERVISE_INTERVAL = 5.0
+
+# Name prefix of worker processes, so modules that start the pool on import
+# (the handler's module is imported in every worker) don't recurse
+WORKER_NAME = "mashup-queue-worker"
+
+_supervisor = None
+_supervisor_lock = threading.Lock()
+
+
+def new_job_id():
+    """Return a unique, unguessable job id"""
+    return uuid.uuid4().hex
+
+
+class QueueFull(Exception):
+    """Raised by submit() when the queue is saturated"""
+
+    def __init__(self, queue_length):
+        super().__init__(f"Job queue is full ({queue_length} jobs waiting)")
+        self.queue_length = queue_length
+
+
+@database.schema
+def _create_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS jobs (
+            id TEXT PRIMARY KEY,
+            kind TEXT NOT NULL DEFAULT 'mashup',
+            dedupe_key TEXT,
+            status TEXT NOT NULL,
+            args TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            started_at REAL,
+            finished_at REAL,
+            heartbeat REAL,
+            worker TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT
+        )
+    """)
+    # Databases created before job kinds and coalescing existed
+    columns = [row['name'] for row in conn.execute("PRAGMA table_info(jobs)")]
+    if 'kind' not in columns:
+        conn.execute("ALTER TABLE jobs ADD COLUMN kind TEXT NOT NULL DEFAULT 'mashup'")
+    if 'dedupe_key' not in columns:
+        conn.execute("ALTER TABLE jobs ADD COLUMN dedupe_key TEXT")
+    # ... and before fair scheduling and follow-up jobs
+    for column in ('client TEXT', 'cost REAL NOT NULL DEFAULT 0',
+                   'start_tag REAL NOT NULL DEFAULT 0', 'finish_tag REAL NOT NULL DEFAULT 0',
+                   'followup TEXT'):
+        if column.split()[0] not in columns:
+            conn.execute(f"ALTER TABLE jobs ADD COLUMN {column}")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_dedupe ON jobs (dedupe_key, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_fair ON jobs (status, finish_tag)")
+    conn.execute("CREATE INDEX IF NOT EXISTS jobs_client ON jobs (client, finish_tag)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS scheduler (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            virtual_time REAL NOT NULL
+        )
+    """)
+    conn.execute("INSERT OR IGNORE INTO scheduler (id, virtual_time) VALUES (0, 0)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS job_subscribers (
+            job_id TEXT NOT NULL,
+            subscriber TEXT NOT NULL,
+            added_at REAL NOT NULL,
+            notified INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (job_id, subscriber)
+        )
+    """)
+
+
+def in_worker():
+    """True inside a queue worker process (already while its modules are imported)"""
+    return multiprocessing.current_process().name.startswith(WORKER_NAME)
+
+
+def _queue_length(conn):
+    return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'").fetchone()[0]
+
+
+def _queue_position(conn, job):
+    """Return the 1-based position of a queued job in the fair order, as it stands now"""
+    return conn.execute(
+        "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND "
+        "(finish_tag < ? OR (finish_tag = ? AND created_at <= ?))",
+        (job['finish_tag'], job['finish_tag'], job['created_at'])
+    ).fetchone()[0]
+
+
+def _tags(conn, client, cost):
+    """Return the (start, finish) fair queueing tags of a new job"""
+    virtual_time = conn.execute("SELECT virtual_time FROM scheduler WHERE id = 0").fetchone()[0]
+    busy = conn.execute("SELECT 1 FROM jobs WHERE status IN ('queued', 'running') LIMIT 1").fetchone()
+    if busy is None:
+        # An idle queue catches up with all the work served so far
+        served = conn.execute("SELECT MAX(finish_tag) FROM jobs WHERE status IN ('done', 'failed')"
+                              ).fetchone()[0]
+        if served is not None and served > virtual_time:
+            virtual_time = served
+            conn.execute("UPDATE scheduler SET virtual_time = ? WHERE id = 0", (virtual_time,))
+    start = virtual_time
+    if client is not None:
+        previous = conn.execute("SELECT MAX(finish_tag) FROM jobs WHERE client = ?",
+                                (client,)).fetchone()[0]
+        start = max(start, previous or 0)
+    return start, start + cost
+
+
+def _subscribe(conn, job_id, subscriber):
+    """Add a subscriber; returns False if it was subscribed already"""
+    return conn.execute(
+        "INSERT OR IGNORE INTO job_subscribers (job_id, subscriber, added_at) VALUES (?, ?, ?)",
+        (job_id, subscriber, time.time())
+    ).rowcount == 1
+
+
+def _insert(conn, job_id, args, kind, dedupe_key=None, client=None, cost=0, followup=None):
+    """Insert a queued job and return the fields _queue_position() needs"""
+    start, finish = _tags(conn, client, cost)
+    job = {'created_at': time.time(), 'finish_tag': finish}
+    conn.execute(
+        "INSERT INTO jobs (id, kind, dedupe_key, status, args, created_at, client, cost, "
+        "start_tag, finish_tag, followup) VALUES (?, ?, ?, 'queued', ?, ?, ?, ?, ?, ?, ?)",
+        (job_id, kind, dedupe_key, json.dumps(args), job['created_at'], client, cost, start, finish,
+         followup)
+    )
+    return job
+
+
+def _queue_followup(conn, job_id, kind):
+    """Queue a `kind` job for job_id's unnotified subscribers, unless one is
+    still waiting to start (a running one may have claimed them already)"""
+    dedupe_key = f"{kind}|{job_id}"
+    waiting = conn.execute("SELECT 1 FROM jobs WHERE dedupe_key = ? AND status = 'queued'",
+                           (dedupe_key,)).fetchone()
+    if waiting is None:
+        _insert(conn, new_job_id(), [job_id], kind, dedupe_key=dedupe_key)
+
+
+def submit(job_id, args, kind='mashup', dedupe_key=None, subscriber=None,
+           max_queued=None, dedupe_window=None, client=None, cost=0, followup=None):
+    """Add a job to the queue, or attach to an identical one.
+
+    If `dedupe_key` matches a job that is queued, running, or finished
+    successfully within `dedupe_window` seconds, `subscriber` is added to that
+    job instead and no new job is created. Returns a dict with the 'job_id'
+    to follow, its 'status', its 'queue_position' (if queued) and whether the
+    request was 'attached' to an existing job.
+
+    `followup` is the kind of job (called with this job's id) that notifies
+    subscribers the job itself did not claim: those attaching after it
+    finished, or while it was finishing.
+
+    `client` identifies who asked, for fair scheduling, and `cost` is the
+    job's size in any consistent unit (0 for trivial jobs, which run first).
+
+    Raises QueueFull when a new job is needed but `max_queued` jobs are
+    already waiting.
+    """
+    max_queued = MAX_QUEUED if max_queued is None else max_queued
+    dedupe_window = DEDUPE_WINDOW if dedupe_window is None else dedupe_window
+    with closing(database.connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+
+        if dedupe_key is not None:
+            existing = conn.execute(
+                "SELECT id, status, created_at, finish_tag, followup FROM jobs WHERE dedupe_key = ? AND "
+                "(status IN ('queued', 'running') OR (status = 'done' AND finished_at > ?)) "
+                "ORDER BY created_at DESC LIMIT 1",
+                (dedupe_key, time.time() - dedupe_window)
+            ).fetchone()
+            if existing is not None:
+                if subscriber is not None and _subscribe(conn, existing['id'], subscriber) \
+                        and existing['status'] == 'done' and existing['followup']:
+                    _queue_followup(conn, existing['id'], existing['followup'])
+                position = None
+                if existing['status'] == 'queued':
+                    position = _queue_position(conn, existing)
+                conn.execute("COMMIT")
+                return {
+                    'job_id': existing['id'],
+                    'status': existing['status'],
+                    'queue_position': position,
+                    'attached': True,
+                }
+
+        waiting = _queue_length(conn)
+        if waiting >= max_queued:
+            conn.execute("ROLLBACK")
+            raise QueueFull(waiting)
+        job = _insert(conn, job_id, args, kind, dedupe_key, client, cost, followup)
+        if subscriber is not None:
+            _subscribe(conn, job_id, subscriber)
+        position = _queue_position(conn, job)
+        conn.execute("COMMIT")
+        return {
+            'job_id': job_id,
+            'status': 'queued',
+            'queue_position': position,
+            'attached': False,
+        }
+
+
+def claim_subscribers(job_id):
+    """Return the subscribers of a job not notified yet, marking them notified.
+
+    Claiming is atomic, so concurrent deliveries never notify anyone twice.
+    Use release_subscriber() if delivery to one of them fails.
+    """
+    with closing(database.connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        rows = conn.execute(
+            "SELECT subscriber FROM job_subscribers WHERE job_id = ? AND notified = 0 "
+            "ORDER BY added_at",
+            (job_id,)
+        ).fetchall()
+        conn.execute("UPDATE job_subscribers SET notified = 1 WHERE job_id = ?", (job_id,))
+        conn.execute("COMMIT")
+    return [row['subscriber'] for row in rows]
+
+
+def release_subscriber(job_id, subscriber):
+    """Mark a claimed subscriber as not notified again"""
+    with closing(database.connect()) as conn:
+        conn.execute(
+            "UPDATE job_subscribers SET notified = 0 WHERE job_id = ? AND subscriber = ?",
+            (job_id, subscriber)
+        )
+
+
+def get_job(job_id):
+    """Return a job row as a dict (with its queue position if waiting), or None"""
+    with closing(database.connect()) as conn:
+        row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job['args'] = json.loads(job['args'])
+        if job['status'] == 'queued':
+            job['queue_position'] = _queue_position(conn, job)
+        return job
+
+
+def unfinished_jobs(kind):
+    """Return the id, status and args of every queued or running job of a kind"""
+    with closing(database.connect()) as conn:
+        rows = conn.execute("SELECT id, status, args FROM jobs WHERE kind = ? AND "
+                            "status IN ('queued', 'running')", (kind,)).fetchall()
+    return [dict(row, args=json.loads(row['args'])) for row in rows]
+
+
+def queue_stats():
+    """Return the number of jobs in each status"""
+    with closing(database.connect()) as conn:
+        rows = conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+    return {status: count for status, count in rows}
+
+
+def prune(cutoff):
+    """Delete jobs that finished before `cutoff` (a timestamp) and their
+    subscribers, keeping those whose follow-up job has not finished yet.
+    Returns the number of jobs deleted."""
+    with closing(database.connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        deleted = conn.execute(
+            "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ? AND NOT EXISTS ("
+            "SELECT 1 FROM jobs AS f WHERE f.dedupe_key = jobs.followup || '|' || jobs.id "
+            "AND f.status IN ('queued', 'running'))",
+            (cutoff,)
+        ).rowcount
+        conn.execute("DELETE FROM job_subscribers WHERE job_id NOT IN (SELECT id FROM jobs)")
+        conn.execute("COMMIT")
+    return deleted
+
+
+def _claim(worker_id, max_wait=None):
+    """Atomically move the next queued job to running and return it.
+
+    That is the job that waited longest if it waited over `max_wait`
+    seconds, otherwise the one with the smallest finish tag.
+    """
+    max_wait = MAX_WAIT if max_wait is None else max_wait
+    with closing(database.connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        now = time.time()
+        row = conn.execute(
+            "SELECT * FROM jobs WHERE status = 'queued' AND created_at < ? ORDER BY created_at LIMIT 1",
+            (now - max_wait,)
+        ).fetchone()
+        if row is None:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE status = 'queued' ORDER BY finish_tag, created_at LIMIT 1"
+            ).fetchone()
+        if row is None:
+            conn.execute("ROLLBACK")
+            return None
+        conn.execute(
+            "UPDATE jobs SET status = 'running', worker = ?, started_at = ?, heartbeat = ?, "
+            "attempts = attempts + 1 WHERE id = ?",
+            (worker_id, now, now, row['id'])
+        )
+        # Virtual time follows the jobs being served
+        conn.execute("UPDATE scheduler SET virtual_time = MAX(virtual_time, ?) WHERE id = 0",
+                     (row['start_tag'],))
+        conn.execute("COMMIT")
+    if row['attempts'] == 0:
+        telemetry.observe('mashup_queue_wait_seconds', now - row['created_at'], kind=row['kind'])
+    return dict(row)
+
+
+def _finish(job_id, status, error=None):
+    """Record a job's outcome, queueing its follow-up job in the same
+    transaction if subscribers attached after the job last claimed them"""
+    with closing(database.connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        conn.execute(
+            "UPDATE jobs SET status = ?, finished_at = ?, error = ? WHERE id = ?",
+            (status, time.time(), error, job_id)
+        )
+        job = conn.execute("SELECT followup FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if job is not None and job['followup'] and conn.execute(
+                "SELECT 1 FROM job_subscribers WHERE job_id = ? AND notified = 0 LIMIT 1",
+                (job_id,)).fetchone():
+            _queue_followup(conn, job_id, job['followup'])
+        conn.execute("COMMIT")
+
+
+def _heartbeat(job_id, stop):
+    while not stop.wait(HEARTBEAT_INTERVAL):
+        try:
+            with closing(database.connect()) as conn:
+                conn.execute("UPDATE jobs SET heartbeat = ? WHERE id = ?", (time.time(), job_id))
+        except sqlite3.Error as e:
+            telemetry.log_job(job_id, f"Warning - heartbeat failed: {str(e)}")
+
+
+def recover_stale(stale_after=STALE_AFTER, on_failed=None):
+    """Requeue running jobs whose worker stopped sending heartbeats.
+
+    Jobs that already used MAX_ATTEMPTS are marked failed instead, and
+    on_failed(job) is called for each of them (a dict like get_job's), so
+    their requesters hear about it like about any other failure.
+    Returns the number of jobs requeued.
+    """
+    cutoff = time.time() - stale_after
+    with closing(database.connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        failed = conn.execute(
+            "SELECT * FROM jobs WHERE status = 'running' AND heartbeat < ? AND attempts >= ?",
+            (cutoff, MAX_ATTEMPTS)
+        ).fetchall()
+        conn.executemany(
+            "UPDATE jobs SET status = 'failed', finished_at = ?, error = 'Worker died' WHERE id = ?",
+            [(time.time(), row['id']) for row in failed]
+        )
+        requeued = conn.execute(
+            "UPDATE jobs SET status = 'queued', worker = NULL "
+            "WHERE status = 'running' AND heartbeat < ?",
+            (cutoff,)
+        ).rowcount
+        conn.execute("COMMIT")
+
+    for row in failed:
+        job = dict(row, status='failed', error='Worker died')
+        job['args'] = json.loads(job['args'])
+        telemetry.log_job(job['id'], f"Gave up after {job['attempts']} attempts: worker died", level='error')
+        if on_failed:
+            try:
+                on_failed(job)
+            except Exception as e:
+                telemetry.log_job(job['id'], f"Warning - failure handler failed: {str(e)}", level='warning')
+    return requeued
+
+
+def _load_handler(handler_spec):
+    module_name, func_name = handler_spec.split(':')
+    return getattr(importlib.import_module(module_name), func_name)
+
+
+def _worker_main(db_path, handlers, parent_pid):
+    """Entry point of a worker process: claim and run jobs until the parent exits"""
+    database.configure(db_path)
+
+    handlers = {kind: _load_handler(spec) for kind, spec in handlers.items()}
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+
+    while os.getppid() == parent_pid:
+        try:
+            job = _claim(worker_id)
+        except sqlite3.Error as e:
+            telemetry.log(f"Queue worker {worker_id}: Warning - could not claim job: {str(e)}", level='warning')
+            job = None
+        if job is None:
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        stop = threading.Event()
+        beat = threading.Thread(target=_heartbeat, args=(job['id'], stop), daemon=True)
+        beat.start()
+        try:
+            handler = handlers.get(job['kind'])
+            if handler is None:
+                raise ValueError(f"No handler for job kind '{job['kind']}'")
+            handler(*json.loads(job['args']))
+            _finish(job['id'], 'done')
+        except Exception as e:
+            telemetry.log_job(job['id'], f"Failed in worker {worker_id}: {str(e)}", level='error')
+            _finish(job['id'], 'failed', str(e))
+        finally:
+            stop.set()
+            beat.join()
+
+
+def wait_for_leadership(lock_path, retry_interval=SUPERVISE_INTERVAL):
+    """Block until this process holds the exclusive lock at lock_path.
+
+    The lock is held until the process exits, so when the leader dies another
+    waiting process takes over. Returns the open lock file.
+    """
+    lock_file = open(lock_path, 'a')
+    if fcntl:
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                time.sleep(retry_interval)
+    return lock_file
+
+
+def _supervise(handlers, workers, on_failed=None):
+    """Become the queue leader for this host, then keep the worker pool alive"""
+    lock_file = wait_for_leadership(database.path() + ".lock")  # keep open: closing releases the lock
+    telemetry.log(f"Job queue: process {os.getpid()} is leader, starting {workers} workers")
+    ctx = multiprocessing.get_context('spawn')
+    procs = [None] * workers
+    while True:
+        try:
+            requeued = recover_stale(on_failed=on_failed)
+            if requeued:
+                telemetry.log(f"Job queue: requeued {requeued} jobs from dead workers", level='warning')
+        except sqlite3.Error as e:
+            telemetry.log(f"Job queue: Warning - stale job recovery failed: {str(e)}", level='warning')
+
+        for i, proc in enumerate(procs):
+            if proc is None or not proc.is_alive():
+                procs[i] = ctx.Process(
+                    name=f"{WORKER_NAME}-{i+1}",
+                    target=_worker_main,
+                    args=(database.path(), handlers, os.getpid()),
+                    daemon=True
+                )
+                procs[i].start()
+        time.sleep(SUPERVISE_INTERVAL)
+
+
+def start_pool(handlers, workers=None, on_failed=None):
+    """Start (once per process) the supervisor that runs queued jobs.
+
+    A process forked from one that had started it starts its own, since
+    threads do not survive a fork.
+
+    `handlers` maps each job kind to a "module:function" spec; the function
+    is called with the job's args in a worker process. `on_failed(job)` is
+    called in this process for jobs given up on after their worker died
+    MAX_ATTEMPTS times (see recover_stale).
+    """
+    global _supervisor
+    workers = QUEUE_WORKERS if workers is None else workers
+    with _supervisor_lock:
+        if (_supervisor is not None and _supervisor.is_alive()) or in_worker():
+            return
+        _supervisor = threading.Thread(
+            target=_supervise,
+            args=(handlers, workers, on_failed),
+            daemon=True
+        )
+        _supervisor.start()
@@ -0,0 +1,113 @@
+"""
+Job progress store shared by the web processes and the queue workers.
+
+Workers record the current stage and counters of each job in SQLite; the web
+app reads them back for the /jobs/<id> status endpoint and its event stream.
+"""
+
+import time
+from contextlib import closing
+
+import database
+
+# Stages a job moves through, in order
+STAGES = ['queued', 'searching', 'downloading', 'processing', 'packaging', 'emailing', 'done']
+FINAL_STAGES = ('done', 'failed')
+
+_FIELDS = (
+    'stage', 'message', 'videos_total', 'videos_downloaded', 'videos_processed',
+    'bytes_fetched', 'started_at', 'stage_started_at', 'updated_at',
+)
+
+
+@database.schema
+def _create_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS job_progress (
+            id TEXT PRIMARY KEY,
+            stage TEXT NOT NULL,
+            message TEXT,
+            videos_total INTEGER NOT NULL DEFAULT 0,
+            videos_downloaded INTEGER NOT NULL DEFAULT 0,
+            videos_processed INTEGER NOT NULL DEFAULT 0,
+            bytes_fetched INTEGER NOT NULL DEFAULT 0,
+            started_at REAL NOT NULL,
+            stage_started_at REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+
+
+def update(job_id, **fields):
+    """Create or update a job's progress record.
+
+    Changing `stage` also restarts the stage timer used for the ETA.
+    """
+    unknown = set(fields) - set(_FIELDS)
+    if unknown:
+        raise ValueError(f"Unknown progress fields: {', '.join(sorted(unknown))}")
+
+    now = time.time()
+    fields['updated_at'] = now
+    with closing(database.connect()) as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO job_progress (id, stage, started_at, stage_started_at, updated_at) "
+            "VALUES (?, 'queued', ?, ?, ?)",
+            (job_id, now, now, now)
+        )
+        if 'stage' in fields:
+            row = conn.execute("SELECT stage FROM job_progress WHERE id = ?", (job_id,)).fetchone()
+            if row['stage'] != fields['stage']:
+                fields['stage_started_at'] = now
+        columns = ', '.join(f"{name} = ?" for name in fields)
+        conn.execute(
+            f"UPDATE job_progress SET {columns} WHERE id = ?",
+            list(fields.values()) + [job_id]
+        )
+
+
+def increment(job_id, field, amount=1):
+    """Atomically add `amount` to a counter field"""
+    if field not in ('videos_downloaded', 'videos_processed', 'bytes_fetched'):
+        raise ValueError(f"Not a counter field: {field}")
+    with closing(database.connect()) as conn:
+        conn.execute(
+            f"UPDATE job_progress SET {field} = {field} + ?, updated_at = ? WHERE id = ?",
+            (amount, time.time(), job_id)
+        )
+
+
+def _estimate_eta(progress, now):
+    """Rough seconds remaining, extrapolated from the download rate so far"""
+    total = progress['videos_total']
+    done = progress['videos_downloaded']
+    if progress['stage'] in FINAL_STAGES:
+        return 0
+    if progress['stage'] != 'downloading' or not total or not done:
+        return None
+    elapsed = now - progress['stage_started_at']
+    remaining_downloads = elapsed / done * (total - done)
+    # Processing a whole job takes roughly as long as one more download round
+    return round(remaining_downloads + elapsed / done, 1)
+
+
+def prune(cutoff):
+    """Delete the progress of jobs that reached a final stage before `cutoff`
+    (a timestamp); returns the number of rows deleted"""
+    with closing(database.connect()) as conn:
+        return conn.execute(
+            f"DELETE FROM job_progress WHERE stage IN ({', '.join('?' * len(FINAL_STAGES))}) "
+            f"AND updated_at < ?",
+            (*FINAL_STAGES, cutoff)
+        ).rowcount
+
+
+def get(job_id):
+    """Return a job's progress as a dict (including 'eta_seconds'), or None"""
+    with closing(database.connect()) as conn:
+        row = conn.execute("SELECT * FROM job_progress WHERE id = ?", (job_id,)).fetchone()
+    if row is None:
+        return None
+    progress = dict(row)
+    progress['eta_seconds'] = _estimate_eta(progress, time.time())
+    return progress
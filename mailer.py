@@ -0,0 +1,275 @@
+"""
+Outbound mail subsystem.
+
+Jobs only enqueue messages into a persistent SQLite outbox. One process per
+host (elected like the job queue leader) runs a small pool of sender threads;
+each keeps its own authenticated SMTP connection open and reuses it for
+batches of messages. Failed deliveries are retried with exponential backoff.
+
+Every claim of a message carries a lease token, renewed just before the
+message is sent; a sender only records the outcome while it still holds the
+lease. A message is only taken back from a sender that has not renewed its
+lease for MASHUP_MAIL_STALE_AFTER seconds (and never sooner than
+STALE_TIMEOUTS SMTP timeouts), so a slow send is not repeated by another
+sender. A sender that dies after the server accepted a message but before
+recording it still causes a second delivery; both copies then carry the same
+Message-ID, which lets mail clients drop the duplicate.
+"""
+
+import os
+import smtplib
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import closing
+from email.utils import make_msgid
+
+import database
+import job_queue
+import telemetry
+
+# Mail configuration (override with environment variables)
+MAIL_WORKERS = int(os.environ.get("MASHUP_MAIL_WORKERS", "2"))
+MAIL_BATCH_SIZE = int(os.environ.get("MASHUP_MAIL_BATCH", "10"))
+MAIL_MAX_ATTEMPTS = int(os.environ.get("MASHUP_MAIL_ATTEMPTS", "6"))
+MAIL_RETRY_BACKOFF = float(os.environ.get("MASHUP_MAIL_BACKOFF", "30"))  # seconds, doubled per attempt
+MAIL_IDLE_TIMEOUT = 60.0  # close a pooled connection after this long unused
+MAIL_POLL_INTERVAL = 1.0
+MAIL_STALE_AFTER = float(os.environ.get("MASHUP_MAIL_STALE_AFTER", "900"))  # seconds without a lease renewal
+STALE_TIMEOUTS = 10  # one send is several SMTP round trips, each with its own timeout
+
+_smtp = {
+    'host': 'localhost',
+    'port': 25,
+    'username': None,
+    'password': None,
+    'starttls': False,
+    'timeout': 30,
+}
+_sender = None
+_sender_lock = threading.Lock()
+
+
+def configure(host, port, username=None, password=None, starttls=True, timeout=30):
+    """Set the SMTP server messages are sent through"""
+    _smtp.update(host=host, port=port, username=username, password=password,
+                 starttls=starttls, timeout=timeout)
+
+
+@database.schema
+def _create_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS outbox (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            sender TEXT NOT NULL,
+            recipient TEXT NOT NULL,
+            message TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            claimed_at REAL,
+            created_at REAL NOT NULL,
+            last_error TEXT,
+            lease TEXT
+        )
+    """)
+    # Databases created before leases existed
+    columns = [row['name'] for row in conn.execute("PRAGMA table_info(outbox)")]
+    if 'lease' not in columns:
+        conn.execute("ALTER TABLE outbox ADD COLUMN lease TEXT")
+    conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)")
+
+
+def enqueue(msg):
+    """Queue an email.message.Message for delivery and return its outbox id"""
+    if msg['Message-ID'] is None:
+        msg['Message-ID'] = make_msgid()  # kept by every retry of the message
+    with closing(database.connect()) as conn:
+        now = time.time()
+        return conn.execute(
+            "INSERT INTO outbox (sender, recipient, message, next_attempt_at, created_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (msg['From'], msg['To'], msg.as_string(), now, now)
+        ).lastrowid
+
+
+def outbox_stats():
+    """Return the number of outbox messages in each status"""
+    with closing(database.connect()) as conn:
+        rows = conn.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()
+    return {status: count for status, count in rows}
+
+
+def prune(cutoff):
+    """Delete sent and failed messages last handled before `cutoff` (a
+    timestamp); returns the number deleted"""
+    with closing(database.connect()) as conn:
+        return conn.execute(
+            "DELETE FROM outbox WHERE status IN ('sent', 'failed') AND COALESCE(claimed_at, created_at) < ?",
+            (cutoff,)
+        ).rowcount
+
+
+def stale_after():
+    """Seconds after which a claimed message whose lease was not renewed is taken back"""
+    return max(MAIL_STALE_AFTER, STALE_TIMEOUTS * _smtp['timeout'])
+
+
+def _claim_batch(limit):
+    """Atomically claim up to `limit` due messages, each with a new lease"""
+    now = time.time()
+    with closing(database.connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        # Messages claimed by a sender that died are due again; that counts as an attempt
+        conn.execute(
+            "UPDATE outbox SET status = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END, "
+            "attempts = attempts + 1, lease = NULL, last_error = 'Sender stopped' "
+            "WHERE status = 'sending' AND claimed_at < ?",
+            (MAIL_MAX_ATTEMPTS, now - stale_after())
+        )
+        rows = conn.execute(
+            "SELECT * FROM outbox WHERE status = 'pending' AND next_attempt_at <= ? "
+            "ORDER BY next_attempt_at LIMIT ?",
+            (now, limit)
+        ).fetchall()
+        batch = [dict(row, lease=uuid.uuid4().hex) for row in rows]
+        conn.executemany(
+            "UPDATE outbox SET status = 'sending', claimed_at = ?, lease = ? WHERE id = ?",
+            [(now, message['lease'], message['id']) for message in batch]
+        )
+        conn.execute("COMMIT")
+    return batch
+
+
+def _renew(message):
+    """Renew a message's lease right before sending it; False if it was taken back"""
+    with closing(database.connect()) as conn:
+        return conn.execute(
+            "UPDATE outbox SET claimed_at = ? WHERE id = ? AND lease = ? AND status = 'sending'",
+            (time.time(), message['id'], message['lease'])
+        ).rowcount == 1
+
+
+def _mark_sent(message):
+    with closing(database.connect()) as conn:
+        updated = conn.execute(
+            "UPDATE outbox SET status = 'sent', attempts = attempts + 1, last_error = NULL, lease = NULL "
+            "WHERE id = ? AND lease = ?",
+            (message['id'], message['lease'])
+        ).rowcount
+    if not updated:
+        telemetry.log(f"Delivered to {message['recipient']} after its claim expired; "
+                      f"it may be delivered twice", level='warning', mail_id=message['id'])
+
+
+def _mark_failed(message, error):
+    """Schedule a retry with exponential backoff, or give up after MAIL_MAX_ATTEMPTS"""
+    attempts = message['attempts'] + 1
+    if attempts >= MAIL_MAX_ATTEMPTS:
+        status, next_attempt = 'failed', message['next_attempt_at']
+        telemetry.log(f"Giving up on {message['recipient']} after {attempts} attempts: {error}",
+                      level='error', mail_id=message['id'])
+    else:
+        status, next_attempt = 'pending', time.time() + MAIL_RETRY_BACKOFF * (2 ** (attempts - 1))
+        telemetry.log(f"Delivery to {message['recipient']} failed, retrying later: {error}",
+                      level='warning', mail_id=message['id'])
+    with closing(database.connect()) as conn:
+        conn.execute(
+            "UPDATE outbox SET status = ?, attempts = ?, next_attempt_at = ?, last_error = ?, lease = NULL "
+            "WHERE id = ? AND lease = ?",
+            (status, attempts, next_attempt, str(error), message['id'], message['lease'])
+        )
+
+
+def open_connection():
+    """Open and authenticate a new SMTP connection"""
+    server = smtplib.SMTP(_smtp['host'], _smtp['port'], timeout=_smtp['timeout'])
+    try:
+        if _smtp['starttls']:
+            server.starttls()
+        if _smtp['username']:
+            server.login(_smtp['username'], _smtp['password'])
+    except Exception:
+        server.close()
+        raise
+    return server
+
+
+def _close(server):
+    try:
+        server.quit()
+    except Exception:
+        server.close()
+
+
+def _send_batch(batch, server):
+    """Deliver a claimed batch over `server` (opened on demand when None).
+
+    Returns the connection to keep using, or None if it was dropped.
+    """
+    for message in batch:
+        try:
+            if not _renew(message):
+                telemetry.log(f"Mail sender: message {message['id']} was taken back, skipping it",
+                              level='warning', mail_id=message['id'])
+                continue
+            with telemetry.span('smtp_send', mail_id=message['id']):
+                if server is None:
+                    server = open_connection()
+                server.sendmail(message['sender'], [message['recipient']], message['message'])
+            _mark_sent(message)
+        except Exception as e:
+            # Recipient-level rejections keep the connection; anything else drops it
+            if not isinstance(e, (smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError)) \
+                    and server is not None:
+                _close(server)
+                server = None
+            _mark_failed(message, e)
+    return server
+
+
+def _sender_loop():
+    """Deliver due messages in batches over one reused SMTP connection"""
+    server = None
+    last_used = 0
+    while True:
+        try:
+            batch = _claim_batch(MAIL_BATCH_SIZE)
+        except sqlite3.Error as e:
+            telemetry.log(f"Mail sender: Warning - could not claim messages: {str(e)}", level='warning')
+            batch = []
+
+        if not batch:
+            if server is not None and time.time() - last_used > MAIL_IDLE_TIMEOUT:
+                _close(server)
+                server = None
+            time.sleep(MAIL_POLL_INTERVAL)
+            continue
+
+        server = _send_batch(batch, server)
+        last_used = time.time()
+
+
+def _run_senders(workers):
+    lock_file = job_queue.wait_for_leadership(database.path() + ".mail.lock")  # keep open: closing releases the lock
+    telemetry.log(f"Mailer: process {os.getpid()} is sending mail with {workers} connections")
+    threads = [
+        threading.Thread(target=_sender_loop, name=f"mail-sender-{i+1}", daemon=True)
+        for i in range(workers)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def start(workers=None):
+    """Start (once per process, including forked children) the mail sender pool"""
+    global _sender
+    workers = MAIL_WORKERS if workers is None else workers
+    with _sender_lock:
+        if (_sender is not None and _sender.is_alive()) or job_queue.in_worker():
+            return
+        _sender = threading.Thread(target=_run_senders, args=(workers,), daemon=True)
+        _sender.start()
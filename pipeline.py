@@ -0,0 +1,304 @@
+"""
+Streaming download -> decode -> encode pipeline shared by the web app and the
+command-line tool.
+
+Download threads hand each finished track to the decode workers, which trim
+it to raw PCM while later tracks are still downloading; a single encoder
+consumes the decoded segments in search order and writes the mashup.
+Wall-clock time approaches the slowest stage instead of the sum of all
+stages.
+
+Both hand-offs are bounded by how far a track is ahead of the encoder: a
+track is only decoded within MASHUP_STAGE_QUEUE tracks of the one being
+encoded, and only downloaded within that plus the number of download
+workers. One slow track therefore holds back the tracks after it instead of
+letting all of them pile up as decoded PCM.
+
+Loudness normalization happens in the decode step and crossfades are mixed
+while the encoder is fed, so neither adds a pass over the audio.
+
+With a track filter (see track_filter), each downloaded clip is checked
+before it is queued for decoding; a rejected one is replaced in its slot by
+the next acceptable search result.
+"""
+
+import os
+import queue
+import threading
+
+import telemetry
+from audio_engine import (decode_segment, encode_pcm, ProcessRSS, PCMCrossfader, EngineError,
+                          SAMPLE_RATE, LOUDNESS_TARGET, CROSSFADE_SECONDS)
+from downloader import download_one, DOWNLOAD_WORKERS
+from segment_select import SEGMENT_MODE
+
+# Pipeline configuration (override with environment variables)
+DECODE_WORKERS = int(os.environ.get("MASHUP_DECODE_WORKERS", str(os.cpu_count() or 1)))  # ffmpeg decoders
+STAGE_QUEUE_SIZE = int(os.environ.get("MASHUP_STAGE_QUEUE", "4"))  # decoded tracks ahead of the encoder
+GLOBAL_DECODE_LIMIT = int(os.environ.get("MASHUP_GLOBAL_DECODES", str(os.cpu_count() or 1)))  # per process
+
+PCM_BYTES_PER_SECOND = SAMPLE_RATE * 2 * 2  # s16le stereo
+
+# Shared by every pipeline running in this process (e.g. CLI batch rows)
+_decode_slots = threading.BoundedSemaphore(GLOBAL_DECODE_LIMIT)
+
+
+class MashupPipeline:
+    """Download, trim and merge one mashup with overlapping stages.
+
+    After run() (whether it succeeded or not) `downloaded` holds the
+    downloaded path of every video in search order (None where it failed),
+    so callers can fall back to another engine without downloading again.
+
+    With a track_filter, `videos` should come from its select(); slots whose
+    clip it rejects get its replacement() (and `videos` is updated).
+    """
+
+    def __init__(self, videos, work_dir, duration, download_workers=None,
+                 decode_workers=None, queue_size=None, on_progress=None,
+                 on_downloads_done=None, on_segment=None, job_id=None,
+                 loudness=LOUDNESS_TARGET, crossfade=CROSSFADE_SECONDS,
+                 segment=SEGMENT_MODE, track_filter=None, log=print):
+        self.videos = list(videos)
+        self.work_dir = work_dir
+        self.duration = duration
+        self.download_workers = download_workers or DOWNLOAD_WORKERS
+        self.decode_workers = decode_workers or DECODE_WORKERS
+        self.queue_size = max(1, queue_size or STAGE_QUEUE_SIZE)
+        self.on_progress = on_progress
+        self.on_downloads_done = on_downloads_done
+        self.on_segment = on_segment
+        self.job_id = job_id
+        self.loudness = loudness
+        self.crossfade = crossfade
+        self.segment = segment
+        self.track_filter = track_filter
+        self.log = log
+        self.downloaded = [None] * len(self.videos)
+
+        self._pending = queue.Queue()  # indices still to download
+        self._to_decode = {}  # index -> downloaded path (None if it failed)
+        self._decoded = {}  # index -> PCM path, or None if the track was skipped
+        self._next_encode = 0  # index the encoder waits for
+        self._downloads_done = False
+        self._decoded_ready = threading.Condition()  # guards the four above
+        self._encoder_failed = threading.Event()  # stop decoding, keep downloading
+        self._aborted = threading.Event()  # stop everything
+
+    def downloaded_files(self):
+        """Return the paths that downloaded successfully, in search order"""
+        return [path for path in self.downloaded if path]
+
+    def _callback(self, callback, *args):
+        if callback:
+            try:
+                callback(*args)
+            except Exception as e:
+                self.log(f"Warning: Pipeline callback failed: {str(e)}")
+
+    def _ahead(self, i, window):
+        """Whether track i is too far ahead of the encoder to be worked on yet.
+
+        Once encoding has stopped nothing is held back, so `downloaded` still
+        fills up for fallbacks.
+        """
+        return i >= self._next_encode + window and not self._encoder_failed.is_set()
+
+    def _download_worker(self):
+        total = len(self.videos)
+        window = self.queue_size + self.download_workers
+        while not self._aborted.is_set():
+            try:
+                i = self._pending.get_nowait()
+            except queue.Empty:
+                return
+            # Waits while the encoder is behind, bounding the downloads in flight
+            with self._decoded_ready:
+                while self._ahead(i, window) and not self._aborted.is_set():
+                    self._decoded_ready.wait()
+            if self._aborted.is_set():
+                return
+            path, fetched = self._download_slot(i, total)
+            self.downloaded[i] = path
+            self._callback(self.on_progress, i, path, fetched)
+            with self._decoded_ready:
+                self._to_decode[i] = path
+                self._decoded_ready.notify_all()
+
+    def _download_slot(self, i, total):
+        """Download the track for slot i, replacing it while the track filter rejects it"""
+        fetched_total = 0
+        while True:
+            with telemetry.span('download', job_id=self.job_id, track=i + 1) as span:
+                path, fetched = download_one(self.videos[i], i, total, self.work_dir,
+                                             duration=self.duration, segment=self.segment,
+                                             log=self.log)
+                span.update(ok=path is not None, bytes=fetched)
+            fetched_total += fetched
+            if path is None:
+                telemetry.inc('mashup_stage_failures_total', stage='download')
+                return None, fetched_total
+            if fetched:
+                telemetry.observe('mashup_download_bytes', fetched)
+            reason = self.track_filter.check(self.videos[i], path) if self.track_filter else None
+            if reason is None:
+                return path, fetched_total
+
+            telemetry.inc('mashup_tracks_skipped_total', reason='duplicate')
+            os.remove(path)
+            replacement = self.track_filter.replacement()
+            if replacement is None:
+                self.log(f"Dropping video {i+1} ({reason}), no more search results to replace it")
+                return None, fetched_total
+            self.log(f"Replacing video {i+1} ({reason}) with the next search result")
+            self.videos[i] = replacement
+
+    def _next_to_decode(self):
+        """Wait for the earliest downloaded track within queue_size of the
+        encoder and return (index, path), or None when there is nothing left"""
+        with self._decoded_ready:
+            while True:
+                if self._to_decode:
+                    i = min(self._to_decode)
+                    if not self._ahead(i, self.queue_size):
+                        return i, self._to_decode.pop(i)
+                elif self._downloads_done:
+                    return None
+                self._decoded_ready.wait()
+
+    def _decode_worker(self):
+        while True:
+            item = self._next_to_decode()
+            if item is None:
+                return
+            i, path = item
+            pcm_path = None
+            if path and not self._encoder_failed.is_set():
+                pcm_path = os.path.join(self.work_dir, f"segment_{i}.pcm")
+                try:
+                    # Trimming happens in the same ffmpeg run as decoding
+                    with _decode_slots, telemetry.span('decode', job_id=self.job_id, track=i + 1):
+                        decode_segment(path, pcm_path, duration=self.duration,
+                                       loudness=self.loudness)
+                except EngineError as e:
+                    self.log(f"Error processing audio {i+1}: {str(e)}")
+                    pcm_path = None
+            with self._decoded_ready:
+                self._decoded[i] = pcm_path
+                self._decoded_ready.notify_all()
+
+    def _wait_for_segment(self, i):
+        with self._decoded_ready:
+            while i not in self._decoded:
+                if self._aborted.is_set():
+                    raise EngineError("Pipeline cancelled")
+                self._decoded_ready.wait()
+            return self._decoded.pop(i)
+
+    def _segment_done(self, i):
+        # Lets the stages move on to the tracks after i
+        with self._decoded_ready:
+            self._next_encode = i + 1
+            self._decoded_ready.notify_all()
+
+    def _stop_encoding(self, abort=False):
+        self._encoder_failed.set()
+        if abort:
+            self._aborted.set()
+        with self._decoded_ready:
+            self._decoded_ready.notify_all()
+
+    def cancel(self):
+        """Stop a running pipeline: no new downloads start and the encoder is fed no more"""
+        self._stop_encoding(abort=True)
+
+    def run(self, output_file, codec='aac', bitrate='192k', output_format='mp4',
+            channels=None, stdout=None):
+        """Produce output_file and return a stats dict like audio_engine.stream_concat.
+
+        Segments are streamed from disk, so no segment buffer is reported;
+        the process peak covers the pipeline's threads and the crossfade
+        buffer.
+
+        With output_file='pipe:1' the encoded audio is written to `stdout` as
+        it is produced instead (see audio_engine.encode_pcm), and `channels`
+        downmixes it. Tracks that fail to download or decode are skipped.
+        Raises EngineError if no segment could be decoded, the encoder fails
+        or the pipeline is cancelled.
+        """
+        total = len(self.videos)
+        if not total:
+            raise EngineError("No input files to merge")
+        stats = {'duration': 0.0, 'segments': 0, 'encoder_peak_rss_kb': None,
+                 'process_start_rss_kb': None, 'process_peak_rss_kb': None}
+        with ProcessRSS() as rss:
+            for i in range(total):
+                self._pending.put(i)
+
+            downloaders = [
+                threading.Thread(target=self._download_worker, name=f"pipeline-download-{n+1}", daemon=True)
+                for n in range(max(1, min(self.download_workers, total)))
+            ]
+            decoders = [
+                threading.Thread(target=self._decode_worker, name=f"pipeline-decode-{n+1}", daemon=True)
+                for n in range(max(1, min(self.decode_workers, total)))
+            ]
+            for thread in downloaders + decoders:
+                thread.start()
+
+            def close_decoders():
+                for thread in downloaders:
+                    thread.join()
+                self._callback(self.on_downloads_done, self.downloaded_files())
+                with self._decoded_ready:
+                    self._downloads_done = True
+                    self._decoded_ready.notify_all()
+
+            closer = threading.Thread(target=close_decoders, name="pipeline-close", daemon=True)
+            closer.start()
+
+            def feed(stdin):
+                # Encode segments in search order as soon as each one is decoded
+                writer = PCMCrossfader(stdin, self.crossfade)
+                for i in range(total):
+                    pcm_path = self._wait_for_segment(i)
+                    if pcm_path is None:
+                        self._segment_done(i)
+                        continue
+                    size = os.path.getsize(pcm_path)
+                    with open(pcm_path, 'rb') as f:
+                        writer.add(f, size)
+                    os.remove(pcm_path)
+                    self._segment_done(i)
+                    stats['segments'] += 1
+                    self.log(f"Merged file {i+1}/{total}")
+                    self._callback(self.on_segment, i)
+                writer.close()
+                stats['duration'] = writer.bytes_written / PCM_BYTES_PER_SECOND
+                if stats['segments'] == 0:
+                    raise EngineError("No audio segments could be decoded")
+
+            try:
+                with telemetry.span('export', job_id=self.job_id, engine='pipeline') as span:
+                    stats['encoder_peak_rss_kb'] = encode_pcm(feed, output_file, codec=codec, bitrate=bitrate,
+                                                      output_format=output_format, channels=channels,
+                                                      stdout=stdout)
+                    span.update(segments=stats['segments'])
+            except EngineError:
+                self._stop_encoding()
+                raise
+            except BaseException:
+                self._stop_encoding(abort=True)
+                raise
+            finally:
+                # Let every stage finish, so `downloaded` is complete for fallbacks
+                closer.join()
+                for thread in decoders:
+                    thread.join()
+                for name in os.listdir(self.work_dir):
+                    if name.startswith('segment_') and name.endswith('.pcm'):
+                        os.remove(os.path.join(self.work_dir, name))
+
+        stats['process_start_rss_kb'] = rss.start_kb
+        stats['process_peak_rss_kb'] = rss.peak_kb
+        return stats
@@ -0,0 +1,175 @@
+"""
+Short, low-bitrate previews of a mashup, streamed while they are made.
+
+A preview runs the same steps as a full job (search cache, track filter,
+clip cache, range fetches, decoders, one encoder), but with
+MASHUP_PREVIEW_SECONDS of each track, downmixed to mono MP3 at
+MASHUP_PREVIEW_BITRATE. Everything runs in a producer thread whose encoder
+writes into a pipe that the HTTP response reads from, so the first track can
+be heard as soon as it is downloaded and decoded.
+
+The response is only started once the first audio is there (start()): a
+preview that finds nothing or fails before then, or takes longer than
+MASHUP_PREVIEW_TIMEOUT, is reported as an HTTP error instead of an empty
+200. Only MASHUP_PREVIEW_SLOTS previews run at once per process.
+"""
+
+import os
+import select
+import threading
+import time
+
+import search_cache
+import telemetry
+import workspace
+from pipeline import MashupPipeline
+from track_filter import TrackFilter
+
+# Preview configuration (override with environment variables)
+PREVIEW_SECONDS = int(os.environ.get("MASHUP_PREVIEW_SECONDS", "5"))  # per track
+PREVIEW_BITRATE = os.environ.get("MASHUP_PREVIEW_BITRATE", "64k")
+PREVIEW_MAX_TRACKS = int(os.environ.get("MASHUP_PREVIEW_MAX_TRACKS", "20"))
+PREVIEW_SLOTS = int(os.environ.get("MASHUP_PREVIEW_SLOTS", "2"))  # concurrent previews per process
+PREVIEW_TIMEOUT = float(os.environ.get("MASHUP_PREVIEW_TIMEOUT", "30"))  # seconds until the first audio
+MIMETYPE = 'audio/mpeg'
+CHUNK_SIZE = 8 * 1024  # small, so audio reaches the client early
+
+_slots = threading.BoundedSemaphore(PREVIEW_SLOTS)
+
+
+class PreviewError(Exception):
+    """Raised by PreviewStream.start() when no audio could be produced"""
+
+    def __init__(self, message, status=502):
+        super().__init__(message)
+        self.status = status  # HTTP status to answer with
+
+
+def try_acquire():
+    """Reserve a preview slot; returns False when all are in use"""
+    return _slots.acquire(blocking=False)
+
+
+def release():
+    """Give back a slot taken with try_acquire()"""
+    _slots.release()
+
+
+class PreviewStream:
+    """Iterable of the encoded preview for an artist, for an HTTP response.
+
+    Takes over a slot reserved with try_acquire(); it is given back when the
+    producer thread has stopped. Call start() before handing the stream to
+    the response, and close() (the response does) to stop it early.
+    """
+
+    def __init__(self, singer_name, count, job_id=None, started=None, log=print):
+        self.singer_name = singer_name
+        self.count = count
+        self.job_id = job_id
+        self.log = log
+        self.started = time.perf_counter() if started is None else started  # for time to first audio
+        self.failure = None  # PreviewError of the producer, if it failed
+        self._first = None
+        self._reader = None
+        self._pipeline = None
+        self._cancelled = False
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+
+    def _produce(self, write_fd):
+        try:
+            with workspace.job_workspace(f"preview_{self.job_id}", keep_failed=False) as work_dir:
+                with telemetry.span('search', job_id=self.job_id) as span:
+                    results = search_cache.search(self.singer_name)
+                    span.update(results=len(results))
+                if not results:
+                    raise PreviewError(f"No search results found for '{self.singer_name}'", 404)
+                candidates = TrackFilter(results, self.singer_name, duration=PREVIEW_SECONDS,
+                                         segment='start', log=self.log)
+                videos = candidates.select(self.count)
+                if not videos:
+                    raise PreviewError(f"None of the search results for '{self.singer_name}' look like songs", 404)
+
+                with self._lock:
+                    if self._cancelled:
+                        return
+                    self._pipeline = MashupPipeline(videos, work_dir, PREVIEW_SECONDS, segment='start',
+                                                    track_filter=candidates, job_id=self.job_id,
+                                                    log=self.log)
+                with telemetry.span('preview', job_id=self.job_id) as span:
+                    stats = self._pipeline.run('pipe:1', codec='libmp3lame', bitrate=PREVIEW_BITRATE,
+                                               output_format='mp3', channels=1, stdout=write_fd)
+                    span.update(segments=stats['segments'])
+        except PreviewError as e:
+            self.failure = e
+        except Exception as e:
+            self.failure = PreviewError(f"Could not make the preview: {str(e)}")
+        finally:
+            os.close(write_fd)  # the reader sees the end of the stream
+            self._done.set()
+            release()
+
+    def start(self, timeout=None):
+        """Start producing the preview and wait for its first audio.
+
+        Raises PreviewError, after stopping the preview, if it failed or no
+        audio arrived within `timeout` seconds (MASHUP_PREVIEW_TIMEOUT).
+        """
+        timeout = PREVIEW_TIMEOUT if timeout is None else timeout
+        write_fd = None
+        try:
+            read_fd, write_fd = os.pipe()
+            self._reader = os.fdopen(read_fd, 'rb', buffering=0)
+            threading.Thread(target=self._produce, args=(write_fd,), name="preview-producer",
+                             daemon=True).start()
+        except (OSError, RuntimeError) as e:
+            # No producer is running to close its end and give back the slot
+            if write_fd is not None:
+                os.close(write_fd)
+            self.close()
+            release()
+            raise PreviewError(f"Could not start the preview: {str(e)}", 503)
+
+        deadline = time.perf_counter() + timeout
+        try:
+            while True:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    raise PreviewError("The preview took too long to start. Please try again.", 504)
+                readable, _, _ = select.select([self._reader], [], [], remaining)
+                if readable:
+                    break
+            self._first = self._reader.read(CHUNK_SIZE)
+            if not self._first:
+                self._done.wait()
+                raise self.failure or PreviewError("The preview produced no audio")
+        except BaseException:
+            self.close()
+            raise
+        telemetry.observe('mashup_preview_first_audio_seconds', time.perf_counter() - self.started)
+
+    def __iter__(self):
+        return self._generate()
+
+    def _generate(self):
+        try:
+            chunk = self._first
+            while chunk:
+                yield chunk
+                chunk = self._reader.read(CHUNK_SIZE)
+            if self.failure:
+                # Too late for an error status; the client gets a shorter preview
+                self.log(f"Preview failed after it started: {str(self.failure)}")
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop the preview (if still running) and drop the stream; also reached
+        when the client disconnects mid-stream"""
+        with self._lock:
+            self._cancelled = True
+            if self._pipeline is not None:
+                self._pipeline.cancel()
+        if self._reader is not None:
+            self._reader.close()  # an encoder still writing gets a broken pipe
@@ -0,0 +1,127 @@
+"""
+Token-bucket rate limits on job submissions, per client IP and per email,
+and on previews, per client IP.
+
+Each key has a bucket of up to `burst` tokens that refills at `per_hour`
+tokens an hour; a submission takes one token from every bucket it is
+charged to, or none if any of them is empty. Tokens can be given back
+(refund()) to a submission that was refused later on. Buckets live in
+SQLite (the job database), so every web worker process enforces the same
+limits.
+"""
+
+import os
+import time
+from contextlib import closing
+
+import database
+
+# Limit configuration (override with environment variables; a rate of 0 disables a limit)
+IP_BURST = float(os.environ.get("MASHUP_RATE_IP_BURST", "5"))
+IP_PER_HOUR = float(os.environ.get("MASHUP_RATE_IP_PER_HOUR", "20"))
+EMAIL_BURST = float(os.environ.get("MASHUP_RATE_EMAIL_BURST", "3"))
+EMAIL_PER_HOUR = float(os.environ.get("MASHUP_RATE_EMAIL_PER_HOUR", "10"))
+PREVIEW_BURST = float(os.environ.get("MASHUP_RATE_PREVIEW_BURST", "5"))
+PREVIEW_PER_HOUR = float(os.environ.get("MASHUP_RATE_PREVIEW_PER_HOUR", "30"))
+PROXY_HOPS = int(os.environ.get("MASHUP_PROXY_HOPS", "1"))  # trusted proxies adding X-Forwarded-For (Railway: 1)
+
+LIMITS = {
+    # scope -> (burst, tokens per hour)
+    'ip': (IP_BURST, IP_PER_HOUR),
+    'email': (EMAIL_BURST, EMAIL_PER_HOUR),
+    'preview': (PREVIEW_BURST, PREVIEW_PER_HOUR),  # per client IP
+}
+
+
+class RateLimited(Exception):
+    """Raised by acquire() when a bucket has no token left"""
+
+    def __init__(self, scope, retry_after):
+        super().__init__(f"Too many submissions for this {scope} (retry in {retry_after:.0f}s)")
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+@database.schema
+def _create_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS rate_buckets (
+            key TEXT PRIMARY KEY,
+            tokens REAL NOT NULL,
+            updated_at REAL NOT NULL
+        )
+    """)
+
+
+def client_ip(remote_addr, forwarded_for=None, proxy_hops=None):
+    """Return the client address of a request, trusting `proxy_hops` proxies'
+    X-Forwarded-For entries (counted from the right)"""
+    proxy_hops = PROXY_HOPS if proxy_hops is None else proxy_hops
+    if proxy_hops and forwarded_for:
+        hops = [hop.strip() for hop in forwarded_for.split(',') if hop.strip()]
+        if len(hops) >= proxy_hops:
+            return hops[-proxy_hops]
+    return remote_addr or 'unknown'
+
+
+def acquire(charges, limits=None):
+    """Take one token from the bucket of every (scope, key) in `charges`.
+
+    All buckets are checked in one transaction: either every bucket gives a
+    token, or none is charged and RateLimited is raised for the scope that
+    would refill last.
+    """
+    limits = LIMITS if limits is None else limits
+    now = time.time()
+    with closing(database.connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        updates = []
+        blocked = None
+        for scope, key in charges:
+            burst, per_hour = limits[scope]
+            if per_hour <= 0 or not key:
+                continue
+            bucket_key = f"{scope}:{key}"
+            row = conn.execute("SELECT tokens, updated_at FROM rate_buckets WHERE key = ?",
+                               (bucket_key,)).fetchone()
+            tokens = burst if row is None else \
+                min(burst, row['tokens'] + (now - row['updated_at']) * per_hour / 3600)
+            if tokens < 1:
+                retry_after = (1 - tokens) * 3600 / per_hour
+                if blocked is None or retry_after > blocked.retry_after:
+                    blocked = RateLimited(scope, retry_after)
+            updates.append((bucket_key, tokens - 1))
+        if blocked is not None:
+            conn.execute("ROLLBACK")
+            raise blocked
+        conn.executemany(
+            "INSERT OR REPLACE INTO rate_buckets (key, tokens, updated_at) VALUES (?, ?, ?)",
+            [(bucket_key, tokens, now) for bucket_key, tokens in updates]
+        )
+        # Buckets untouched long enough to be full again carry no state
+        full_after = max([burst * 3600 / per_hour for burst, per_hour in limits.values() if per_hour > 0],
+                         default=0)
+        conn.execute("DELETE FROM rate_buckets WHERE updated_at < ?", (now - full_after,))
+        conn.execute("COMMIT")
+
+
+def refund(charges, limits=None):
+    """Give back the token acquire() took from the bucket of every (scope, key)
+    in `charges`, e.g. when the request was refused after all"""
+    limits = LIMITS if limits is None else limits
+    now = time.time()
+    with closing(database.connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        for scope, key in charges:
+            burst, per_hour = limits[scope]
+            if per_hour <= 0 or not key:
+                continue
+            bucket_key = f"{scope}:{key}"
+            row = conn.execute("SELECT tokens, updated_at FROM rate_buckets WHERE key = ?",
+                               (bucket_key,)).fetchone()
+            if row is None:
+                continue  # pruned, so full already
+            tokens = min(burst, row['tokens'] + (now - row['updated_at']) * per_hour / 3600 + 1)
+            conn.execute("UPDATE rate_buckets SET tokens = ?, updated_at = ? WHERE key = ?",
+                         (tokens, now, bucket_key))
+        conn.execute("COMMIT")
@@ -0,0 +1,124 @@
+"""
+Packaging of finished mashups for download.
+
+A result is kept on disk once, as the encoded mashup itself. Archives are
+never written out: they are generated chunk by chunk while they are sent,
+with stored (uncompressed) entries, since the audio is already compressed.
+
+Formats:
+- raw: the mashup file as it is
+- zip: the mashup in a zip archive
+- bundle: a zip archive with the mashup and an MP3 rendition of it, which
+  ffmpeg encodes while the archive streams
+"""
+
+import os
+import subprocess
+import time
+import zipfile
+
+from audio_engine import get_ffmpeg, EngineError
+
+# Packaging configuration (override with environment variables)
+PACKAGE_FORMATS = ('raw', 'zip', 'bundle')
+DEFAULT_FORMAT = os.environ.get("MASHUP_PACKAGE", "raw")  # format of the emailed link (raw is resumable)
+BUNDLE_BITRATE = os.environ.get("MASHUP_BUNDLE_BITRATE", "192k")  # MP3 rendition
+CHUNK_SIZE = 256 * 1024
+
+FORMAT_LABELS = {
+    'raw': "Audio file only",
+    'zip': "ZIP archive",
+    'bundle': "MP4 + MP3 bundle (ZIP)",
+}
+
+
+class _ChunkWriter:
+    """Unseekable file object that collects what zipfile writes, for a generator to hand on"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        if data:
+            self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+
+def download_name(path, fmt):
+    """Return the file name a client should save the packaged result as"""
+    if fmt == 'raw':
+        return os.path.basename(path)
+    base = os.path.splitext(os.path.basename(path))[0]
+    return base + ('_bundle' if fmt == 'bundle' else '') + '.zip'
+
+
+def _file_chunks(path):
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk
+
+
+def _mp3_chunks(path, bitrate=BUNDLE_BITRATE):
+    """Encode path to MP3 with ffmpeg and yield the output as it is produced"""
+    cmd = [get_ffmpeg(), '-hide_banner', '-nostdin', '-loglevel', 'error', '-i', path,
+           '-map', '0:a:0', '-c:a', 'libmp3lame', '-b:a', bitrate, '-f', 'mp3', 'pipe:1']
+    try:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise EngineError(f"Could not run ffmpeg: {str(e)}")
+    try:
+        while True:
+            chunk = proc.stdout.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+        stderr = proc.stderr.read().decode('utf-8', errors='replace')
+        if proc.wait() != 0:
+            raise EngineError(f"ffmpeg exited with code {proc.returncode}: {stderr.strip()[-500:]}")
+    finally:
+        # The client may disconnect mid-download
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stdout.close()
+        proc.stderr.close()
+
+
+def _entries(path, fmt):
+    """Yield (ZipInfo, chunk iterator factory) for each member of the archive"""
+    base = os.path.splitext(os.path.basename(path))[0]
+    yield zipfile.ZipInfo.from_file(path, os.path.basename(path)), lambda: _file_chunks(path)
+    if fmt == 'bundle':
+        yield zipfile.ZipInfo(base + '.mp3', time.localtime()[:6]), lambda: _mp3_chunks(path)
+
+
+def stream_package(path, fmt):
+    """Yield the result at `path` packaged as `fmt` ('zip' or 'bundle') in chunks.
+
+    The archive is produced while it is consumed, so nothing is written to
+    disk and memory use is bounded by CHUNK_SIZE. Members carry data
+    descriptors, since their sizes are not known before they are written.
+    """
+    if fmt not in ('zip', 'bundle'):
+        raise ValueError(f"Unknown package format: {fmt}")
+    out = _ChunkWriter()
+    with zipfile.ZipFile(out, 'w', zipfile.ZIP_STORED) as archive:
+        for info, chunks in _entries(path, fmt):
+            info.compress_type = zipfile.ZIP_STORED
+            with archive.open(info, 'w') as member:
+                for chunk in chunks():
+                    member.write(chunk)
+                    yield from out.drain()
+            yield from out.drain()
+    # Central directory, written when the archive is closed
+    yield from out.drain()
@@ -0,0 +1,359 @@
+"""
+TTL cache for YouTube search results, keyed by normalised artist name.
+
+Each cached result resolves its title, duration and audio stream at most once
+and shares them with every job that uses it. Concurrent lookups for the same
+artist are coalesced into a single in-flight search.
+
+Jobs run in separate worker processes, so after database.configure() the
+results, with their titles, durations and audio stream descriptors as they
+get resolved, and the in-flight markers also live in SQLite (the job
+database): a process that finds another one searching for the same artist
+waits for its results instead of searching again, and reuses what was
+resolved for them. Without it (the CLI) the cache is per process.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+import database
+
+# Cache configuration (override with environment variables)
+SEARCH_TTL = float(os.environ.get("MASHUP_SEARCH_TTL", "1800"))  # seconds
+SEARCH_WAIT = float(os.environ.get("MASHUP_SEARCH_WAIT", "60"))  # longest wait for another process's search
+POLL_INTERVAL = 0.2  # seconds between checks while another process searches
+
+_lock = threading.Lock()
+_entries = {}  # key -> (expires_at, [CachedVideo])
+_inflight = {}  # key -> _PendingSearch
+_counters = {'hits': 0, 'misses': 0, 'coalesced': 0}
+
+
+class CachedVideo:
+    """Search result whose metadata and audio stream are fetched once and shared.
+
+    Exposes the parts of the pytubefix YouTube interface the downloader uses
+    (video_id, title, length and streams.filter(only_audio=True).first()).
+
+    `video` is the pytubefix YouTube object, or None to have load() create
+    it when first needed. A result rebuilt from the shared cache starts from
+    the `metadata` another process stored (see describe()), so YouTube is
+    only asked for what that process had not resolved. With `shared_until`
+    set, everything resolved here is stored for the other processes too.
+    """
+
+    def __init__(self, video_id, video=None, load=None, metadata=None, shared_until=None):
+        metadata = metadata or {}
+        self.video_id = video_id
+        self.streams = _AudioStreams(self)
+        self.shared_until = shared_until
+        self._video = video
+        self._load = load
+        self._lock = threading.Lock()
+        self._title = metadata.get('title')
+        self._length = metadata.get('length')
+        self._stream_resolved = 'audio_stream' in metadata
+        stream = metadata.get('audio_stream')
+        self._audio_stream = _StoredStream(stream) if stream else None
+
+    def _youtube(self):
+        if self._video is None:
+            self._video = self._load()
+        return self._video
+
+    def _resolve(self, resolve):
+        """Run resolve() under the lock; share the result if it was new"""
+        with self._lock:
+            value, resolved = resolve()
+        if resolved and self.shared_until is not None:
+            _store_videos([self], self.shared_until)
+        return value
+
+    @property
+    def title(self):
+        def resolve():
+            if self._title is not None:
+                return self._title, False
+            self._title = self._youtube().title
+            return self._title, True
+        return self._resolve(resolve)
+
+    @property
+    def length(self):
+        def resolve():
+            if self._length is not None:
+                return self._length, False
+            self._length = self._youtube().length
+            return self._length, True
+        return self._resolve(resolve)
+
+    def audio_stream(self):
+        """Resolve (once) and return the first audio-only stream, or None"""
+        def resolve():
+            if self._stream_resolved:
+                return self._audio_stream, False
+            self._audio_stream = self._youtube().streams.filter(only_audio=True).first()
+            self._stream_resolved = True
+            return self._audio_stream, True
+        return self._resolve(resolve)
+
+    def describe(self):
+        """Return the metadata resolved so far as a plain dict (what is not
+        resolved yet is left out)"""
+        with self._lock:
+            metadata = {'video_id': self.video_id}
+            if self._title is not None:
+                metadata['title'] = self._title
+            if self._length is not None:
+                metadata['length'] = self._length
+            stream = self._audio_stream
+            if self._stream_resolved and (stream is None or getattr(stream, 'url', None)):
+                metadata['audio_stream'] = {
+                    'url': stream.url,
+                    'mime_type': getattr(stream, 'mime_type', None),
+                    'bitrate': getattr(stream, 'bitrate', None),
+                } if stream else None
+            return metadata
+
+
+class _StoredStream:
+    """Audio stream rebuilt from describe(): what the downloader uses of a
+    pytubefix Stream. Stream URLs stay valid for hours, far longer than
+    SEARCH_TTL."""
+
+    filesize = None  # unknown; range fetches notice the end of the file
+
+    def __init__(self, descriptor):
+        self.url = descriptor['url']
+        self.mime_type = descriptor.get('mime_type')
+        self.bitrate = descriptor.get('bitrate')
+
+    def download(self, output_path, filename):
+        from downloader import fetch_url  # downloader imports the audio engine; keep it lazy
+        path = os.path.join(output_path, filename)
+        fetch_url(self.url, path)
+        return path
+
+
+class _AudioStreams:
+    """Minimal stand-in for a pytubefix StreamQuery that serves the cached audio stream"""
+
+    def __init__(self, video):
+        self._video = video
+
+    def filter(self, only_audio=True, **kwargs):
+        return self
+
+    def first(self):
+        return self._video.audio_stream()
+
+
+class _PendingSearch:
+    def __init__(self):
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+def _youtube_search(query):
+    from pytubefix import Search
+    return Search(query).results
+
+
+def _youtube_video(video_id):
+    from pytubefix import YouTube
+    return YouTube(f"https://www.youtube.com/watch?v={video_id}")
+
+
+@database.schema
+def _create_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS search_results (
+            key TEXT PRIMARY KEY,
+            video_ids TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS search_inflight (
+            key TEXT PRIMARY KEY,
+            started_at REAL NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS search_videos (
+            video_id TEXT PRIMARY KEY,
+            metadata TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    """)
+
+
+def _claim_shared(key):
+    """Return (video_ids, expires_at, waited) for a fresh shared entry, or
+    (None, None, waited) once this process holds the key's in-flight marker.
+
+    While another process's marker is younger than SEARCH_WAIT, waits for
+    its results; a marker that old is taken over.
+    """
+    waited = False
+    while True:
+        now = time.time()
+        with closing(database.connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT video_ids, expires_at FROM search_results "
+                               "WHERE key = ? AND expires_at > ?", (key, now)).fetchone()
+            if row is not None:
+                conn.execute("COMMIT")
+                return json.loads(row['video_ids']), row['expires_at'], waited
+            marker = conn.execute("SELECT started_at FROM search_inflight WHERE key = ?",
+                                  (key,)).fetchone()
+            if marker is None or marker['started_at'] <= now - SEARCH_WAIT:
+                conn.execute("INSERT OR REPLACE INTO search_inflight (key, started_at) VALUES (?, ?)",
+                             (key, now))
+                conn.execute("COMMIT")
+                return None, None, waited
+            conn.execute("COMMIT")
+        waited = True
+        time.sleep(POLL_INTERVAL)
+
+
+def _release_shared(key, results=None, expires_at=None):
+    """Drop this process's in-flight marker, storing non-empty results"""
+    with closing(database.connect()) as conn:
+        conn.execute("BEGIN IMMEDIATE")
+        if results:
+            conn.execute("INSERT OR REPLACE INTO search_results (key, video_ids, expires_at) VALUES (?, ?, ?)",
+                         (key, json.dumps([video.video_id for video in results]), expires_at))
+            _write_videos(conn, results, expires_at)
+            conn.execute("DELETE FROM search_results WHERE expires_at <= ?", (time.time(),))
+            conn.execute("DELETE FROM search_videos WHERE expires_at <= ?", (time.time(),))
+        conn.execute("DELETE FROM search_inflight WHERE key = ?", (key,))
+        conn.execute("COMMIT")
+
+
+def _write_videos(conn, videos, expires_at):
+    """Merge the videos' metadata into what is stored (inside a transaction),
+    so processes resolving different fields don't drop each other's"""
+    for video in videos:
+        row = conn.execute("SELECT metadata FROM search_videos WHERE video_id = ?",
+                           (video.video_id,)).fetchone()
+        metadata = json.loads(row['metadata']) if row else {}
+        metadata.update(video.describe())
+        conn.execute("INSERT OR REPLACE INTO search_videos (video_id, metadata, expires_at) "
+                     "VALUES (?, ?, ?)", (video.video_id, json.dumps(metadata), expires_at))
+
+
+def _store_videos(videos, expires_at):
+    """Share the metadata resolved for results so far; best effort"""
+    try:
+        with closing(database.connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            _write_videos(conn, videos, expires_at)
+            conn.execute("COMMIT")
+    except sqlite3.Error:
+        pass  # other processes just resolve it themselves
+
+
+def _load_videos(video_ids, expires_at, video_fn):
+    """Rebuild shared results from the metadata stored for them"""
+    with closing(database.connect()) as conn:
+        rows = conn.execute(
+            f"SELECT video_id, metadata FROM search_videos WHERE video_id IN "
+            f"({', '.join('?' * len(video_ids))}) AND expires_at > ?",
+            (*video_ids, time.time())
+        ).fetchall()
+    stored = {row['video_id']: json.loads(row['metadata']) for row in rows}
+    return [CachedVideo(video_id, load=lambda video_id=video_id: video_fn(video_id),
+                        metadata=stored.get(video_id), shared_until=expires_at)
+            for video_id in video_ids]
+
+
+def normalize(singer_name):
+    """Normalise an artist name into a cache key"""
+    return ' '.join(singer_name.lower().split())
+
+
+def stats():
+    """Return a copy of this process's search cache counters"""
+    with _lock:
+        return dict(_counters, entries=len(_entries))
+
+
+def _remember(key, results, expires_at):
+    with _lock:
+        now = time.time()
+        for stale in [k for k, (expires, _) in _entries.items() if expires <= now]:
+            del _entries[stale]
+        _entries[key] = (expires_at, results)
+
+
+def search(singer_name, ttl=None, search_fn=_youtube_search, video_fn=_youtube_video):
+    """Return search results for an artist, from the cache when still fresh.
+
+    Only one search per artist runs at a time (across processes once
+    configured); concurrent callers wait for it and share its results.
+    Results cached by another process are rebuilt from the metadata stored
+    for them; video_fn(video_id) fetches whatever was not resolved yet.
+    Empty results and errors are not cached.
+    """
+    ttl = SEARCH_TTL if ttl is None else ttl
+    key = normalize(singer_name)
+
+    with _lock:
+        entry = _entries.get(key)
+        if entry and entry[0] > time.time():
+            _counters['hits'] += 1
+            return entry[1]
+
+        pending = _inflight.get(key)
+        leader = pending is None
+        if leader:
+            pending = _inflight[key] = _PendingSearch()
+        else:
+            _counters['coalesced'] += 1
+
+    if not leader:
+        pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.results
+
+    shared = database.configured()
+    try:
+        if shared:
+            video_ids, expires_at, waited = _claim_shared(key)
+            if video_ids is not None:
+                results = _load_videos(video_ids, expires_at, video_fn)
+                with _lock:
+                    _counters['coalesced' if waited else 'hits'] += 1
+                _remember(key, results, expires_at)
+                pending.results = results
+                shared = False  # no marker to release
+                return results
+
+        with _lock:
+            _counters['misses'] += 1
+        expires_at = time.time() + ttl
+        results = [CachedVideo(video.video_id, video=video, shared_until=expires_at if shared else None)
+                   for video in (search_fn(singer_name) or [])]
+        pending.results = results
+        if results:
+            _remember(key, results, expires_at)
+        if shared:
+            shared = False
+            _release_shared(key, results, expires_at)
+        return results
+    except Exception as e:
+        pending.error = e
+        raise
+    finally:
+        if shared:
+            _release_shared(key)
+        with _lock:
+            _inflight.pop(key, None)
+        pending.done.set()
@@ -0,0 +1,139 @@
+"""
+Pick which part of each track goes into the mashup.
+
+The default mode keeps the first Y seconds of every track. The "energy" mode
+instead keeps the Y-second window with the most energy, which is usually the
+chorus rather than a quiet intro or a spoken segment. The track is decoded
+once to low-rate mono, reduced to an envelope of RMS loudness plus onset
+strength (positive spectral flux) per 100 ms frame, and the best window is
+found with a cumulative sum over that envelope.
+
+Envelopes are cached per video id next to the clip cache, so any later job
+(with any Y) picks its window without decoding the track again.
+"""
+
+import hashlib
+import os
+import subprocess
+import tempfile
+import time
+
+import clip_cache
+from audio_engine import get_ffmpeg, EngineError
+
+# Segment selection configuration (override with environment variables)
+SEGMENT_MODE = os.environ.get("MASHUP_SEGMENT_MODE", "start")  # "start" or "energy"
+SEGMENT_MODES = ('start', 'energy')
+ANALYSIS_RATE = 8000  # Hz, mono
+FRAME_SECONDS = 0.1  # envelope resolution
+ONSET_WEIGHT = 0.5  # onset strength relative to RMS in the envelope
+
+ENVELOPE_DIR = clip_cache.add_folder('envelope', "envelopes")
+
+
+def _envelope_path(video_id):
+    return os.path.join(ENVELOPE_DIR, hashlib.sha1(video_id.encode('utf-8')).hexdigest() + ".npy")
+
+
+def decode_mono(path, rate=ANALYSIS_RATE, seconds=None):
+    """Decode a file (or its first `seconds`) to a float32 mono NumPy array at `rate` Hz"""
+    import numpy as np
+    cmd = [get_ffmpeg(), '-hide_banner', '-nostdin', '-loglevel', 'error', '-i', path,
+           '-map', '0:a:0', '-ac', '1', '-ar', str(rate)]
+    if seconds:
+        cmd += ['-t', str(seconds)]
+    cmd += ['-f', 's16le', 'pipe:1']
+    try:
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as e:
+        raise EngineError(f"Could not run ffmpeg: {str(e)}")
+    if proc.returncode != 0:
+        raise EngineError(f"ffmpeg exited with code {proc.returncode}: "
+                          f"{proc.stderr.decode('utf-8', errors='replace').strip()[-500:]}")
+    return np.frombuffer(proc.stdout, dtype='<i2').astype(np.float32) / 32768.0
+
+
+def energy_envelope(samples, rate=ANALYSIS_RATE, frame_seconds=FRAME_SECONDS):
+    """Return one score per frame: normalized RMS plus weighted onset strength"""
+    import numpy as np
+    hop = int(rate * frame_seconds)
+    count = len(samples) // hop
+    if count < 2:
+        return np.zeros(count, dtype=np.float32)
+    frames = samples[:count * hop].reshape(count, hop)
+
+    rms = np.sqrt(np.mean(frames * frames, axis=1))
+    spectrum = np.abs(np.fft.rfft(frames * np.hanning(hop).astype(np.float32), axis=1))
+    flux = np.concatenate(([0.0], np.maximum(np.diff(spectrum, axis=0), 0).sum(axis=1)))
+
+    envelope = rms / (rms.max() or 1.0) + ONSET_WEIGHT * flux / (flux.max() or 1.0)
+    return envelope.astype(np.float32)
+
+
+def best_window(envelope, duration, frame_seconds=FRAME_SECONDS):
+    """Return the start (seconds) of the `duration`-second window with the highest energy"""
+    import numpy as np
+    width = int(round(duration / frame_seconds))
+    if width <= 0 or len(envelope) <= width:
+        return 0.0
+    totals = np.cumsum(np.concatenate(([0.0], envelope)))
+    sums = totals[width:] - totals[:-width]
+    return round(int(np.argmax(sums)) * frame_seconds, 3)
+
+
+def load_envelope(video_id):
+    """Return the cached envelope of a video, or None"""
+    import numpy as np
+    path = _envelope_path(video_id)
+    try:
+        envelope = np.load(path)
+        os.utime(path)
+        return envelope
+    except (OSError, ValueError):
+        return None
+
+
+def save_envelope(video_id, envelope):
+    """Atomically store the envelope of a video"""
+    import numpy as np
+    os.makedirs(ENVELOPE_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=ENVELOPE_DIR, prefix=".tmp-", suffix=".npy")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, envelope)
+        os.replace(tmp_path, _envelope_path(video_id))
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def cached_start(video_id, duration):
+    """Return the best window start for a video from its cached envelope, or None"""
+    envelope = load_envelope(video_id) if video_id else None
+    if envelope is None:
+        return None
+    return best_window(envelope, duration)
+
+
+def select_window(path, duration, video_id=None, cache=clip_cache.CACHE_ENABLED, log=print):
+    """Return the start (seconds) of the most energetic `duration`-second window of path.
+
+    Falls back to 0 (the start of the track) if the analysis fails.
+    """
+    envelope = load_envelope(video_id) if cache and video_id else None
+    if envelope is None:
+        started = time.perf_counter()
+        try:
+            envelope = energy_envelope(decode_mono(path))
+        except (EngineError, ImportError) as e:
+            log(f"Warning: Could not analyse {os.path.basename(path)}, "
+                f"keeping its first {duration}s: {str(e)}")
+            return 0.0
+        if cache and video_id:
+            try:
+                save_envelope(video_id, envelope)
+            except OSError as e:
+                log(f"Warning: Could not cache envelope of {os.path.basename(path)}: {str(e)}")
+        log(f"Analysed {os.path.basename(path)} in {time.perf_counter() - started:.2f}s")
+    return best_window(envelope, duration)
@@ -0,0 +1,208 @@
+"""
+Structured logging, timing spans and Prometheus metrics.
+
+Log lines are JSON objects (one per line on stdout) carrying the job ID.
+Spans time one stage of a job (search, download, decode, export, zip,
+email, ...), log its outcome and record it in the metrics. Metric values are
+kept in SQLite, normally the job queue database, so samples recorded by the
+queue worker processes and the mailer are all visible to whichever web
+process serves /metrics. render() produces the Prometheus text format.
+
+Nothing is recorded or logged by spans until database.configure() is called,
+so the command-line tool keeps its plain output.
+"""
+
+import json
+import math
+import os
+import sqlite3
+import time
+from contextlib import closing, contextmanager
+
+import database
+
+DURATION_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+BYTES_BUCKETS = (64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2)
+
+# name -> (type, help, histogram buckets)
+METRICS = {
+    'mashup_stage_duration_seconds': ('histogram', "Time spent in each job stage", DURATION_BUCKETS),
+    'mashup_stage_failures_total': ('counter', "Stage runs that raised an error, by stage", None),
+    'mashup_download_bytes': ('histogram', "Bytes fetched per downloaded track", BYTES_BUCKETS),
+    'mashup_jobs_total': ('counter', "Finished jobs by outcome", None),
+    'mashup_tracks_skipped_total': ('counter', "Search results left out of mashups, by reason", None),
+    'mashup_queue_wait_seconds': ('histogram', "Time jobs waited in the queue before a worker took them",
+                                  DURATION_BUCKETS + (1800, 3600)),
+    'mashup_rate_limited_total': ('counter', "Job submissions refused by a rate limit, by scope", None),
+    'mashup_preview_first_audio_seconds': ('histogram', "Time from a preview request to its first audio bytes",
+                                           DURATION_BUCKETS),
+    'mashup_queue_depth': ('gauge', "Jobs waiting in the queue", None),
+    'mashup_active_jobs': ('gauge', "Jobs currently running", None),
+    'mashup_mail_outbox': ('gauge', "Outbox messages by status", None),
+    'mashup_clip_cache_total': ('counter', "Clip cache lookups, stores and evictions, by kind and result", None),
+}
+
+@database.schema
+def _create_tables(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS metrics (
+            name TEXT NOT NULL,
+            labels TEXT NOT NULL,
+            value REAL NOT NULL,
+            PRIMARY KEY (name, labels)
+        )
+    """)
+
+
+# ---------------------------------------------------------------------------
+# Logging
+# ---------------------------------------------------------------------------
+
+def log(message, job_id=None, level='info', **fields):
+    """Write one JSON log line"""
+    record = {
+        'ts': round(time.time(), 3),
+        'level': level,
+        'job_id': job_id,
+        'pid': os.getpid(),
+        'msg': message,
+    }
+    record.update(fields)
+    print(json.dumps(record, default=str), flush=True)
+
+
+def log_job(job_id, message, level=None, **fields):
+    """Write a log line for a job; without an explicit level, messages that
+    mention an error or a warning are logged at that level"""
+    if level is None:
+        lowered = message.lower()
+        level = 'error' if 'error' in lowered else 'warning' if 'warning' in lowered else 'info'
+    log(message, job_id=job_id, level=level, **fields)
+
+
+def job_logger(job_id):
+    """Return a log(message) callback bound to a job, for the log= parameters"""
+    return lambda message, **fields: log_job(job_id, message, **fields)
+
+
+# ---------------------------------------------------------------------------
+# Metrics
+# ---------------------------------------------------------------------------
+
+def _labels(labels):
+    return ','.join(f'{key}="{_escape(value)}"' for key, value in sorted(labels.items()))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _add(rows):
+    """Add (name, labels, amount) rows in one transaction"""
+    if not database.configured():
+        return
+    try:
+        with closing(database.connect()) as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.executemany(
+                "INSERT INTO metrics (name, labels, value) VALUES (?, ?, ?) "
+                "ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value",
+                rows
+            )
+            conn.execute("COMMIT")
+    except sqlite3.Error as e:
+        # Metrics must never fail a job
+        log(f"Warning - could not record metrics: {str(e)}", level='warning')
+
+
+def inc(name, amount=1, **labels):
+    """Increment a counter"""
+    _add([(name, _labels(labels), amount)])
+
+
+def observe(name, value, **labels):
+    """Record one histogram sample"""
+    base = _labels(labels)
+    prefix = f"{base}," if base else ''
+    rows = [
+        (f"{name}_bucket", f'{prefix}le="{bound}"', 1 if value <= bound else 0)
+        for bound in METRICS[name][2]
+    ]
+    rows.append((f"{name}_bucket", f'{prefix}le="+Inf"', 1))
+    rows.append((f"{name}_sum", base, value))
+    rows.append((f"{name}_count", base, 1))
+    _add(rows)
+
+
+@contextmanager
+def span(stage, job_id=None, **fields):
+    """Time a stage: record its duration (and failure), and log the outcome.
+
+    Yields a dict; keys added to it are included in the log line.
+    """
+    extra = {}
+    started = time.perf_counter()
+    try:
+        yield extra
+    except BaseException as e:
+        elapsed = time.perf_counter() - started
+        if database.configured():
+            observe('mashup_stage_duration_seconds', elapsed, stage=stage)
+            inc('mashup_stage_failures_total', stage=stage)
+            log(f"{stage} failed", job_id=job_id, level='error', stage=stage,
+                duration=round(elapsed, 3), error=str(e), **fields, **extra)
+        raise
+    elapsed = time.perf_counter() - started
+    if database.configured():
+        observe('mashup_stage_duration_seconds', elapsed, stage=stage)
+        log(f"{stage} finished", job_id=job_id, stage=stage, duration=round(elapsed, 3),
+            **fields, **extra)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(int(value)) if float(value).is_integer() else repr(value)
+
+
+def _sort_key(row):
+    """Group series by labels; within a histogram: buckets by bound, then _sum, _count"""
+    name, labels, _ = row
+    if name.endswith('_bucket'):
+        other_labels, _, le = labels.rpartition('le="')
+        le = le.rstrip('"')
+        return (other_labels.rstrip(','), 0, math.inf if le == '+Inf' else float(le))
+    return (labels, 1 if name.endswith('_sum') else 2, 0)
+
+
+def render(gauges=None):
+    """Return every metric in the Prometheus text exposition format.
+
+    `gauges` maps a gauge name to a value, or to a {labels dict as tuple: value}
+    mapping, sampled by the caller at scrape time.
+    """
+    rows = []
+    if database.configured():
+        with closing(database.connect()) as conn:
+            rows = conn.execute("SELECT name, labels, value FROM metrics").fetchall()
+    for name, value in (gauges or {}).items():
+        if isinstance(value, dict):
+            rows.extend((name, _labels(dict(labels)), v) for labels, v in value.items())
+        else:
+            rows.append((name, '', value))
+
+    lines = []
+    for metric, (metric_type, help_text, _) in METRICS.items():
+        series = [
+            row for row in rows
+            if row[0] == metric or (metric_type == 'histogram' and row[0] in
+                                    (f"{metric}_bucket", f"{metric}_sum", f"{metric}_count"))
+        ]
+        if not series and metric_type != 'gauge':
+            continue
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {metric_type}")
+        for name, labels, value in sorted(series, key=_sort_key):
+            lines.append(f"{name}{{{labels}}} {_format_value(value)}" if labels
+                         else f"{name} {_format_value(value)}")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,139 @@
+"""
+Shared fixtures and stand-ins for the test suite.
+
+The modules live at the top of the repository, so it is put on sys.path
+here. Nothing in the suite touches YouTube or a real SMTP server: videos and
+streams are faked with configurable latency and failures.
+"""
+
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import database  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    """Point every module at a fresh shared database for one test"""
+    monkeypatch.setattr(database, '_path', database._path)
+    database.configure(str(tmp_path / 'jobs.db'))
+    return database.path()
+
+
+class FakeStream:
+    """Audio stream whose download sleeps `latency` seconds and raises
+    `failures` times before writing `payload`"""
+
+    def __init__(self, payload=b'audio', latency=0.0, failures=0, url=None, bitrate=None,
+                 filesize=None):
+        self.payload = payload
+        self.latency = latency
+        self.failures = failures
+        self.url = url
+        self.bitrate = bitrate
+        self.filesize = filesize
+        self.attempts = 0
+        self.tracker = None
+
+    def download(self, output_path, filename):
+        self.attempts += 1
+        if self.tracker:
+            self.tracker.enter()
+        try:
+            threading.Event().wait(self.latency)  # time.sleep may be patched by a test
+            if self.attempts <= self.failures:
+                raise ConnectionError(f"injected failure {self.attempts}")
+            path = os.path.join(output_path, filename)
+            with open(path, 'wb') as f:
+                f.write(self.payload)
+            return path
+        finally:
+            if self.tracker:
+                self.tracker.leave()
+
+
+class ConcurrencyTracker:
+    """Records the highest number of downloads running at once"""
+
+    def __init__(self):
+        self.active = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def enter(self):
+        with self._lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+
+    def leave(self):
+        with self._lock:
+            self.active -= 1
+
+
+class _Streams:
+    def __init__(self, stream):
+        self._stream = stream
+
+    def filter(self, only_audio=False):
+        return self
+
+    def first(self):
+        return self._stream
+
+
+class FakeVideo:
+    """Just enough of pytubefix.YouTube for the downloader"""
+
+    def __init__(self, video_id, stream=None, title=None):
+        self.video_id = video_id
+        self.title = title or f"Track {video_id}"
+        self.stream = stream
+        self.streams = _Streams(stream)
+
+
+class FakeSMTP:
+    """SMTP connection that answers each sendmail with the next of `outcomes`
+    (None accepts the message, an exception instance is raised)"""
+
+    def __init__(self, outcomes=()):
+        self.outcomes = list(outcomes)
+        self.sent = []
+        self.closed = False
+
+    def sendmail(self, sender, recipients, message):
+        outcome = self.outcomes.pop(0) if self.outcomes else None
+        if outcome is not None:
+            raise outcome
+        self.sent.append((sender, recipients, message))
+        return {}
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+@pytest.fixture(scope='session')
+def _app_module(tmp_path_factory):
+    # app.py configures itself on import, relative to the working directory
+    with pytest.MonkeyPatch.context() as mp:
+        mp.chdir(tmp_path_factory.mktemp('app'))
+        mp.setenv('SENDER_EMAIL', 'sender@example.com')
+        mp.setenv('SENDER_PASSWORD', 'secret')
+        mp.setattr(database, '_path', database._path)
+        import app
+    return app
+
+
+@pytest.fixture
+def app(_app_module, db, tmp_path, monkeypatch):
+    """The web app on a fresh database, without its background threads"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(_app_module, 'start_background', lambda: None)
+    return _app_module
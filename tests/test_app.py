@@ -0,0 +1,81 @@
+"""Web endpoints: rate limits, coalescing of identical requests and event streams."""
+
+import threading
+
+import pytest
+
+import job_queue
+import mailer
+import rate_limit
+import workspace
+
+
+def _submit(client, email, ip='203.0.113.7', singer='Some Singer'):
+    return client.post('/create-mashup', data={
+        'singer_name': singer, 'num_videos': '11', 'duration': '21', 'email': email,
+    }, environ_base={'REMOTE_ADDR': ip})
+
+
+@pytest.fixture
+def client(app):
+    return app.app.test_client()
+
+
+def test_attaching_to_a_finished_job_still_costs_an_ip_token(client, monkeypatch):
+    monkeypatch.setitem(rate_limit.LIMITS, 'ip', (3, 1))
+    first = _submit(client, 'first@example.com')
+    assert first.status_code == 200
+    job_queue._finish(first.json['task_id'], 'done')
+
+    statuses = [_submit(client, f"user{i}@example.com").status_code for i in range(10)]
+
+    assert statuses == [200, 200] + [429] * 8
+    assert job_queue.queue_stats() == {'done': 1, 'queued': 1}  # one delivery for both attaches
+
+
+def test_attaching_gives_back_the_email_token(client, monkeypatch):
+    monkeypatch.setitem(rate_limit.LIMITS, 'email', (2, 1))
+    statuses = [_submit(client, 'same@example.com', ip=f"198.51.100.{i}").status_code
+                for i in range(5)]
+    assert statuses == [200] * 5
+    assert job_queue.queue_stats() == {'queued': 1}
+
+
+def test_full_queue_gives_back_every_token(client, monkeypatch):
+    monkeypatch.setitem(rate_limit.LIMITS, 'ip', (1, 1))
+    monkeypatch.setattr(job_queue, 'MAX_QUEUED', 0)
+    assert _submit(client, 'a@example.com').status_code == 429
+    monkeypatch.setattr(job_queue, 'MAX_QUEUED', 20)
+    assert _submit(client, 'a@example.com').status_code == 200
+
+
+def test_queued_jobs_hold_their_workspace_estimate(client, monkeypatch):
+    monkeypatch.setattr(workspace, 'QUOTA_BYTES', workspace.estimate_job_bytes(11, 21) * 3 // 2)
+    assert _submit(client, 'a@example.com').status_code == 200
+    assert _submit(client, 'b@example.com', ip='198.51.100.1', singer='Other Singer').status_code == 503
+
+
+def test_follow_up_delivery_of_a_failed_job_sends_the_error(app):
+    job_queue.submit('a', ['Some Singer', 11, 21, 'x@example.com', 'a'], dedupe_key='k',
+                     subscriber='x@example.com', followup='deliver')
+    job_queue._claim('worker')
+    job_queue._finish('a', 'failed', 'No search results')
+
+    app.deliver_mashup('a')
+
+    assert mailer.outbox_stats() == {'pending': 1}
+    assert job_queue.claim_subscribers('a') == []
+
+
+def test_event_streams_are_capped(app, client, monkeypatch):
+    monkeypatch.setattr(app, '_sse_slots', threading.BoundedSemaphore(1))
+    task_id = _submit(client, 'a@example.com').json['task_id']
+
+    first = client.get(f"/jobs/{task_id}/events", buffered=False)
+    assert first.status_code == 200
+    assert next(first.response).startswith(b'data: ')
+    assert client.get(f"/jobs/{task_id}/events").status_code == 503
+
+    first.close()  # the client went away
+    job_queue._finish(task_id, 'done')
+    assert client.get(f"/jobs/{task_id}/events").status_code == 200
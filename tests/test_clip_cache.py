@@ -0,0 +1,45 @@
+"""Clip cache entries, eviction and the metrics they record."""
+
+import os
+
+import pytest
+
+import clip_cache
+import telemetry
+
+
+@pytest.fixture
+def cache_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(clip_cache, 'CACHE_DIR', str(tmp_path / 'cache'))
+    return tmp_path / 'cache'
+
+
+def _file(path, size):
+    with open(path, 'wb') as f:
+        f.write(b'\0' * size)
+    return str(path)
+
+
+def test_lookups_stores_and_evictions_are_recorded(db, cache_dir, tmp_path, monkeypatch):
+    monkeypatch.setattr(clip_cache, 'CACHE_MAX_BYTES', 150)
+    clip_cache.store(clip_cache.raw_key('a'), _file(tmp_path / 'a', 100))
+    assert clip_cache.lookup(clip_cache.raw_key('a'), str(tmp_path / 'hit'))
+    assert clip_cache.lookup(clip_cache.clip_key('a', 30), str(tmp_path / 'miss')) is None
+    clip_cache.store(clip_cache.clip_key('b', 30), _file(tmp_path / 'b', 100))  # evicts a
+
+    assert not os.path.exists(tmp_path / 'cache' / clip_cache.raw_key('a'))
+    metrics = telemetry.render()
+    for kind, result in [('raw', 'store'), ('raw', 'hit'), ('clip', 'miss'), ('clip', 'store'),
+                         ('raw', 'evict')]:
+        assert f'mashup_clip_cache_total{{kind="{kind}",result="{result}"}} 1' in metrics
+
+
+def test_folders_of_other_modules_are_evicted_too(cache_dir, tmp_path, monkeypatch):
+    monkeypatch.setitem(clip_cache._folders, 'extra', 'extra')
+    monkeypatch.setattr(clip_cache, 'CACHE_MAX_BYTES', 150)
+    os.makedirs(cache_dir / 'extra')
+    old = _file(cache_dir / 'extra' / 'old.npy', 100)
+    os.utime(old, (1, 1))
+    clip_cache.store(clip_cache.raw_key('a'), _file(tmp_path / 'a', 100))
+    assert not os.path.exists(old)
+    assert clip_cache.stats()['extra_evict'] >= 1
@@ -0,0 +1,99 @@
+"""Retry, backoff and partial-failure behaviour of the parallel downloader."""
+
+import os
+import time
+
+import pytest
+
+import downloader
+from conftest import ConcurrencyTracker, FakeStream, FakeVideo
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Record retry delays instead of waiting them out"""
+    delays = []
+    monkeypatch.setattr(downloader.time, 'sleep', delays.append)
+    return delays
+
+
+def test_retries_with_exponential_backoff(tmp_path, sleeps):
+    stream = FakeStream(payload=b'ok', failures=2)
+    path = downloader.download_audio(FakeVideo('a', stream), str(tmp_path), 'a.mp4',
+                                     retries=2, backoff=0.5, log=lambda msg: None)
+
+    assert stream.attempts == 3
+    assert sleeps == [0.5, 1.0]
+    with open(path, 'rb') as f:
+        assert f.read() == b'ok'
+
+
+def test_raises_after_retries_exhausted(tmp_path, sleeps):
+    stream = FakeStream(failures=10)
+    with pytest.raises(ConnectionError):
+        downloader.download_audio(FakeVideo('a', stream), str(tmp_path), 'a.mp4',
+                                  retries=3, backoff=1.0, log=lambda msg: None)
+
+    assert stream.attempts == 4
+    assert sleeps == [1.0, 2.0, 4.0]
+
+
+def test_missing_audio_stream_is_not_retried(tmp_path, sleeps):
+    path = downloader.download_audio(FakeVideo('a', None), str(tmp_path), 'a.mp4',
+                                     retries=2, log=lambda msg: None)
+    assert path is None
+    assert sleeps == []
+
+
+def test_partial_failure_keeps_search_order(tmp_path, sleeps):
+    streams = [
+        FakeStream(payload=b'0'),
+        FakeStream(failures=10),               # gives up
+        FakeStream(payload=b'2', failures=1),  # recovers on retry
+        None,                                  # no audio stream
+        FakeStream(payload=b'4'),
+    ]
+    videos = [FakeVideo(f"v{i}", stream) for i, stream in enumerate(streams)]
+    progress = []
+
+    paths = downloader.download_all(videos, str(tmp_path), workers=2, retries=1, backoff=0,
+                                    cache=False, segment='start',
+                                    on_progress=lambda i, path, fetched: progress.append((i, fetched)),
+                                    log=lambda msg: None)
+
+    assert [p is not None for p in paths] == [True, False, True, False, True]
+    for i in (0, 2, 4):
+        assert os.path.basename(paths[i]) == f"video_{i}.mp4"
+        with open(paths[i], 'rb') as f:
+            assert f.read() == str(i).encode()
+    assert sorted(progress) == [(0, 1), (1, 0), (2, 1), (3, 0), (4, 1)]
+    assert streams[1].attempts == 2
+
+
+def test_failing_progress_callback_does_not_fail_downloads(tmp_path):
+    def on_progress(i, path, fetched):
+        raise RuntimeError("callback broke")
+
+    videos = [FakeVideo(f"v{i}", FakeStream()) for i in range(3)]
+    paths = downloader.download_all(videos, str(tmp_path), workers=3, cache=False,
+                                    segment='start', on_progress=on_progress,
+                                    log=lambda msg: None)
+    assert all(paths)
+
+
+def test_downloads_overlap_up_to_worker_count(tmp_path):
+    tracker = ConcurrencyTracker()
+    videos = []
+    for i in range(8):
+        stream = FakeStream(latency=0.2)
+        stream.tracker = tracker
+        videos.append(FakeVideo(f"v{i}", stream))
+
+    started = time.perf_counter()
+    paths = downloader.download_all(videos, str(tmp_path), workers=4, cache=False,
+                                    segment='start', log=lambda msg: None)
+    elapsed = time.perf_counter() - started
+
+    assert all(paths)
+    assert tracker.peak == min(4, downloader.GLOBAL_DOWNLOAD_LIMIT)
+    assert elapsed < 8 * 0.2 / 2  # serially this would take 1.6s
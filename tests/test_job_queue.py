@@ -0,0 +1,85 @@
+"""Job queue coalescing, subscribers and follow-up deliveries."""
+
+import json
+import time
+from contextlib import closing
+
+import database
+import job_queue
+
+
+def _submit(job_id, subscriber):
+    return job_queue.submit(job_id, ['x'], dedupe_key='k', subscriber=subscriber, followup='deliver')
+
+
+def _queued(kind):
+    with closing(database.connect()) as conn:
+        return [(row['kind'], json.loads(row['args'])) for row in conn.execute(
+            "SELECT kind, args FROM jobs WHERE status = 'queued' AND kind = ?", (kind,))]
+
+
+def test_identical_jobs_are_coalesced(db):
+    first = _submit('a', 'one@example.com')
+    second = _submit('b', 'two@example.com')
+    assert (first['attached'], second['attached'], second['job_id']) == (False, True, 'a')
+    assert job_queue.claim_subscribers('a') == ['one@example.com', 'two@example.com']
+    assert job_queue.claim_subscribers('a') == []
+
+
+def test_finishing_with_everyone_notified_queues_nothing(db):
+    _submit('a', 'one@example.com')
+    job_queue._claim('worker')
+    job_queue.claim_subscribers('a')
+    job_queue._finish('a', 'done')
+    assert _queued('deliver') == []
+
+
+def test_subscriber_attaching_while_job_finishes_gets_a_delivery(db):
+    _submit('a', 'one@example.com')
+    job_queue._claim('worker')
+    assert job_queue.claim_subscribers('a') == ['one@example.com']  # the job's last claim
+    assert _submit('b', 'late@example.com')['status'] == 'running'
+
+    job_queue._finish('a', 'done')
+
+    assert _queued('deliver') == [('deliver', ['a'])]
+
+
+def test_failed_job_with_unclaimed_subscribers_gets_a_delivery(db):
+    _submit('a', 'one@example.com')
+    job_queue._claim('worker')
+    job_queue._finish('a', 'failed', 'boom')
+    assert _queued('deliver') == [('deliver', ['a'])]
+
+
+def test_one_waiting_delivery_per_finished_job(db):
+    _submit('a', 'one@example.com')
+    job_queue._claim('worker')
+    job_queue.claim_subscribers('a')
+    job_queue._finish('a', 'done')
+
+    assert _submit('b', 'two@example.com')['status'] == 'done'
+    assert _submit('c', 'three@example.com')['attached']
+    assert _submit('d', 'two@example.com')['attached']
+    assert _queued('deliver') == [('deliver', ['a'])]
+
+    # Once it runs it may already have claimed its subscribers, so a new one queues
+    job_queue._claim('worker')
+    _submit('e', 'four@example.com')
+    assert _queued('deliver') == [('deliver', ['a'])]
+    assert job_queue.queue_stats() == {'done': 1, 'running': 1, 'queued': 1}
+
+
+def test_pruning_keeps_jobs_with_a_pending_follow_up(db):
+    job_queue.submit('c', ['y'], dedupe_key='other', subscriber='three@example.com')
+    job_queue._claim('worker')
+    job_queue._finish('c', 'failed', 'boom')
+    _submit('a', 'one@example.com')
+    job_queue._claim('worker')
+    job_queue._finish('a', 'done')  # one@ was never claimed: a delivery is queued
+    job_queue.submit('d', ['z'], dedupe_key='queued')
+
+    assert job_queue.prune(time.time() + 1) == 1  # c; a waits for its delivery
+    assert job_queue.queue_stats() == {'done': 1, 'queued': 2}
+    assert job_queue.claim_subscribers('a') == ['one@example.com']
+    assert job_queue.claim_subscribers('c') == []
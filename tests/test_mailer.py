@@ -0,0 +1,160 @@
+"""Outbox delivery, retry with backoff, dead-lettering and leases."""
+
+import smtplib
+import time
+from contextlib import closing
+from email.mime.text import MIMEText
+
+import pytest
+
+import database
+import mailer
+from conftest import FakeSMTP
+
+BACKOFF = 10.0
+MAX_ATTEMPTS = 3
+
+
+@pytest.fixture
+def outbox(db, monkeypatch):
+    """A fresh outbox whose connections are FakeSMTP servers from `outbox.servers`"""
+    monkeypatch.setattr(mailer, '_smtp', dict(mailer._smtp))
+    monkeypatch.setattr(mailer, 'MAIL_RETRY_BACKOFF', BACKOFF)
+    monkeypatch.setattr(mailer, 'MAIL_MAX_ATTEMPTS', MAX_ATTEMPTS)
+    mailer.configure('localhost', 25, starttls=False)
+
+    class Outbox:
+        servers = []  # FakeSMTP instances handed out, each preloaded from `outcomes`
+        outcomes = []
+
+        @staticmethod
+        def row(mail_id):
+            with closing(database.connect()) as conn:
+                return dict(conn.execute("SELECT * FROM outbox WHERE id = ?", (mail_id,)).fetchone())
+
+        @staticmethod
+        def update(mail_id, **values):
+            assignments = ", ".join(f"{column} = ?" for column in values)
+            with closing(database.connect()) as conn:
+                conn.execute(f"UPDATE outbox SET {assignments} WHERE id = ?", (*values.values(), mail_id))
+
+    def open_connection():
+        server = FakeSMTP(Outbox.outcomes)
+        Outbox.outcomes = []
+        Outbox.servers.append(server)
+        return server
+
+    monkeypatch.setattr(mailer, 'open_connection', open_connection)
+    return Outbox
+
+
+def _enqueue(to='someone@example.com'):
+    msg = MIMEText("Your mashup is ready")
+    msg['From'] = 'sender@example.com'
+    msg['To'] = to
+    msg['Subject'] = 'Mashup'
+    return mailer.enqueue(msg)
+
+
+def test_batch_is_sent_over_one_connection(outbox):
+    ids = [_enqueue(f"user{i}@example.com") for i in range(3)]
+
+    server = mailer._send_batch(mailer._claim_batch(10), None)
+
+    assert outbox.servers == [server]
+    assert [recipients for _, recipients, _ in server.sent] == \
+        [[f"user{i}@example.com"] for i in range(3)]
+    assert all('Message-ID: ' in message for _, _, message in server.sent)
+    assert mailer.outbox_stats() == {'sent': 3}
+    assert all(outbox.row(mail_id)['lease'] is None for mail_id in ids)
+
+
+def test_failed_send_is_retried_with_exponential_backoff(outbox):
+    mail_id = _enqueue()
+    outbox.outcomes = [smtplib.SMTPServerDisconnected("gone")]
+
+    before = time.time()
+    assert mailer._send_batch(mailer._claim_batch(10), None) is None  # connection dropped
+    assert outbox.servers[0].closed
+    row = outbox.row(mail_id)
+    assert (row['status'], row['attempts'], row['last_error']) == ('pending', 1, 'gone')
+    assert before + BACKOFF <= row['next_attempt_at'] <= time.time() + BACKOFF
+    assert mailer._claim_batch(10) == []  # not due yet
+
+    outbox.update(mail_id, next_attempt_at=0)
+    outbox.outcomes = [smtplib.SMTPServerDisconnected("gone again")]
+    before = time.time()
+    mailer._send_batch(mailer._claim_batch(10), None)
+    row = outbox.row(mail_id)
+    assert row['attempts'] == 2
+    assert row['next_attempt_at'] >= before + 2 * BACKOFF
+
+    outbox.update(mail_id, next_attempt_at=0)
+    mailer._send_batch(mailer._claim_batch(10), None)
+    assert outbox.row(mail_id)['status'] == 'sent'
+    assert outbox.row(mail_id)['attempts'] == 3
+
+
+def test_message_is_dead_lettered_after_max_attempts(outbox):
+    mail_id = _enqueue()
+    for _ in range(MAX_ATTEMPTS):
+        outbox.outcomes = [smtplib.SMTPServerDisconnected("gone")]
+        outbox.update(mail_id, next_attempt_at=0)
+        mailer._send_batch(mailer._claim_batch(10), None)
+
+    row = outbox.row(mail_id)
+    assert (row['status'], row['attempts'], row['last_error']) == ('failed', MAX_ATTEMPTS, 'gone')
+    outbox.update(mail_id, next_attempt_at=0)
+    assert mailer._claim_batch(10) == []
+    assert mailer.outbox_stats() == {'failed': 1}
+
+
+def test_refused_recipient_keeps_the_connection(outbox):
+    refused = _enqueue('nobody@example.com')
+    accepted = _enqueue('someone@example.com')
+    outbox.outcomes = [smtplib.SMTPRecipientsRefused({'nobody@example.com': (550, b'no such user')})]
+
+    server = mailer._send_batch(mailer._claim_batch(10), None)
+
+    assert outbox.servers == [server] and not server.closed
+    assert outbox.row(refused)['status'] == 'pending'
+    assert outbox.row(accepted)['status'] == 'sent'
+
+
+def test_stale_claim_is_taken_back_and_old_sender_skips_it(outbox):
+    mail_id = _enqueue()
+    stalled = mailer._claim_batch(10)
+    outbox.update(mail_id, claimed_at=time.time() - mailer.stale_after() - 1)
+
+    reclaimed = mailer._claim_batch(10)  # another sender takes it back
+    assert [m['id'] for m in reclaimed] == [mail_id]
+    assert reclaimed[0]['lease'] != stalled[0]['lease']
+    assert outbox.row(mail_id)['attempts'] == 1  # the stalled claim counts as an attempt
+
+    assert mailer._send_batch(stalled, None) is None  # lease lost: nothing sent or opened
+    assert outbox.servers == []
+
+    server = mailer._send_batch(reclaimed, None)
+    assert len(server.sent) == 1
+    assert outbox.row(mail_id)['status'] == 'sent'
+
+    mailer._mark_failed(stalled[0], RuntimeError("late"))  # an outdated lease changes nothing
+    assert outbox.row(mail_id)['status'] == 'sent'
+
+
+def test_stale_claim_on_last_attempt_is_dead_lettered(outbox):
+    mail_id = _enqueue()
+    mailer._claim_batch(10)
+    outbox.update(mail_id, attempts=MAX_ATTEMPTS - 1,
+                  claimed_at=time.time() - mailer.stale_after() - 1)
+
+    assert mailer._claim_batch(10) == []
+    row = outbox.row(mail_id)
+    assert (row['status'], row['attempts'], row['last_error']) == \
+        ('failed', MAX_ATTEMPTS, 'Sender stopped')
+
+
+def test_stale_timeout_covers_several_smtp_timeouts(outbox, monkeypatch):
+    monkeypatch.setattr(mailer, 'MAIL_STALE_AFTER', 60)
+    monkeypatch.setitem(mailer._smtp, 'timeout', 30)
+    assert mailer.stale_after() == mailer.STALE_TIMEOUTS * 30
@@ -0,0 +1,41 @@
+"""Per-run memory measurement of long-lived processes."""
+
+import os
+import time
+
+import pytest
+
+from audio_engine import ProcessRSS
+
+pytestmark = pytest.mark.skipif(not os.path.exists('/proc/self/status'), reason="needs /proc")
+
+MB = 1024 * 1024
+
+
+def _touch(size):
+    block = bytearray(size)
+    block[::4096] = b'x' * len(block[::4096])  # make every page resident
+    return block
+
+
+def test_peak_is_per_run_not_process_lifetime():
+    del_me = _touch(200 * MB)  # an earlier, larger job
+    del del_me
+
+    with ProcessRSS() as rss:
+        block = _touch(20 * MB)
+        del block
+
+    assert rss.start_kb is not None
+    assert rss.peak_kb - rss.start_kb >= 15 * 1024
+    assert rss.peak_kb - rss.start_kb < 150 * 1024
+
+
+def test_overlapping_runs_fall_back_to_sampling():
+    with ProcessRSS() as outer:
+        with ProcessRSS(interval=0.01) as inner:
+            block = _touch(30 * MB)
+            time.sleep(0.1)
+            del block
+    assert inner.peak_kb - inner.start_kb >= 20 * 1024
+    assert outer.peak_kb >= inner.peak_kb - 1024  # the kernel updates its counters in batches
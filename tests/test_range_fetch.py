@@ -0,0 +1,131 @@
+"""Range fetches against a local server that does or does not honour Range."""
+
+import os
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import audio_engine
+import downloader
+from conftest import FakeStream
+
+BLOB = bytes(range(256)) * 4096  # 1 MiB, every offset distinguishable modulo 256
+
+
+class _Handler(BaseHTTPRequestHandler):
+    honour_range = True
+
+    def do_GET(self):
+        self.server.ranges.append(self.headers.get('Range'))
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range') or '')
+        if self.honour_range and match:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else len(BLOB) - 1
+            body = BLOB[start:end + 1]
+            self.send_response(206)
+            self.send_header('Content-Range', f"bytes {start}-{end}/{len(BLOB)}")
+        else:
+            body = BLOB
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client stops reading once it has its range
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _IgnoresRange(_Handler):
+    honour_range = False
+
+
+@pytest.fixture(params=[_Handler, _IgnoresRange], ids=['range', 'no-range'])
+def server(request):
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), request.param)
+    httpd.ranges = []
+    thread = threading.Thread(target=httpd.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    httpd.url = f"http://127.0.0.1:{httpd.server_address[1]}/audio"
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def test_fetch_from_start_truncates_to_range(server, tmp_path):
+    path = str(tmp_path / 'a.mp4')
+    assert downloader._fetch_range(server.url, path, 0, 999) == 1000
+    assert _read(path) == BLOB[:1000]
+    assert server.ranges == ['bytes=0-999']
+
+
+def test_fetch_from_offset_appends(server, tmp_path):
+    path = str(tmp_path / 'a.mp4')
+    downloader._fetch_range(server.url, path, 0, 99_999)
+    # Spans several read chunks, so a full 200 body must be skipped across chunks
+    assert downloader._fetch_range(server.url, path, 100_000, 299_999) == 200_000
+    assert _read(path) == BLOB[:300_000]
+
+
+def test_fetch_open_ended_reads_to_eof(server, tmp_path):
+    path = str(tmp_path / 'a.mp4')
+    downloader._fetch_range(server.url, path, 0, 511)
+    assert downloader._fetch_range(server.url, path, 512) == len(BLOB) - 512
+    assert _read(path) == BLOB
+    assert server.ranges[-1] == 'bytes=512-'
+
+
+def test_download_range_stops_once_clip_is_long_enough(server, tmp_path, monkeypatch):
+    # The stream claims 8 kbit/s but really holds 10 kB per second of audio
+    monkeypatch.setattr(audio_engine, 'probe_duration', lambda path: os.path.getsize(path) / 10_000)
+    stream = FakeStream(url=server.url, bitrate=8000)
+
+    path = downloader.download_range(stream, str(tmp_path), 'a.mp4', duration=10, margin=0,
+                                     log=lambda msg: None)
+
+    first_end = 10 * 1000 + downloader.RANGE_HEADER_BYTES - 1  # 7.5s of audio: too short
+    assert server.ranges == [f"bytes=0-{first_end}", f"bytes={first_end + 1}-{2 * first_end + 1}"]
+    assert _read(path) == BLOB[:2 * (first_end + 1)]
+
+
+def test_download_range_short_file_is_fetched_once(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(audio_engine, 'probe_duration', lambda path: pytest.fail("probed"))
+    stream = FakeStream(url=server.url, bitrate=10_000_000)  # estimate exceeds the file
+
+    path = downloader.download_range(stream, str(tmp_path), 'a.mp4', duration=10,
+                                     log=lambda msg: None)
+
+    assert len(server.ranges) == 1
+    assert _read(path) == BLOB
+
+
+def test_download_range_clamps_to_known_filesize(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(audio_engine, 'probe_duration', lambda path: pytest.fail("probed"))
+    stream = FakeStream(url=server.url, bitrate=10_000_000, filesize=len(BLOB))
+
+    path = downloader.download_range(stream, str(tmp_path), 'a.mp4', duration=10,
+                                     log=lambda msg: None)
+
+    assert server.ranges == [f"bytes=0-{len(BLOB) - 1}"]
+    assert _read(path) == BLOB
+
+
+def test_download_range_fetches_the_rest_after_max_growth(server, tmp_path, monkeypatch):
+    monkeypatch.setattr(audio_engine, 'probe_duration', lambda path: None)  # unreadable clip
+    stream = FakeStream(url=server.url, bitrate=8000)
+
+    path = downloader.download_range(stream, str(tmp_path), 'a.mp4', duration=1, margin=0,
+                                     log=lambda msg: None)
+
+    assert len(server.ranges) == downloader.RANGE_MAX_GROWTH + 2
+    assert server.ranges[-1].endswith('-')
+    assert _read(path) == BLOB
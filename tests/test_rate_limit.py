@@ -0,0 +1,47 @@
+"""Token buckets and client address resolution."""
+
+import os
+
+import pytest
+
+import rate_limit
+
+LIMITS = {'ip': (2, 3600)}  # two tokens, one more a second
+
+
+def test_client_ip_trusts_the_proxy_added_entry():
+    # The client controls everything left of what the proxy appended
+    assert rate_limit.client_ip('10.0.0.1', '1.2.3.4, 198.51.100.9', proxy_hops=1) == '198.51.100.9'
+    assert rate_limit.client_ip('10.0.0.1', '198.51.100.9', proxy_hops=1) == '198.51.100.9'
+
+
+def test_client_ip_counts_hops_from_the_right():
+    forwarded = '1.2.3.4, 198.51.100.9, 10.0.0.2'
+    assert rate_limit.client_ip('10.0.0.1', forwarded, proxy_hops=2) == '198.51.100.9'
+
+
+def test_client_ip_falls_back_to_the_peer_address():
+    assert rate_limit.client_ip('10.0.0.1', None, proxy_hops=1) == '10.0.0.1'
+    assert rate_limit.client_ip('10.0.0.1', ' , ', proxy_hops=1) == '10.0.0.1'
+    assert rate_limit.client_ip('10.0.0.1', '198.51.100.9', proxy_hops=2) == '10.0.0.1'
+    assert rate_limit.client_ip('10.0.0.1', '198.51.100.9', proxy_hops=0) == '10.0.0.1'
+    assert rate_limit.client_ip(None, None, proxy_hops=0) == 'unknown'
+
+
+@pytest.mark.skipif('MASHUP_PROXY_HOPS' in os.environ, reason="proxy hops set in the environment")
+def test_default_trusts_one_proxy():
+    assert rate_limit.PROXY_HOPS == 1
+    assert rate_limit.client_ip('10.0.0.1', '198.51.100.9') == '198.51.100.9'
+
+
+def test_bucket_runs_out_and_refund_gives_a_token_back(db):
+    rate_limit.acquire([('ip', 'a')], LIMITS)
+    rate_limit.acquire([('ip', 'a')], LIMITS)
+    with pytest.raises(rate_limit.RateLimited) as blocked:
+        rate_limit.acquire([('ip', 'a')], LIMITS)
+    assert blocked.value.scope == 'ip'
+    assert 0 < blocked.value.retry_after <= 1
+
+    rate_limit.acquire([('ip', 'b')], LIMITS)  # other keys are unaffected
+    rate_limit.refund([('ip', 'a')], LIMITS)
+    rate_limit.acquire([('ip', 'a')], LIMITS)
@@ -0,0 +1,54 @@
+"""Search results shared between processes through the job database."""
+
+import pytest
+
+import search_cache
+from conftest import FakeStream, FakeVideo
+
+
+@pytest.fixture
+def other_process(monkeypatch):
+    """Forget this process's cache, as another worker process would"""
+    def forget():
+        monkeypatch.setattr(search_cache, '_entries', {})
+    forget()
+    return forget
+
+
+def _video(video_id, length=200):
+    video = FakeVideo(video_id, FakeStream(url=f"https://media.example/{video_id}", bitrate=128000))
+    video.length = length
+    return video
+
+
+def test_shared_results_keep_what_was_resolved(db, other_process):
+    search_cache.search('Artist', search_fn=lambda name: [_video('a'), _video('b')])
+    video = search_cache.search('Artist')[0]
+    assert (video.title, video.length) == ('Track a', 200)
+    assert video.streams.filter(only_audio=True).first().url == "https://media.example/a"
+
+    other_process()
+    fetched = []
+
+    def video_fn(video_id):
+        fetched.append(video_id)
+        return _video(video_id, length=300)
+
+    first, second = search_cache.search('artist', video_fn=video_fn)
+    stream = first.streams.filter(only_audio=True).first()
+    assert (first.title, first.length) == ('Track a', 200)
+    assert (stream.url, stream.bitrate) == ("https://media.example/a", 128000)
+    assert fetched == []
+    assert second.length == 300  # never resolved before, so fetched now
+    assert fetched == ['b']
+
+
+def test_fields_resolved_elsewhere_are_merged(db, other_process):
+    search_cache.search('Artist', search_fn=lambda name: [_video('a')])
+    other_process()
+    search_cache.search('Artist', video_fn=_video)[0].title
+    other_process()
+    search_cache.search('Artist', video_fn=_video)[0].length
+    other_process()
+    assert search_cache.search('Artist', video_fn=None)[0].describe() == {
+        'video_id': 'a', 'title': 'Track a', 'length': 200}
@@ -0,0 +1,330 @@
+"""
+Choose which search results go into a mashup.
+
+A search for an artist often returns the same song several times (official
+video, lyric video, live version) and things that are not songs at all
+(interviews, shorts, full albums). Two checks keep them out:
+
+- Before downloading, each result's metadata: titles with non-music words,
+  tracks shorter than MASHUP_MIN_TRACK_SECONDS (shorts) or longer than
+  MASHUP_MAX_TRACK_SECONDS (long-form content), and titles that name a song
+  already chosen once brackets and words like "official"/"lyrics" are removed.
+- After downloading, each clip's audio: its first seconds are reduced with
+  NumPy to a compact fingerprint (chroma and octave-band energy, overall and
+  per block of time). Fingerprints are hashed (SimHash) so only clips whose
+  hashes are close get compared in full, and a clip whose cosine similarity
+  to an accepted one reaches MASHUP_DUPLICATE_SIMILARITY is dropped.
+
+Every dropped result is replaced with the next acceptable one from the rest
+of the search results. Fingerprints are cached per video id next to the clip
+cache.
+"""
+
+import hashlib
+import os
+import re
+import tempfile
+import threading
+
+import clip_cache
+import segment_select
+import telemetry
+from audio_engine import EngineError
+
+# Filter configuration (override with environment variables)
+FILTER_ENABLED = os.environ.get("MASHUP_FILTER", "1") == "1"
+MIN_TRACK_SECONDS = float(os.environ.get("MASHUP_MIN_TRACK_SECONDS", "60"))  # shorter: shorts, clips
+MAX_TRACK_SECONDS = float(os.environ.get("MASHUP_MAX_TRACK_SECONDS", "900"))  # longer: long-form
+FINGERPRINT_SECONDS = float(os.environ.get("MASHUP_FINGERPRINT_SECONDS", "15"))
+DUPLICATE_SIMILARITY = float(os.environ.get("MASHUP_DUPLICATE_SIMILARITY", "0.95"))  # cosine
+METADATA_WORKERS = int(os.environ.get("MASHUP_METADATA_WORKERS", "8"))  # parallel title/length lookups
+
+NON_MUSIC_WORDS = ('interview', 'podcast', 'reaction', 'full album', 'jukebox', 'audio jukebox',
+                   'press conference', 'behind the scenes', 'making of', 'trailer', 'teaser',
+                   'documentary', 'vlog', '#shorts', 'livestream', 'live stream', 'nonstop',
+                   'non-stop', 'mashup', 'tutorial', 'karaoke')
+TITLE_NOISE_WORDS = {'official', 'video', 'music', 'lyric', 'lyrics', 'audio', 'full', 'song',
+                     'hd', 'hq', '4k', 'live', 'version', 'visualizer', 'remastered', 'with',
+                     'ft', 'feat', 'featuring', 'by', 'new', 'latest', 'the'}
+
+FRAME_SIZE = 2048  # samples at segment_select.ANALYSIS_RATE (~0.26 s)
+BLOCKS = 4  # time blocks summarised in a fingerprint
+HASH_BITS = 64
+CANDIDATE_BITS = 20  # hashes further apart than this are not compared in full
+CHROMA_RANGE = (110.0, 3520.0)  # Hz, A2..A7
+OCTAVE_EDGES = (62.5, 125.0, 250.0, 500.0, 1000.0, 2000.0, 4000.0)  # Hz
+
+FINGERPRINT_DIR = clip_cache.add_folder('fingerprint', "fingerprints")
+
+_planes = None  # random hyperplanes of the SimHash, fixed by seed
+_metadata_pool = None  # created on first use, so it is never inherited across a fork
+_metadata_pool_lock = threading.Lock()
+
+
+def _fingerprint_path(key):
+    return os.path.join(FINGERPRINT_DIR, hashlib.sha1(key.encode('utf-8')).hexdigest() + ".npy")
+
+
+def _pool():
+    global _metadata_pool
+    with _metadata_pool_lock:
+        if _metadata_pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _metadata_pool = ThreadPoolExecutor(max_workers=max(1, METADATA_WORKERS),
+                                                thread_name_prefix="track-metadata")
+        return _metadata_pool
+
+
+def non_music_reason(title, length, min_length=MIN_TRACK_SECONDS, max_length=MAX_TRACK_SECONDS):
+    """Return why a result does not look like a song from its metadata, or None"""
+    if length:
+        if length < min_length:
+            return f"too short ({length}s)"
+        if length > max_length:
+            return f"too long ({length}s)"
+    lowered = (title or '').lower()
+    for word in NON_MUSIC_WORDS:
+        if word in lowered:
+            return f"title mentions '{word}'"
+    return None
+
+
+def song_key(title, singer_name=''):
+    """Reduce a title to the words naming the song, for spotting re-uploads.
+
+    Returns a frozenset of words, empty when nothing distinctive is left.
+    """
+    title = re.sub(r'[(\[{].*?[)\]}]', ' ', (title or '').lower())
+    ignored = TITLE_NOISE_WORDS | set(re.findall(r'\w+', singer_name.lower()))
+    return frozenset(word for word in re.findall(r'\w+', title) if word not in ignored)
+
+
+def fingerprint(samples, rate=segment_select.ANALYSIS_RATE):
+    """Return the unit-length fingerprint vector of mono samples, or None if too short or silent.
+
+    It holds the chroma (12 pitch classes) and the octave-band energy in dB,
+    once for the whole excerpt and once per block of time, each part centred
+    so that loudness and encoding differences cancel out. The overall parts
+    tolerate a small offset between two uploads, the block parts tell apart
+    songs in the same key.
+    """
+    import numpy as np
+    count = len(samples) // FRAME_SIZE
+    if count < BLOCKS:
+        return None
+    frames = samples[:count * FRAME_SIZE].reshape(count, FRAME_SIZE)
+    power = np.abs(np.fft.rfft(frames * np.hanning(FRAME_SIZE).astype(np.float32), axis=1)) ** 2
+    if power.sum() < 1e-6:
+        return None
+    freqs = np.fft.rfftfreq(FRAME_SIZE, 1.0 / rate)
+
+    in_range = (freqs >= CHROMA_RANGE[0]) & (freqs <= CHROMA_RANGE[1])
+    pitch_class = np.round(12 * np.log2(freqs[in_range] / 440.0)).astype(int) % 12
+    mapping = np.zeros((len(pitch_class), 12), dtype=np.float32)
+    mapping[np.arange(len(pitch_class)), pitch_class] = 1.0
+    mapping /= np.maximum(mapping.sum(axis=0), 1.0)  # same weight for every pitch class
+    chroma = power[:, in_range] @ mapping
+    chroma /= chroma.sum(axis=1, keepdims=True) + 1e-12
+
+    octave_bins = np.digitize(freqs, OCTAVE_EDGES)  # 1..len(OCTAVE_EDGES)-1 inside the bands
+    octaves = np.stack([power[:, octave_bins == band].sum(axis=1)
+                        for band in range(1, len(OCTAVE_EDGES))], axis=1)
+    octaves_db = 10 * np.log10(octaves + 1e-10)
+
+    blocks = np.array_split(np.arange(count), BLOCKS)
+    chroma_blocks = np.stack([chroma[block].mean(axis=0) for block in blocks])
+    octave_blocks = np.stack([octaves_db[block].mean(axis=0) for block in blocks])
+    overall_chroma = chroma.mean(axis=0)
+    overall_octaves = octaves_db.mean(axis=0)
+    parts = [overall_chroma - overall_chroma.mean(), overall_octaves - overall_octaves.mean(),
+             chroma_blocks - chroma_blocks.mean(axis=1, keepdims=True),
+             octave_blocks - octave_blocks.mean()]
+    features = np.concatenate([part.ravel() / (np.linalg.norm(part) or 1.0) for part in parts])
+    return (features / np.linalg.norm(features)).astype(np.float32)
+
+
+def simhash(features):
+    """Hash a fingerprint to HASH_BITS bits (int); similar fingerprints differ in few bits"""
+    import numpy as np
+    global _planes
+    if _planes is None or _planes.shape[1] != len(features):
+        _planes = np.random.default_rng(20240601).standard_normal((HASH_BITS, len(features)))
+    return int(sum(1 << int(n) for n in np.flatnonzero(_planes @ features > 0)))
+
+
+def distance(a, b):
+    """Return the number of differing bits between two hashes"""
+    return bin(a ^ b).count('1')
+
+
+def load_fingerprint(key):
+    """Return the cached fingerprint for a key, or None"""
+    import numpy as np
+    path = _fingerprint_path(key)
+    try:
+        features = np.load(path)
+        os.utime(path)  # mark as recently used for the clip cache eviction
+        return features
+    except (OSError, ValueError):
+        return None
+
+
+def save_fingerprint(key, features):
+    """Atomically store a fingerprint"""
+    import numpy as np
+    os.makedirs(FINGERPRINT_DIR, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=FINGERPRINT_DIR, prefix=".tmp-", suffix=".npy")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, features)
+        os.replace(tmp_path, _fingerprint_path(key))
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class TrackFilter:
+    """Hands out search results for a mashup, skipping non-music and duplicates.
+
+    select() picks the first results that pass the metadata checks; the
+    pipeline then calls check() on every downloaded clip and, when it
+    returns a reason to drop it, replacement() for the next candidate.
+    With enabled=False results are used as they come.
+
+    A result's title and length are fetched lazily (a request each), so they
+    are looked up in parallel on a shared thread pool a few results ahead of
+    the one being examined, and never while holding the filter's lock.
+    """
+
+    def __init__(self, results, singer_name='', duration=None,
+                 segment=segment_select.SEGMENT_MODE, enabled=FILTER_ENABLED,
+                 cache=clip_cache.CACHE_ENABLED, log=print):
+        self.singer_name = singer_name
+        self.duration = duration
+        self.segment = segment
+        self.enabled = enabled
+        self.cache = cache
+        self.log = log
+        self.skipped = []  # (title, reason) of every result left out
+        self._candidates = list(results)
+        self._position = 0  # next candidate to examine
+        self._metadata = {}  # position -> Future of (title, length)
+        self._lock = threading.Lock()
+        self._song_keys = set()
+        self._fingerprints = []  # (hash, fingerprint, title) of accepted clips
+
+    def _title(self, video):
+        try:
+            return video.title or ''
+        except Exception:
+            return ''
+
+    def _resolve(self, video):
+        title = self._title(video)
+        try:
+            length = video.length
+        except Exception:
+            length = None
+        return title, length
+
+    def _prefetch(self, count):
+        # Called with the lock held; only submits the lookups
+        end = min(len(self._candidates), self._position + count)
+        for n in range(self._position, end):
+            if n not in self._metadata:
+                self._metadata[n] = _pool().submit(self._resolve, self._candidates[n])
+
+    def _skip(self, title, reason):
+        with self._lock:
+            self.skipped.append((title, reason))
+        self.log(f"Skipping '{title[:50]}': {reason}")
+        telemetry.inc('mashup_tracks_skipped_total', reason='metadata')
+
+    def _next(self):
+        while True:
+            with self._lock:
+                if self._position >= len(self._candidates):
+                    return None
+                if not self.enabled:
+                    self._position += 1
+                    return self._candidates[self._position - 1]
+                self._prefetch(METADATA_WORKERS)
+                video = self._candidates[self._position]
+                lookup = self._metadata.pop(self._position)
+                self._position += 1
+            title, length = lookup.result()
+            reason = non_music_reason(title, length)
+            key = song_key(title, self.singer_name)
+            with self._lock:
+                if reason is None and key and key in self._song_keys:
+                    reason = "same song as an earlier result"
+                if reason is None and key:
+                    self._song_keys.add(key)
+            if reason is None:
+                return video
+            self._skip(title, reason)
+
+    def select(self, count):
+        """Return up to `count` results that pass the metadata checks, in search order"""
+        if self.enabled:
+            with self._lock:
+                self._prefetch(count + METADATA_WORKERS)
+        videos = []
+        while len(videos) < count:
+            video = self._next()
+            if video is None:
+                break
+            videos.append(video)
+        return videos
+
+    def replacement(self):
+        """Return the next result that passes the metadata checks, or None"""
+        return self._next()
+
+    def _fingerprint_key(self, video_id):
+        key = video_id
+        # The clip starts at a different point (per Y) in the energy mode
+        if self.segment == 'energy':
+            key += f":energy:{self.duration}"
+        # Clips shorter than the fingerprint (previews) give different fingerprints
+        if self.duration and self.duration < FINGERPRINT_SECONDS:
+            key += f":{self.duration}s"
+        return key
+
+    def clip_fingerprint(self, video, path):
+        """Return the fingerprint of a downloaded clip (cached per video id), or None"""
+        video_id = getattr(video, 'video_id', None)
+        key = self._fingerprint_key(video_id) if self.cache and video_id else None
+        features = load_fingerprint(key) if key else None
+        if features is None:
+            try:
+                features = fingerprint(segment_select.decode_mono(path, seconds=FINGERPRINT_SECONDS))
+            except (EngineError, ImportError) as e:
+                self.log(f"Warning: Could not fingerprint {os.path.basename(path)}: {str(e)}")
+                return None
+            if key and features is not None:
+                try:
+                    save_fingerprint(key, features)
+                except OSError as e:
+                    self.log(f"Warning: Could not cache fingerprint of {os.path.basename(path)}: {str(e)}")
+        return features
+
+    def check(self, video, path):
+        """Return why the downloaded clip at `path` should be dropped, or None to keep it"""
+        if not self.enabled:
+            return None
+        features = self.clip_fingerprint(video, path)
+        if features is None:
+            return None
+        value = simhash(features)
+        own_title = self._title(video)
+        with self._lock:
+            for other_value, other, title in self._fingerprints:
+                if distance(value, other_value) <= CANDIDATE_BITS and \
+                        float(features @ other) >= DUPLICATE_SIMILARITY:
+                    reason = f"sounds like '{title[:50]}'"
+                    self.skipped.append((own_title, reason))
+                    return reason
+            self._fingerprints.append((value, features, own_title))
+        return None
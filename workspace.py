@@ -0,0 +1,286 @@
+"""
+Per-job scratch workspaces with a disk quota and a reaper.
+
+Every job gets its own uniquely named directory (task_<job id>_<random>)
+under the workspace root, holding a lock file for as long as the job runs.
+A finished job's directory is removed; a failed job's directory is kept for
+debugging with a .failed marker, until the reaper removes it by age
+(MASHUP_FAILED_TTL) or to keep failed directories under MASHUP_FAILED_MAX_MB.
+Directories left by a crashed process (unlocked, unmarked) count as failed.
+
+New jobs are only admitted while the workspaces fit in the quota
+(MASHUP_WORKSPACE_QUOTA_MB) with room for the new job's estimated size and
+for what the jobs admitted earlier will still need (see check_quota).
+
+With MASHUP_TMPFS=1 workspaces are created on tmpfs (/dev/shm) when it has
+room, so downloaded tracks and decoded segments never touch the disk.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import telemetry
+from pipeline import PCM_BYTES_PER_SECOND, STAGE_QUEUE_SIZE
+
+try:
+    import fcntl
+except ImportError:  # Windows: active workspaces are recognised by age only
+    fcntl = None
+
+# Workspace configuration (override with environment variables)
+WORKSPACE_ROOT = os.environ.get("MASHUP_WORKSPACE_DIR", os.path.join(tempfile.gettempdir(), "mashup_work"))
+QUOTA_BYTES = int(float(os.environ.get("MASHUP_WORKSPACE_QUOTA_MB", "10240")) * 1024 * 1024)
+FAILED_TTL = float(os.environ.get("MASHUP_FAILED_TTL", str(24 * 3600)))  # seconds
+FAILED_MAX_BYTES = int(float(os.environ.get("MASHUP_FAILED_MAX_MB", "2048")) * 1024 * 1024)
+REAP_INTERVAL = float(os.environ.get("MASHUP_REAP_INTERVAL", "300"))  # seconds
+USE_TMPFS = os.environ.get("MASHUP_TMPFS", "0") == "1"
+TMPFS_DIR = os.environ.get("MASHUP_TMPFS_DIR", "/dev/shm")
+
+PREFIX = "task_"
+LOCK_FILE = ".lock"
+FAILED_MARKER = ".failed"
+ORPHAN_GRACE = 60.0  # seconds before an unlocked, unmarked directory counts as abandoned
+AUDIO_BYTES_PER_SECOND = 24 * 1024  # ~192 kbps, for size estimates
+ESTIMATE_SLACK_SECONDS = 30  # per track: range-fetch margin and growth
+
+_root = WORKSPACE_ROOT
+_reaper = None
+_reaper_lock = threading.Lock()
+
+
+class QuotaExceeded(Exception):
+    """Raised when a new job would not fit in the workspace quota"""
+
+    def __init__(self, used, needed, quota):
+        super().__init__(f"Workspace quota exceeded ({used // 2**20} MB used, "
+                         f"{needed // 2**20} MB needed, quota {quota // 2**20} MB)")
+        self.used = used
+        self.needed = needed
+        self.quota = quota
+
+
+def configure(root):
+    """Set the directory job workspaces are created in"""
+    global _root
+    _root = root
+    os.makedirs(root, exist_ok=True)
+
+
+def _tmpfs_root():
+    return os.path.join(TMPFS_DIR, "mashup-" + os.path.basename(os.path.abspath(_root)))
+
+
+def roots():
+    """Return every directory that may hold workspaces"""
+    result = [_root]
+    if USE_TMPFS and os.path.isdir(TMPFS_DIR):
+        result.append(_tmpfs_root())
+    return result
+
+
+def _scratch_root(estimate):
+    """Pick tmpfs when enabled and it has room for the job, the workspace root otherwise"""
+    if USE_TMPFS and os.path.isdir(TMPFS_DIR) and os.access(TMPFS_DIR, os.W_OK):
+        if shutil.disk_usage(TMPFS_DIR).free > 2 * estimate:
+            return _tmpfs_root()
+    return _root
+
+
+def estimate_job_bytes(num_videos, duration):
+    """Rough upper bound of the scratch space one job needs: each downloaded
+    track and its cut clip, the decoded segments in flight and the output"""
+    per_track = 2 * (duration + ESTIMATE_SLACK_SECONDS) * AUDIO_BYTES_PER_SECOND
+    in_flight = (STAGE_QUEUE_SIZE + 1) * duration * PCM_BYTES_PER_SECOND
+    output = num_videos * duration * AUDIO_BYTES_PER_SECOND
+    return int(num_videos * per_track + in_flight + output)
+
+
+def _dir_size(path):
+    total = 0
+    try:
+        entries = list(os.scandir(path))
+    except OSError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += _dir_size(entry.path)
+            else:
+                total += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            pass
+    return total
+
+
+def _workspaces():
+    """Yield (path, state, age seconds, size bytes) for every workspace.
+
+    state is 'active' (its job still holds the lock), 'failed', or
+    'abandoned' (left unlocked and unmarked by a process that died).
+    """
+    now = time.time()
+    for root in roots():
+        try:
+            names = [name for name in os.listdir(root) if name.startswith(PREFIX)]
+        except OSError:
+            continue
+        for name in names:
+            path = os.path.join(root, name)
+            if not os.path.isdir(path):
+                continue
+            marker = os.path.join(path, FAILED_MARKER)
+            try:
+                if os.path.exists(marker):
+                    state, age = 'failed', now - os.path.getmtime(marker)
+                else:
+                    age = now - os.path.getmtime(path)
+                    state = 'active' if _is_locked(path) or age < ORPHAN_GRACE else 'abandoned'
+            except OSError:
+                continue
+            yield path, state, age, _dir_size(path)
+
+
+def _is_locked(path):
+    lock_path = os.path.join(path, LOCK_FILE)
+    if fcntl is None:
+        # No way to tell; treat as active until it is as old as a failed one may get
+        return time.time() - os.path.getmtime(path) < FAILED_TTL
+    try:
+        # Opened read-only so probing never creates files in the directory
+        with open(lock_path, 'r') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(f, fcntl.LOCK_UN)
+            return False
+    except OSError:
+        return False
+
+
+def usage():
+    """Return the bytes used by all workspaces, by state"""
+    totals = {'active': 0, 'failed': 0, 'abandoned': 0}
+    for _, state, _, size in _workspaces():
+        totals[state] += size
+    return totals
+
+
+def job_usage():
+    """Return the bytes used by each active workspace, by job id"""
+    totals = {}
+    for path, state, _, size in _workspaces():
+        if state == 'active':
+            job_id = os.path.basename(path)[len(PREFIX):].rsplit('_', 1)[0]
+            totals[job_id] = totals.get(job_id, 0) + size
+    return totals
+
+
+def reap(quota=None, log=telemetry.log):
+    """Remove failed and abandoned workspaces that are too old, then the oldest
+    ones while they exceed FAILED_MAX_BYTES or the whole quota is exceeded.
+
+    Returns (removed count, bytes freed).
+    """
+    quota = QUOTA_BYTES if quota is None else quota
+    workspaces = list(_workspaces())
+    total = sum(size for _, _, _, size in workspaces)
+    # Oldest first
+    dead = sorted((w for w in workspaces if w[1] != 'active'), key=lambda w: -w[2])
+    dead_total = sum(size for _, _, _, size in dead)
+
+    removed = freed = 0
+    for path, state, age, size in dead:
+        if age < FAILED_TTL and dead_total <= FAILED_MAX_BYTES and total <= quota:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        removed += 1
+        freed += size
+        dead_total -= size
+        total -= size
+        log(f"Workspace reaper: removed {state} workspace {os.path.basename(path)} "
+            f"({size // 1024} KB, {age / 3600:.1f}h old)")
+    return removed, freed
+
+
+def check_quota(needed, quota=None, reserved=0):
+    """Raise QuotaExceeded unless a job needing `needed` bytes fits in the quota.
+
+    `reserved` is the space admitted jobs will still take beyond what their
+    workspaces use now (queued jobs have none yet), counted as used.
+    Reaps failed workspaces first if that would make room.
+    """
+    quota = QUOTA_BYTES if quota is None else quota
+    used = sum(usage().values()) + reserved
+    if used + needed > quota:
+        reap(quota=max(0, quota - needed - reserved))
+        used = sum(usage().values()) + reserved
+        if used + needed > quota:
+            raise QuotaExceeded(used, needed, quota)
+
+
+@contextmanager
+def job_workspace(job_id, estimate=0, keep_failed=True):
+    """Create a unique workspace directory for a job and yield its path.
+
+    It is removed when the block completes; if the block raises it is kept
+    with a .failed marker for the reaper (or removed, with keep_failed=False).
+    """
+    root = _scratch_root(estimate)
+    os.makedirs(root, exist_ok=True)
+    path = tempfile.mkdtemp(prefix=f"{PREFIX}{job_id}_", dir=root)
+    lock_file = open(os.path.join(path, LOCK_FILE), 'a')
+    if fcntl:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+    try:
+        yield path
+    except BaseException as e:
+        if keep_failed:
+            try:
+                with open(os.path.join(path, FAILED_MARKER), 'w') as f:
+                    f.write(f"{type(e).__name__}: {str(e)}\n")
+            except OSError:
+                pass
+        else:
+            shutil.rmtree(path, ignore_errors=True)
+        raise
+    else:
+        shutil.rmtree(path, ignore_errors=True)
+    finally:
+        lock_file.close()
+
+
+def _reap_forever(interval, sweep=None):
+    import job_queue
+    lock_file = job_queue.wait_for_leadership(os.path.join(_root, ".reaper.lock"))  # keep open
+    while True:
+        try:
+            reap()
+        except Exception as e:
+            telemetry.log(f"Workspace reaper: Warning - {str(e)}", level='warning')
+        if sweep:
+            try:
+                sweep()
+            except Exception as e:
+                telemetry.log(f"Retention sweep: Warning - {str(e)}", level='warning')
+        time.sleep(interval)
+
+
+def start_reaper(interval=None, sweep=None):
+    """Start (once per process, including forked children) the background reaper.
+
+    Only one process per workspace root reaps at a time; it also calls
+    `sweep()` every round, for other cleanup that must run once per host.
+    """
+    import job_queue  # not at module level: the CLI only needs the workspaces
+    global _reaper
+    interval = REAP_INTERVAL if interval is None else interval
+    with _reaper_lock:
+        if (_reaper is not None and _reaper.is_alive()) or job_queue.in_worker():
+            return
+        _reaper = threading.Thread(target=_reap_forever, args=(interval, sweep), daemon=True)
+        _reaper.start()